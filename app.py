@@ -1,53 +1,169 @@
 import os
+import json
+import hashlib
 import psycopg2
-import sqlite3
 import time
 import threading
-from flask import Flask, render_template, request, redirect, url_for, session, flash
-from werkzeug.security import generate_password_hash, check_password_hash
+import click
+from flask import (Flask, render_template, request, redirect, url_for, session, flash, g, has_app_context,
+                   Response, stream_with_context, send_from_directory)
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from markupsafe import Markup
 from datetime import date, datetime, timedelta
-from werkzeug.utils import secure_filename
-from twilio.rest import Client
 from zoneinfo import ZoneInfo
+import logging
+import registro
+registro.configurar()  # antes que los demás módulos, para que sus logs salgan ya estructurados
+import db
+from db import adapt_query
+import repositorio
+import notificaciones
+import exportar
+import eventos
+import imagenes
+import estaticos
+import compresion
+import metricas
+from tareas import ejecutar_como_lider
+from cache import (cache, leer_o_calcular, version_peluquero, invalidar_peluquero,
+                   invalidar_todos, invalidar_lista_peluqueros)
+
+log = logging.getLogger(__name__)
 
 # --- zona horaria: America/Bogota
 tz = ZoneInfo("America/Bogota")
 ahora = datetime.now(tz)
 
-ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
-AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
-TWILIO_WHATSAPP = os.getenv("TWILIO_WHATSAPP_NUMBER")
+# Recordatorios: cuántos minutos antes de la cita se avisa al cliente y
+# cuánto puede dormir como máximo el hilo entre revisiones (segundos)
+RECORDATORIO_VENTANA = int(os.getenv("RECORDATORIO_VENTANA", "60"))
+RECORDATORIO_MAX_ESPERA = int(os.getenv("RECORDATORIO_MAX_ESPERA", "900"))
 
 # 📂 Asegurar carpeta de imágenes
 UPLOAD_FOLDER = os.path.join("static", "img_peluqueros")
+URL_FOTOS = "/static/img_peluqueros"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 app = Flask(__name__)
 app.secret_key = "clave-secreta"
 
-# ---------- CONFIG BD ----------
-USE_POSTGRES = os.getenv("USE_POSTGRES", "False").lower() == "true"
+# ---------- MEDICIÓN DE PETICIONES ----------
+# Cada petición cuenta sus consultas y el tiempo en la base (db.medicion) y
+# lo devuelve en Server-Timing (visible en las herramientas del navegador);
+# los totales por ruta quedan en /metrics para Prometheus. Además lleva un id
+# (X-Request-ID, recibido o nuevo) que aparece en todos sus logs. Se registra antes
+# que los demás after_request para que el total incluya la compresión.
+SERVER_TIMING = os.getenv("SERVER_TIMING", "True").lower() == "true"
+
+@app.before_request
+def iniciar_medicion():
+    g.inicio_peticion = time.perf_counter()
+    g.id_peticion, g.token_peticion = registro.iniciar_peticion(request.headers.get("X-Request-ID"))
+    db.reiniciar_medicion()
+
+@app.teardown_request
+def terminar_medicion(exc):
+    token = g.pop("token_peticion", None)
+    if token is not None:
+        registro.terminar_peticion(token)
+
+@app.after_request
+def registrar_medicion(resp):
+    inicio = g.pop("inicio_peticion", None)
+    if inicio is None:
+        return resp
+    total = time.perf_counter() - inicio
+    consultas, segundos_bd = db.medicion()
+    endpoint = request.endpoint or "sin_ruta"
+    metricas.PETICION_SEGUNDOS.observar(total, endpoint=endpoint, metodo=request.method)
+    metricas.PETICIONES.sumar(endpoint=endpoint, metodo=request.method, estado=resp.status_code)
+    metricas.CONSULTAS_POR_PETICION.observar(consultas, endpoint=endpoint)
+    metricas.BD_SEGUNDOS.sumar(segundos_bd, endpoint=endpoint)
+    log.info("%s %s → %s", request.method, request.path, resp.status_code,
+             extra={"datos": {"endpoint": endpoint, "ms": round(total * 1000, 1), "consultas": consultas,
+                              "ms_bd": round(segundos_bd * 1000, 1)}})
+    if g.get("id_peticion"):
+        resp.headers["X-Request-ID"] = g.id_peticion
+    if SERVER_TIMING:
+        resp.headers["Server-Timing"] = (f'db;dur={segundos_bd * 1000:.1f};desc="{consultas} consultas", '
+                                         f'app;dur={total * 1000:.1f}')
+    return resp
+
+@app.route("/metrics")
+def metricas_prometheus():
+    if not metricas.autorizado(request.headers.get("Authorization")):
+        return Response("No autorizado\n", status=401, headers={"WWW-Authenticate": "Bearer"})
+    return Response(metricas.exponer(), content_type=metricas.TIPO_CONTENIDO)
+
+# ---------- ESTÁTICOS ----------
+# url_for('static', ...) agrega ?v=<huella del contenido>; esas URLs (y las
+# fotos con hash en el nombre) se sirven con caché de un año e 'immutable'
+
+@app.url_defaults
+def versionar_estaticos(endpoint, values):
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        version = estaticos.huella(app.static_folder, values["filename"])
+        if version:
+            values["v"] = version
+
+def servir_estatico(filename):
+    if safe_join(app.static_folder, filename) is None:
+        return "No encontrado", 404
+    comprimido, codificacion = estaticos.variante_comprimida(
+        app.static_folder, filename, request.headers.get("Accept-Encoding"))
+    if comprimido:
+        resp = send_from_directory(app.static_folder, comprimido, mimetype=estaticos.tipo_mime(filename))
+        resp.headers["Content-Encoding"] = codificacion
+    else:
+        resp = app.send_static_file(filename)
+    resp.vary.add("Accept-Encoding")
+    if estaticos.es_inmutable(app.static_folder, filename, request.args.get("v")):
+        resp.headers["Cache-Control"] = f"public, max-age={estaticos.ESTATICOS_MAX_AGE}, immutable"
+    return resp
+
+app.view_functions["static"] = servir_estatico
+estaticos.precalcular(app.static_folder)
+
+@app.after_request
+def comprimir(resp):
+    return compresion.comprimir_respuesta(resp, request.headers.get("Accept-Encoding"))
 
-if USE_POSTGRES:
-    DB_NAME = os.getenv("POSTGRES_DB", "barberia")
-    DB_USER = os.getenv("POSTGRES_USER", "postgres")
-    DB_PASSWORD = os.getenv("POSTGRES_PASSWORD", "postgres")
-    DB_HOST = os.getenv("POSTGRES_HOST", "localhost")
-    DB_PORT = os.getenv("POSTGRES_PORT", "5432")
-else:
-    DB_NAME = "barberia.db"
+@app.cli.command("comprimir-estaticos")
+def comprimir_estaticos_cli():
+    """Genera variantes .gz (y .br con el paquete 'brotli') de los archivos de texto de /static."""
+    click.echo(f"✅ {estaticos.comprimir(app.static_folder)} variantes comprimidas escritas")
+
+@app.template_filter("srcset")
+def filtro_srcset(foto, formato="jpg"):
+    """{{ foto|srcset('webp') }}: variantes por ancho de una foto procesada."""
+    return imagenes.srcset(foto, formato)
+
+# ---------- CONEXIONES ----------
+# El pool (Postgres) o la conexión por hilo (SQLite) viven en db.py
 
 def get_conn():
-    database_url = os.getenv("DATABASE_URL")
-    if not database_url:
-        raise Exception("❌ No se encontró la variable DATABASE_URL")
-    return psycopg2.connect(database_url)
+    """Conexión del pool. Dentro de un request es una sola por app context."""
+    if has_app_context():
+        if "db_conn" not in g:
+            conn = db.tomar_conexion()
+            conn._en_request = True
+            g.db_conn = conn
+        return g.db_conn
+    return db.tomar_conexion()
+
+@app.teardown_appcontext
+def devolver_conexion(exc):
+    conn = g.pop("db_conn", None)
+    if conn is not None:
+        conn.devolver()
 
 def inicio_semana_con_offset(semana_offset: int):
     hoy = datetime.now().date()
     inicio = hoy - timedelta(days=hoy.weekday())
     return inicio + timedelta(weeks=int(semana_offset))
 
+DIAS_SEMANA = ['lunes', 'martes', 'miercoles', 'jueves', 'viernes', 'sabado', 'domingo']
+
 def fecha_desde_dia(dia, semana_offset):
     inicio_semana = inicio_semana_con_offset(semana_offset)
 
@@ -63,9 +179,6 @@ def fecha_desde_dia(dia, semana_offset):
 
     return inicio_semana + timedelta(days=dias[dia])
 
-def adapt_query(query: str) -> str:
-    return query.replace("?", "%s") if USE_POSTGRES else query
-
 # ---------- INIT SCHEMA ----------
 def init_schema():
     conn = get_conn()
@@ -102,22 +215,405 @@ def init_schema():
     conn.commit()
     conn.close()
 
+# ---------- MIGRACIONES ----------
+# Convierte 'hh:mm AM/PM' en TIME. Solo usa funciones inmutables (sin zona
+# horaria) para poder usarse en columnas generadas; si el texto no tiene ese
+# formato queda NULL en vez de romper el INSERT.
+SQL_HORA_A_TIME = (
+    "CASE WHEN hora ~ '^[0-9]{1,2}:[0-9]{2} [AaPp][Mm]$' THEN make_time("
+    "split_part(hora, ':', 1)::int % 12 + CASE WHEN upper(right(hora, 2)) = 'PM' THEN 12 ELSE 0 END, "
+    "substring(hora from ':([0-9]{2})')::int, 0) END"
+)
+
+# Cada migración es (nombre, [sentencias]) y se aplica una sola vez: el nombre
+# queda en schema_migraciones. Las ya publicadas no se editan; un cambio de
+# esquema es una migración nueva al final de la lista.
+MIGRACIONES = [
+    # Columnas que el código ya usa y que init_schema no crea
+    ("001_columnas_base", [
+        "ALTER TABLE peluqueros ADD COLUMN IF NOT EXISTS telefono TEXT",
+        "ALTER TABLE peluqueros ADD COLUMN IF NOT EXISTS porcentaje NUMERIC DEFAULT 50",
+        "ALTER TABLE horarios ADD COLUMN IF NOT EXISTS fecha DATE",
+        "ALTER TABLE horarios ADD COLUMN IF NOT EXISTS bloqueado BOOLEAN DEFAULT FALSE",
+        "ALTER TABLE citas ADD COLUMN IF NOT EXISTS fecha DATE",
+        "ALTER TABLE citas ADD COLUMN IF NOT EXISTS fijo BOOLEAN DEFAULT FALSE",
+        "ALTER TABLE citas ADD COLUMN IF NOT EXISTS recordatorio_enviado BOOLEAN DEFAULT FALSE",
+    ]),
+
+    # Hora tipada: ordenar y filtrar en la base en lugar de strptime en Python
+    ("002_hora_tipada", [
+        "ALTER TABLE horarios ADD COLUMN IF NOT EXISTS hora_t TIME GENERATED ALWAYS AS (" + SQL_HORA_A_TIME + ") STORED",
+        "ALTER TABLE citas ADD COLUMN IF NOT EXISTS hora_t TIME GENERATED ALWAYS AS (" + SQL_HORA_A_TIME + ") STORED",
+        # Momento real de la cita (fecha + hora) para rangos de tiempo
+        "ALTER TABLE citas ADD COLUMN IF NOT EXISTS inicio TIMESTAMP GENERATED ALWAYS AS (fecha + " + SQL_HORA_A_TIME + ") STORED",
+    ]),
+
+    # Índices para los accesos de calendario y reservas
+    ("003_indices_calendario", [
+        "CREATE INDEX IF NOT EXISTS idx_horarios_peluquero_fecha ON horarios (peluquero_id, fecha)",
+        "CREATE INDEX IF NOT EXISTS idx_horarios_peluquero_dia_hora ON horarios (peluquero_id, dia, hora)",
+        "CREATE INDEX IF NOT EXISTS idx_citas_peluquero_fecha ON citas (peluquero_id, fecha)",
+        "CREATE INDEX IF NOT EXISTS idx_citas_peluquero_dia_hora ON citas (peluquero_id, dia, hora)",
+    ]),
+
+    # Grilla base: un solo horario por peluquero, día y hora (crear_horarios_base
+    # se apoya en este índice para no duplicarla). Antes se borran los repetidos
+    # que dejó la grilla cargada sin él, conservando el más antiguo.
+    ("004_grilla_base_unica", [
+        """
+        DELETE FROM horarios a
+        USING horarios b
+        WHERE a.fecha IS NULL AND b.fecha IS NULL
+          AND a.peluquero_id = b.peluquero_id AND a.dia = b.dia AND a.hora = b.hora
+          AND a.id > b.id
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_horarios_base ON horarios (peluquero_id, dia, hora) WHERE fecha IS NULL",
+    ]),
+
+    # Un horario solo puede reservarse una vez: lo garantiza la base, no un SELECT previo.
+    # Las citas repetidas que dejó la reserva anterior (contar y luego insertar)
+    # impedirían crear el índice: se conserva la más antigua de cada horario y
+    # las demás pasan a 'citas_duplicadas' para revisarlas a mano.
+    ("005_citas_unicas", [
+        "CREATE TABLE IF NOT EXISTS citas_duplicadas AS SELECT * FROM citas WITH NO DATA",
+        """
+        WITH movidas AS (
+            DELETE FROM citas a
+            USING citas b
+            WHERE a.peluquero_id = b.peluquero_id AND a.fecha = b.fecha AND a.hora = b.hora
+              AND a.id > b.id
+            RETURNING a.*
+        )
+        INSERT INTO citas_duplicadas SELECT * FROM movidas
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_citas_peluquero_fecha_hora ON citas (peluquero_id, fecha, hora)",
+    ]),
 
+    # Recordatorios: solo las citas pendientes, ordenadas por su momento real
+    ("006_indice_recordatorios", [
+        "CREATE INDEX IF NOT EXISTS idx_citas_recordatorio_pendiente ON citas (inicio) WHERE recordatorio_enviado = FALSE",
+    ]),
 
-# ---------- FUNCIONES ----------
+    # Resumen semanal de contabilidad por peluquero, mantenido por trigger en
+    # cada INSERT/UPDATE/DELETE de 'contabilidad' (semana = lunes de date_trunc)
+    ("007_contabilidad_resumen", [
+        """
+        CREATE TABLE IF NOT EXISTS contabilidad_resumen (
+            peluquero_id INTEGER NOT NULL,
+            semana_inicio DATE NOT NULL,
+            cortes NUMERIC NOT NULL DEFAULT 0,
+            ventas_otras NUMERIC NOT NULL DEFAULT 0,
+            consumos NUMERIC NOT NULL DEFAULT 0,
+            adelantos NUMERIC NOT NULL DEFAULT 0,
+            movimientos INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (peluquero_id, semana_inicio)
+        )
+        """,
+        """
+        CREATE OR REPLACE FUNCTION contabilidad_resumen_actualizar() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('DELETE', 'UPDATE') AND OLD.peluquero_id IS NOT NULL THEN
+                UPDATE contabilidad_resumen SET
+                    cortes       = cortes       - CASE WHEN OLD.tipo = 'venta' AND OLD.categoria = 'cortes' THEN COALESCE(OLD.valor, 0) ELSE 0 END,
+                    ventas_otras = ventas_otras - CASE WHEN OLD.tipo = 'venta' AND OLD.categoria IS DISTINCT FROM 'cortes' THEN COALESCE(OLD.valor, 0) ELSE 0 END,
+                    consumos     = consumos     - CASE WHEN OLD.tipo = 'consumo' THEN COALESCE(OLD.valor, 0) ELSE 0 END,
+                    adelantos    = adelantos    - CASE WHEN OLD.tipo = 'adelanto' THEN COALESCE(OLD.valor, 0) ELSE 0 END,
+                    movimientos  = movimientos - 1
+                WHERE peluquero_id = OLD.peluquero_id
+                  AND semana_inicio = date_trunc('week', OLD.fecha)::date;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.peluquero_id IS NOT NULL THEN
+                INSERT INTO contabilidad_resumen AS r (peluquero_id, semana_inicio, cortes, ventas_otras, consumos, adelantos, movimientos)
+                VALUES (
+                    NEW.peluquero_id,
+                    date_trunc('week', NEW.fecha)::date,
+                    CASE WHEN NEW.tipo = 'venta' AND NEW.categoria = 'cortes' THEN COALESCE(NEW.valor, 0) ELSE 0 END,
+                    CASE WHEN NEW.tipo = 'venta' AND NEW.categoria IS DISTINCT FROM 'cortes' THEN COALESCE(NEW.valor, 0) ELSE 0 END,
+                    CASE WHEN NEW.tipo = 'consumo' THEN COALESCE(NEW.valor, 0) ELSE 0 END,
+                    CASE WHEN NEW.tipo = 'adelanto' THEN COALESCE(NEW.valor, 0) ELSE 0 END,
+                    1
+                )
+                ON CONFLICT (peluquero_id, semana_inicio) DO UPDATE SET
+                    cortes       = r.cortes       + EXCLUDED.cortes,
+                    ventas_otras = r.ventas_otras + EXCLUDED.ventas_otras,
+                    consumos     = r.consumos     + EXCLUDED.consumos,
+                    adelantos    = r.adelantos    + EXCLUDED.adelantos,
+                    movimientos  = r.movimientos  + 1;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        # Carga inicial (solo si el resumen está vacío) con la tabla bloqueada para
+        # que ningún movimiento quede fuera entre la carga y la creación del trigger
+        "LOCK TABLE contabilidad IN SHARE ROW EXCLUSIVE MODE",
+        """
+        INSERT INTO contabilidad_resumen (peluquero_id, semana_inicio, cortes, ventas_otras, consumos, adelantos, movimientos)
+        SELECT peluquero_id, date_trunc('week', fecha)::date,
+               COALESCE(SUM(valor) FILTER (WHERE tipo = 'venta' AND categoria = 'cortes'), 0),
+               COALESCE(SUM(valor) FILTER (WHERE tipo = 'venta' AND categoria IS DISTINCT FROM 'cortes'), 0),
+               COALESCE(SUM(valor) FILTER (WHERE tipo = 'consumo'), 0),
+               COALESCE(SUM(valor) FILTER (WHERE tipo = 'adelanto'), 0),
+               COUNT(*)
+        FROM contabilidad
+        WHERE peluquero_id IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM contabilidad_resumen)
+        GROUP BY 1, 2
+        """,
+        "DROP TRIGGER IF EXISTS trg_contabilidad_resumen ON contabilidad",
+        """
+        CREATE TRIGGER trg_contabilidad_resumen
+        AFTER INSERT OR UPDATE OR DELETE ON contabilidad
+        FOR EACH ROW EXECUTE FUNCTION contabilidad_resumen_actualizar()
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_contabilidad_peluquero_fecha ON contabilidad (peluquero_id, fecha)",
+    ]),
+
+    # Outbox de WhatsApp (ver notificaciones.py)
+    ("008_outbox_notificaciones", [
+        notificaciones.SQL_CREAR_TABLA,
+        notificaciones.SQL_CREAR_INDICE,
+    ]),
+    # Historial particionado por semana: la tabla plana anterior se renombra a
+    # 'contabilidad_historial_anterior' (queda para borrarla a mano) y sus filas
+    # se copian a la nueva, una partición por semana (lunes a lunes)
+    ("009_historial_particionado", [
+        """
+        DO $$
+        BEGIN
+            IF to_regclass('contabilidad_historial') IS NOT NULL
+               AND (SELECT relkind FROM pg_class WHERE oid = 'contabilidad_historial'::regclass) <> 'p' THEN
+                ALTER TABLE contabilidad_historial RENAME TO contabilidad_historial_anterior;
+            END IF;
+        END $$
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS contabilidad_historial (
+            id BIGSERIAL,
+            peluquero_id INTEGER,
+            nombre_peluquero TEXT,
+            tipo TEXT,
+            categoria TEXT,
+            nombre_item TEXT,
+            valor NUMERIC,
+            semana_inicio DATE NOT NULL,
+            semana_fin DATE,
+            fecha TIMESTAMP,
+            PRIMARY KEY (semana_inicio, id)
+        ) PARTITION BY RANGE (semana_inicio)
+        """,
+        """
+        CREATE OR REPLACE FUNCTION contabilidad_historial_particion(d DATE) RETURNS TEXT AS $$
+        DECLARE
+            lunes DATE := date_trunc('week', d)::date;
+            nombre TEXT := 'contabilidad_historial_' || to_char(date_trunc('week', d), 'YYYYMMDD');
+        BEGIN
+            EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF contabilidad_historial FOR VALUES FROM (%L) TO (%L)',
+                           nombre, lunes, lunes + 7);
+            RETURN nombre;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        DO $$
+        BEGIN
+            IF to_regclass('contabilidad_historial_anterior') IS NOT NULL
+               AND NOT EXISTS (SELECT 1 FROM contabilidad_historial) THEN
+                PERFORM contabilidad_historial_particion(s)
+                FROM (SELECT DISTINCT semana_inicio AS s FROM contabilidad_historial_anterior
+                      WHERE semana_inicio IS NOT NULL) semanas;
+                INSERT INTO contabilidad_historial (peluquero_id, nombre_peluquero, tipo, categoria,
+                                                    nombre_item, valor, semana_inicio, semana_fin)
+                SELECT peluquero_id, nombre_peluquero, tipo, categoria, nombre_item, valor, semana_inicio, semana_fin
+                FROM contabilidad_historial_anterior
+                WHERE semana_inicio IS NOT NULL;
+            END IF;
+        END $$
+        """,
+    ]),
+    # Totales del historial por semana y barbero, recalculados en cada cierre;
+    # la página del historial lee de aquí y no agrupa el historial completo
+    ("010_historial_resumen", [
+        """
+        CREATE TABLE IF NOT EXISTS contabilidad_historial_resumen (
+            semana_inicio DATE NOT NULL,
+            semana_fin DATE NOT NULL,
+            nombre_peluquero TEXT NOT NULL DEFAULT '',
+            total_cortes NUMERIC NOT NULL DEFAULT 0,
+            total_barberia NUMERIC NOT NULL DEFAULT 0,
+            total_consumos NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (semana_inicio, semana_fin, nombre_peluquero)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_historial_resumen_semana_fin ON contabilidad_historial_resumen (semana_fin DESC)",
+        """
+        INSERT INTO contabilidad_historial_resumen (semana_inicio, semana_fin, nombre_peluquero,
+                                                    total_cortes, total_barberia, total_consumos)
+        SELECT semana_inicio, semana_fin, COALESCE(nombre_peluquero, ''),
+               COALESCE(SUM(valor) FILTER (WHERE tipo = 'venta' AND categoria = 'cortes'), 0),
+               COALESCE(SUM(valor) FILTER (WHERE tipo = 'venta' AND categoria = 'barberia'), 0),
+               COALESCE(SUM(valor) FILTER (WHERE tipo = 'consumo'), 0)
+        FROM contabilidad_historial
+        WHERE semana_fin IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM contabilidad_historial_resumen)
+        GROUP BY semana_inicio, semana_fin, COALESCE(nombre_peluquero, '')
+        """,
+    ]),
+    # Marca de cierre por semana: hace el cierre idempotente y reanudable
+    ("011_cierres_semanales", [
+        """
+        CREATE TABLE IF NOT EXISTS cierres_semanales (
+            semana_inicio DATE PRIMARY KEY,
+            semana_fin DATE NOT NULL,
+            movimientos INTEGER NOT NULL DEFAULT 0,
+            iniciado_en TIMESTAMP NOT NULL DEFAULT NOW(),
+            cerrado_en TIMESTAMP
+        )
+        """,
+    ]),
+    # Outbox: estado explícito para las notificaciones descartadas
+    ("012_notificaciones_fallidas", notificaciones.SQL_ESTADO_FALLIDO),
+]
 
-def enviar_notificacion_whatsapp(destinatario, mensaje):
-    client = Client(ACCOUNT_SID, AUTH_TOKEN)
+def migrar_schema():
+    """
+    Aplica las MIGRACIONES pendientes, cada una en su transacción, y anota su
+    nombre en schema_migraciones: en los siguientes arranques solo se lee esa
+    tabla. Un solo proceso a la vez gracias al advisory lock. Si una falla el
+    arranque se corta: la app no debe atender con el esquema a medias.
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT pg_advisory_lock(hashtext('barberia:migraciones'))")
     try:
-        client.messages.create(
-            from_=TWILIO_WHATSAPP,
-            to=f"whatsapp:{destinatario}",  # Ejemplo: whatsapp:+573001234567
-            body=mensaje
-        )
-        print(f"✅ WhatsApp enviado a {destinatario}")
-    except Exception as e:
-        print(f"⚠️ Error enviando WhatsApp: {e}")
-        
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migraciones (
+                nombre TEXT PRIMARY KEY,
+                aplicada_en TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
+        c.execute("SELECT nombre FROM schema_migraciones")
+        aplicadas = {fila[0] for fila in c.fetchall()}
+        conn.commit()
+
+        for nombre, sentencias in MIGRACIONES:
+            if nombre in aplicadas:
+                continue
+            try:
+                for sql in sentencias:
+                    c.execute(sql)
+                c.execute("INSERT INTO schema_migraciones (nombre) VALUES (%s)", (nombre,))
+                conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+                log.exception("❌ Falló la migración %s; se corta el arranque", nombre)
+                raise
+            log.info("🗄️ Migración aplicada: %s", nombre)
+    finally:
+        c.execute("SELECT pg_advisory_unlock(hashtext('barberia:migraciones'))")
+        conn.commit()
+        conn.close()
+
+# Consultas calientes cuyo plan debe usar índices (ver 'flask revisar-indices')
+CONSULTAS_CALIENTES = {
+    "citas de la semana": (
+        "SELECT id, dia, hora FROM citas WHERE peluquero_id = 1 AND fecha BETWEEN '2024-01-01' AND '2024-01-07'"
+    ),
+    "horarios de la semana": (
+        "SELECT dia, hora FROM horarios WHERE peluquero_id = 1 AND (fecha IS NULL OR fecha BETWEEN '2024-01-01' AND '2024-01-07')"
+    ),
+    "horario puntual": (
+        "SELECT 1 FROM horarios WHERE peluquero_id = 1 AND dia = 'lunes' AND hora = '10:00 AM'"
+    ),
+    "cita puntual": (
+        "SELECT 1 FROM citas WHERE peluquero_id = 1 AND dia = 'lunes' AND hora = '10:00 AM'"
+    ),
+}
+
+@app.cli.command("revisar-indices")
+def revisar_indices():
+    """Muestra si las consultas calientes pueden resolverse con un índice."""
+    conn = get_conn()
+    c = conn.cursor()
+    # Con tablas pequeñas el planner prefiere Seq Scan; lo desactivamos para
+    # comprobar que existe un índice utilizable, no cuál es el plan más barato hoy.
+    c.execute("SET LOCAL enable_seqscan = off")
+    for nombre, sql in CONSULTAS_CALIENTES.items():
+        c.execute("EXPLAIN " + sql)
+        plan = "\n".join(fila[0] for fila in c.fetchall())
+        usa_indice = "Index" in plan and "Seq Scan" not in plan
+        click.echo(f"{'✅' if usa_indice else '❌'} {nombre}")
+        if not usa_indice:
+            click.echo(plan)
+    conn.rollback()
+    conn.close()
+
+# ---------- FUNCIONES ----------
+
+def avisar_cambio(peluquero_id, semana=None):
+    """
+    Después del commit de un cambio de horarios o citas: invalida la caché
+    del peluquero y avisa a los clientes con su calendario abierto (SSE).
+    'semana' es el lunes afectado, o None si pueden ser varias semanas.
+    """
+    invalidar_peluquero(peluquero_id)
+    eventos.publicar(get_conn, peluquero_id, semana.isoformat() if semana else None)
+
+def enviar_notificacion_whatsapp(destinatario, mensaje, c=None):
+    """
+    Encola un WhatsApp en el outbox; el hilo despachador lo envía con
+    reintentos. Si se pasa un cursor, la notificación queda en la misma
+    transacción que quien llama (y se confirma con su commit).
+    """
+    if c is not None:
+        notificaciones.encolar(c, destinatario, mensaje)
+        return
+
+    conn = get_conn()
+    c = conn.cursor()
+    notificaciones.encolar(c, destinatario, mensaje)
+    conn.commit()
+    conn.close()
+    notificaciones.avisar()
+
+# Grilla base de horarios para cada peluquero (configurable por entorno)
+HORARIO_INICIO = os.getenv("HORARIO_INICIO", "10:00")
+HORARIO_FIN = os.getenv("HORARIO_FIN", "21:00")
+HORARIO_INTERVALO = int(os.getenv("HORARIO_INTERVALO", "40"))  # minutos
+
+def horas_grilla(inicio=HORARIO_INICIO, fin=HORARIO_FIN, intervalo=HORARIO_INTERVALO):
+    """Horas '%I:%M %p' desde inicio hasta fin (inclusive) cada 'intervalo' minutos."""
+    if intervalo <= 0:
+        raise ValueError(f"intervalo debe ser positivo: {intervalo}")
+    actual = datetime.strptime(inicio, "%H:%M")
+    limite = datetime.strptime(fin, "%H:%M")
+    horas = []
+    while actual <= limite:
+        horas.append(actual.strftime("%I:%M %p"))
+        actual += timedelta(minutes=intervalo)
+    return horas
+
+def crear_horarios_base(c, peluquero_ids, inicio=HORARIO_INICIO, fin=HORARIO_FIN,
+                        intervalo=HORARIO_INTERVALO, dias=DIAS_SEMANA):
+    """
+    Inserta la grilla base de uno o varios peluqueros en un solo INSERT
+    multi-fila. Los horarios que ya existen se respetan: el índice único
+    uq_horarios_base (peluquero, día, hora de la grilla base) descarta los repetidos.
+    Devuelve cuántos horarios se crearon; el commit queda a cargo de quien llama.
+    """
+    horas = horas_grilla(inicio, fin, intervalo)
+    filas = [(pid, d, h) for pid in peluquero_ids if pid for d in dias for h in horas]
+    if not filas:
+        return 0
+    # Postgres: una sola sentencia, un solo viaje; SQLite: la misma preparada por fila
+    db.insertar_varios(
+        c,
+        "INSERT INTO horarios (peluquero_id, dia, hora) VALUES %s"
+        " ON CONFLICT (peluquero_id, dia, hora) WHERE fecha IS NULL DO NOTHING",
+        filas
+    )
+    return c.rowcount
+
 def cargar_horarios_40_minutos(peluquero_id):
     if not peluquero_id:
         return
@@ -125,32 +621,61 @@ def cargar_horarios_40_minutos(peluquero_id):
     conn = get_conn()
     c = conn.cursor()
     try:
-        
-        dias = ["lunes", "martes", "miercoles", "jueves", "viernes", "sabado", "domingo"]
-        hora_actual = datetime.strptime("10:00", "%H:%M")
-        fin = datetime.strptime("21:00", "%H:%M")
-
-        for dia in dias:
-            actual = hora_actual
-            while actual <= fin:
-                hora = actual.strftime("%I:%M %p")
-                c.execute(adapt_query(
-                    "SELECT 1 FROM horarios WHERE peluquero_id=%s AND dia=%s AND hora=%s"
-                ), (peluquero_id, dia, hora))
-                existe = c.fetchone()
-                if not existe:
-                    c.execute(adapt_query(
-                        "INSERT INTO horarios (peluquero_id, dia, hora) VALUES (%s, %s, %s)"
-                    ), (peluquero_id, dia, hora))
-                actual += timedelta(minutes=40)
-
+        crear_horarios_base(c, [peluquero_id])
         conn.commit()
-    except Exception as e:
+    except Exception:
         conn.rollback()
-        print(f"❌ Error al cargar horarios para peluquero_id {peluquero_id}: {e}")
+        log.exception("❌ Error al cargar horarios para peluquero_id %s", peluquero_id)
     finally:
         conn.close()
 
+def armar_calendario_semana(peluquero_id, semana_offset):
+    """
+    Arma la grilla semanal de un peluquero en un solo viaje a la base:
+    nombre, horas existentes (ya ordenadas por hora_t), disponibles,
+    bloqueados y ocupados.
+    La usan los tres calendarios (cliente, admin y peluquero).
+    """
+    inicio_semana = inicio_semana_con_offset(semana_offset)
+    fin_semana = inicio_semana + timedelta(days=6)
+
+    conn = get_conn()
+    c = conn.cursor()
+    filas = repositorio.filas_semana(c, peluquero_id, inicio_semana, fin_semana)
+
+    nombre = None
+    horas = []
+    disponibles = set()
+    bloqueados = set()
+    ocupados = {}
+    for f in filas:
+        if f.tipo == 'ocupado':
+            ocupados[(f.dia, f.hora)] = {"id": f.cita_id, "nombre": f.nombre, "telefono": f.telefono, "fijo": f.fijo}
+        elif f.tipo == 'disponible':
+            disponibles.add((f.dia, f.hora))
+        elif f.tipo == 'bloqueado':
+            bloqueados.add((f.dia, f.hora))
+        elif f.tipo == 'hora':
+            horas.append(f.hora)
+        else:
+            nombre = f.hora
+    c.close()
+
+    return {
+        "nombre": nombre,
+        "inicio_semana": inicio_semana,
+        "fin_semana": fin_semana,
+        "dias": DIAS_SEMANA,
+        "dias_con_fechas": {
+            d: (inicio_semana + timedelta(days=i)).strftime("%d %b %Y")
+            for i, d in enumerate(DIAS_SEMANA)
+        },
+        "horas": horas,
+        "disponibles": disponibles,
+        "bloqueados": bloqueados,
+        "ocupados": ocupados,
+    }
+
 def init_db_legacy():
     conn = get_conn()
     c = conn.cursor()
@@ -182,9 +707,41 @@ def init_db_legacy():
     conn.close()
 
 with app.app_context():
-    init_schema()
+    if db.USE_POSTGRES:
+        init_schema()
+        migrar_schema()
+    else:
+        db.crear_esquema_sqlite()
     init_db_legacy()
 # ---------- RUTAS ----------
+@app.cli.command("procesar-fotos")
+def procesar_fotos_cli():
+    """Genera miniaturas y WebP para las fotos subidas antes del procesamiento y actualiza la base."""
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT id, nombre, foto FROM peluqueros WHERE foto IS NOT NULL AND foto <> ''")
+    procesadas = 0
+    for pid, nombre, foto in c.fetchall():
+        if imagenes.srcset(foto):
+            continue  # ya procesada
+        ruta = foto.lstrip("/") if foto.lstrip("/").startswith("static/") else os.path.join(UPLOAD_FOLDER, foto)
+        if not os.path.isfile(ruta):
+            click.echo(f"⚠️ {nombre}: no se encontró {ruta}")
+            continue
+        try:
+            with open(ruta, "rb") as f:
+                nueva = imagenes.procesar_foto(f.read(), UPLOAD_FOLDER, URL_FOTOS)
+        except imagenes.FotoInvalida as e:
+            click.echo(f"⚠️ {nombre}: {ruta} no es una imagen válida ({e})")
+            continue
+        c.execute("UPDATE peluqueros SET foto = %s WHERE id = %s", (nueva, pid))
+        click.echo(f"🖼️ {nombre}: {foto} → {nueva}")
+        procesadas += 1
+    conn.commit()
+    conn.close()
+    invalidar_lista_peluqueros()
+    click.echo(f"✅ {procesadas} fotos procesadas")
+
 @app.route("/debug_peluqueros")
 def debug_peluqueros():
     conn = get_conn()
@@ -194,13 +751,17 @@ def debug_peluqueros():
     conn.close()
     return {"peluqueros": data}
 
-@app.route("/")
-def index():
+def listar_peluqueros_publicos():
     conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT id, nombre, foto FROM peluqueros WHERE es_admin=0 ORDER BY nombre ASC")
-    peluqueros = c.fetchall()
+    peluqueros = repositorio.peluqueros_publicos(c)
     conn.close()
+    return peluqueros
+
+@app.route("/")
+def index():
+    # 🧠 Se sirve desde caché; se invalida al crear/editar/eliminar peluqueros
+    peluqueros = leer_o_calcular("peluqueros_publicos", listar_peluqueros_publicos)
     return render_template("index.html", peluqueros=peluqueros)
 
 # ==============================
@@ -214,86 +775,59 @@ def agendar():
     nombre = request.form.get("nombre")
     telefono = request.form.get("telefono")
 
+    if not (peluquero_id and dia and hora and nombre and telefono) or dia not in DIAS_SEMANA:
+        return {"success": False, "message": "Faltan datos para agendar la cita"}, 400
+
     # ⬇️ semana_offset viene del frontend (0 o 1)
-    semana_offset = int(request.form.get("semana_offset", 0))
-    
+    try:
+        peluquero_id = int(peluquero_id)
+        semana_offset = int(request.form.get("semana_offset", 0))
+    except ValueError:
+        return {"success": False, "message": "Datos inválidos para agendar la cita"}, 400
+
+    # Solo se agenda con peluqueros de la lista pública (en caché, sin ir a la base)
+    peluqueros = leer_o_calcular("peluqueros_publicos", listar_peluqueros_publicos)
+    if not any(p.id == peluquero_id for p in peluqueros):
+        return {"success": False, "message": "El peluquero no existe"}, 404
+
     # 🔹 Calcular fecha real
     fecha_cita = fecha_desde_dia(dia, semana_offset)
 
     conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT nombre FROM peluqueros WHERE id = %s", (peluquero_id,))
-    row = c.fetchone()
-    nombre_peluquero = row[0] if row else "desconocido"
-
-    if not (peluquero_id and dia and hora and nombre and telefono):
-        return "Faltan datos para agendar la cita", 400
 
-    conn = get_conn()
-    c = conn.cursor()
+    # Guardar la cita en una sola operación atómica: si otro cliente tomó el
+    # horario, el índice único hace que no se inserte nada y no vuelve fila
+    reserva = repositorio.reservar_cita(c, peluquero_id, dia, hora, fecha_cita, nombre, telefono)
 
-    # Verificar que sigue disponible
-    c.execute("""
-        SELECT COUNT(*)
-        FROM citas
-        WHERE peluquero_id=%s AND fecha=%s AND hora=%s
-    """, (peluquero_id, fecha_cita, hora))
-    if c.fetchone()[0] > 0:
+    if reserva is None:
+        conn.rollback()
         conn.close()
-        return "Lo sentimos, ese horario ya fue tomado", 400
+        return {"success": False, "message": "Lo sentimos, ese horario ya fue tomado"}, 409
 
-    # Guardar la cita
-    c.execute(
-        """
-        INSERT INTO citas (peluquero_id, dia, hora, fecha, nombre, telefono)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        """,
-        (peluquero_id, dia, hora, fecha_cita, nombre, telefono)
-    )
-    conn.commit()
-    conn.close()
+    nombre_peluquero = reserva.nombre_peluquero or "desconocido"
+    telefono_barbero = reserva.telefono_peluquero
 
-     # ==============================
-    # ✅ Enviar notificación WhatsApp
     # ==============================
-    try:
-        account_sid = os.getenv("TWILIO_ACCOUNT_SID")
-        auth_token = os.getenv("TWILIO_AUTH_TOKEN")
-        from_whatsapp = os.getenv("TWILIO_WHATSAPP_NUMBER")
-
-        client = Client(account_sid, auth_token)
-
-        # 🔹 Obtener el número del barbero
-        conn_p = get_conn()
-        c_p = conn_p.cursor()
-        c_p.execute("SELECT telefono FROM peluqueros WHERE id=%s", (peluquero_id,))
-        result = c_p.fetchone()
-        conn_p.close()
-
-        if result and result[0]:
-            telefono_barbero = result[0]
-            to_number = f"whatsapp:{telefono_barbero}"
-
-            mensaje = (
-                f"💈 *Nueva cita agendada*\n\n"
-                f"👤 Cliente: {nombre}\n"
-                f"🗓 Día: {dia}\n"
-                f"🕒 Hora: {hora}\n\n"
-                f"Por favor revisa tu calendario desde el panel de administración."
-            )
-
-            msg = client.messages.create(
-                from_=from_whatsapp,
-                to=to_number,
-                body=mensaje
-            )
-            print(f"✅ WhatsApp enviado con SID: {msg.sid}")
-
-        else:
-            print(f"⚠️ Peluquero {peluquero_id} sin número registrado.")
+    # ✅ Notificación WhatsApp al barbero: se encola en la misma transacción
+    #    que la cita y el despachador la envía sin bloquear esta respuesta
+    # ==============================
+    if telefono_barbero:
+        mensaje = (
+            f"💈 *Nueva cita agendada*\n\n"
+            f"👤 Cliente: {nombre}\n"
+            f"🗓 Día: {dia}\n"
+            f"🕒 Hora: {hora}\n\n"
+            f"Por favor revisa tu calendario desde el panel de administración."
+        )
+        enviar_notificacion_whatsapp(telefono_barbero, mensaje, c)
+    else:
+        log.warning("⚠️ Peluquero %s sin número registrado.", peluquero_id)
 
-    except Exception as e:
-        print(f"❌ Error enviando WhatsApp: {e}")
+    conn.commit()
+    conn.close()
+    notificaciones.avisar()
+    avisar_cambio(peluquero_id, fecha_cita - timedelta(days=fecha_cita.weekday()))
 
     return {"success": True,
             "message": (
@@ -365,107 +899,134 @@ def logout():
     session.clear()
     return redirect(url_for("login"))
 
-@app.route('/cliente/<int:peluquero_id>/calendario')
-def calendario_cliente(peluquero_id):
-    conn = get_conn()
-    c = conn.cursor()
-
-    # Nombre del peluquero
-    c.execute("SELECT nombre FROM peluqueros WHERE id=%s", (peluquero_id,))
-    row = c.fetchone()
-    nombre_peluquero = row[0] if row else "Desconocido"
-
-    semana_offset = int(request.args.get("semana_offset", 0))
-    
+def calendario_publico(peluquero_id, semana_offset):
+    """Calendario de la semana leído a través de la caché (clave con la versión del peluquero)."""
+    # 🧠 Clave por peluquero, semana real y versión: cualquier cambio de
+    # horarios o citas del peluquero sube la versión y deja atrás esta entrada
     inicio_semana = inicio_semana_con_offset(semana_offset)
-    fin_semana = inicio_semana + timedelta(days=6)
-
-
-    dias = ['lunes', 'martes', 'miercoles', 'jueves', 'viernes', 'sabado', 'domingo']
-
-
-    dias_con_fechas = {
-        d: (inicio_semana + timedelta(days=i)).strftime("%d %b %Y")  # "27", "28", etc.
-        for i, d in enumerate(dias)
-    }
+    clave = f"calendario:{peluquero_id}:{inicio_semana.isoformat()}:{version_peluquero(peluquero_id)}"
+    return leer_o_calcular(clave, lambda: armar_calendario_semana(peluquero_id, semana_offset))
 
-    # Horas realmente existentes
-    c.execute("""
-        SELECT DISTINCT hora FROM horarios WHERE peluquero_id=%s
-        UNION
-        SELECT DISTINCT hora FROM citas    WHERE peluquero_id=%s
-    """, (peluquero_id, peluquero_id))
-    horas = sorted(
-        {row[0] for row in c.fetchall()},
-        key=lambda h: datetime.strptime(h, "%I:%M %p")
-    )
-
-    # Solo horarios NO bloqueados
-    c.execute("""
-        SELECT dia, hora
-        FROM horarios
-        WHERE peluquero_id = %s
-          AND bloqueado = FALSE
-          AND (
-                fecha IS NULL
-                OR fecha BETWEEN %s AND %s
-              )
-    """, (peluquero_id, inicio_semana, fin_semana))
-    
-    disponibles = {(d, h) for d, h in c.fetchall()}
-
-    # Horarios bloqueados
-    fecha_inicio = inicio_semana
-    fecha_fin = fecha_inicio + timedelta(days=6)
-    
-    c.execute("""
-        SELECT dia, hora
-        FROM horarios
-        WHERE peluquero_id = %s
-          AND bloqueado = TRUE
-          AND (
-                fecha = '2000-01-01'
-                OR fecha BETWEEN %s AND %s
-              )
-    """, (peluquero_id, inicio_semana, fin_semana))
-    
-    bloqueados = {(d, h) for d, h in c.fetchall()}
-
-    # Ocupados
-    c.execute("""
-        SELECT id, dia, hora, nombre, telefono
-        FROM citas
-        WHERE peluquero_id = %s
-          AND fecha BETWEEN %s AND %s
-    """, (peluquero_id, fecha_inicio, fecha_fin))
-    
-    ocupados = {
-        (d, h): {
-            "id": cita_id,
-            "nombre": n,
-            "telefono": t
-        }
-        for cita_id, d, h, n, t in c.fetchall()
-    }
+def grilla_renderizada(plantilla, peluquero_id, semana_offset, cal, **contexto):
+    """
+    HTML de la grilla de la semana guardado ya renderizado, con la versión del
+    peluquero en la clave: mientras no cambien sus horarios o citas la
+    plantilla no se vuelve a evaluar celda por celda.
+    """
+    variante = ":".join(f"{k}={v}" for k, v in sorted(contexto.items()))
+    clave = (f"fragmento:{plantilla}:{peluquero_id}:{cal['inicio_semana'].isoformat()}:"
+             f"{semana_offset}:{version_peluquero(peluquero_id)}:{variante}")
+    html = leer_o_calcular(clave, lambda: render_template(
+        plantilla, peluquero_id=peluquero_id, semana_offset=semana_offset, **cal, **contexto))
+    return Markup(html)
+
+def grilla_calendario(peluquero_id, semana_offset, cal, es_admin):
+    """
+    Grilla de calendario.html. Los datos se leen siempre de la base (el
+    barbero y el admin deben ver su último cambio); el HTML se reutiliza solo
+    con una caché compartida, porque con la caché local otro worker no se
+    entera de la nueva versión.
+    """
+    if cache.compartida:
+        return grilla_renderizada("_grilla_calendario.html", peluquero_id, semana_offset, cal,
+                                  es_admin=bool(es_admin))
+    return Markup(render_template("_grilla_calendario.html", peluquero_id=peluquero_id,
+                                  semana_offset=semana_offset, es_admin=es_admin, **cal))
 
-    conn.close()
+@app.route('/cliente/<int:peluquero_id>/calendario')
+def calendario_cliente(peluquero_id):
+    semana_offset = int(request.args.get("semana_offset", 0))
+    cal = calendario_publico(peluquero_id, semana_offset)
 
     return render_template(
         "cliente_calendario.html",
+        grilla=grilla_renderizada("_grilla_cliente.html", peluquero_id, semana_offset, cal),
         semana=semana_offset,
-        inicio_semana=inicio_semana,
-        fin_semana=fin_semana,
+        inicio_semana=cal["inicio_semana"],
+        fin_semana=cal["fin_semana"],
         peluquero_id=peluquero_id,
-        nombre_peluquero=nombre_peluquero,
-        dias=dias,
-        dias_con_fechas=dias_con_fechas,
-        horas=horas,
-        disponibles=disponibles,
-        ocupados=ocupados,
-        bloqueados=bloqueados,
+        nombre_peluquero=cal["nombre"] or "Desconocido",
+        dias=cal["dias"],
+        dias_con_fechas=cal["dias_con_fechas"],
+        horas=cal["horas"],
+        disponibles=cal["disponibles"],
+        ocupados=cal["ocupados"],
+        bloqueados=cal["bloqueados"],
         semana_offset=semana_offset
     )
 
+DISPONIBILIDAD_MAX_AGE = int(os.getenv("DISPONIBILIDAD_MAX_AGE", "0"))  # segundos antes de revalidar
+
+def disponibilidad_json(peluquero_id, semana_offset):
+    """
+    Cuerpo JSON de la grilla pública y su ETag, guardados juntos en caché por
+    versión: el JSON y el hash se calculan una vez por cambio del peluquero.
+    El ETag sale del contenido para que coincida entre workers aunque cada
+    uno tenga su propia caché local.
+    """
+    inicio_semana = inicio_semana_con_offset(semana_offset)
+    clave = f"disponibilidad:{peluquero_id}:{inicio_semana.isoformat()}:{version_peluquero(peluquero_id)}"
+
+    def calcular():
+        cal = calendario_publico(peluquero_id, semana_offset)
+        if cal["nombre"] is None:
+            return None, None
+        # Solo el estado de cada horario: los datos del cliente no salen de aquí
+        estados = {dia: {} for dia in cal["dias"]}
+        for dia, hora in cal["disponibles"]:
+            estados[dia][hora] = "disponible"
+        for dia, hora in cal["bloqueados"]:
+            estados[dia][hora] = "bloqueado"
+        for dia, hora in cal["ocupados"]:
+            estados[dia][hora] = "ocupado"
+        cuerpo = json.dumps({
+            "peluquero_id": peluquero_id,
+            "nombre": cal["nombre"],
+            "semana_offset": semana_offset,
+            "inicio_semana": cal["inicio_semana"].isoformat(),
+            "fin_semana": cal["fin_semana"].isoformat(),
+            "dias": [{"dia": dia, "fecha": cal["dias_con_fechas"][dia]} for dia in cal["dias"]],
+            "horas": cal["horas"],
+            "estados": estados,
+        }, ensure_ascii=False, sort_keys=True)
+        return cuerpo, hashlib.sha1(cuerpo.encode("utf-8")).hexdigest()
+
+    return leer_o_calcular(clave, calcular)
+
+@app.route("/api/peluqueros/<int:peluquero_id>/disponibilidad")
+def api_disponibilidad(peluquero_id):
+    semana_offset = request.args.get("semana_offset", 0, type=int)
+    cuerpo, etag = disponibilidad_json(peluquero_id, semana_offset)
+    if cuerpo is None:
+        return {"error": "Peluquero no encontrado"}, 404
+
+    resp = Response(cuerpo, mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = f"public, max-age={DISPONIBILIDAD_MAX_AGE}, must-revalidate"
+    # Responde 304 sin cuerpo si el navegador o la CDN ya tienen esta versión
+    return resp.make_conditional(request)
+
+@app.route("/api/peluqueros/<int:peluquero_id>/eventos")
+def api_eventos(peluquero_id):
+    """
+    Server-sent events con los cambios de horarios del peluquero en la semana
+    pedida. No usa la base de datos mientras está abierto; el navegador
+    reconecta solo cada EVENTOS_DURACION segundos. Cada flujo ocupa un hilo
+    del worker; el cupo por proceso se calcula en eventos.py.
+    """
+    semana_offset = request.args.get("semana_offset", 0, type=int)
+    semana = inicio_semana_con_offset(semana_offset).isoformat()
+    cola = eventos.suscribir(peluquero_id, semana)
+    if cola is None:
+        # Sin hilos libres para otro flujo: el navegador pasa a sondear la API
+        return "Demasiadas conexiones, intenta más tarde", 503, {"Retry-After": "60"}
+
+    return Response(
+        eventos.flujo_sse(peluquero_id, semana, cola),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.route("/admin")
 def admin_panel():
     if "peluquero_id" not in session or not session.get("es_admin"):
@@ -537,6 +1098,7 @@ def admin_peluqueros():
             c.execute(adapt_query("DELETE FROM peluqueros WHERE id=%s"), (peluquero_id,))
 
         conn.commit()
+        invalidar_todos()
 
     # 📋 Listado de peluqueros
     c.execute("SELECT id, nombre, es_admin, foto FROM peluqueros")
@@ -561,9 +1123,13 @@ def agregar_peluquero():
     if 'foto' in request.files:
         file = request.files['foto']
         if file and file.filename != "":
-            filename = secure_filename(file.filename)
-            file.save(os.path.join("static/img_peluqueros", filename))
-            foto = f"/static/img_peluqueros/{filename}"
+            # 🖼️ Miniaturas JPEG/WebP con nombre por hash del contenido
+            try:
+                foto = imagenes.procesar_subida(file, UPLOAD_FOLDER, URL_FOTOS)
+            except imagenes.FotoInvalida as e:
+                log.warning("⚠️ Foto rechazada al agregar peluquero: %s", e)
+                flash("La foto debe ser una imagen JPG, PNG, GIF o WebP válida.", "error")
+                return redirect(url_for("admin_peluqueros"))
 
     conn = get_conn()
     c = conn.cursor()
@@ -576,22 +1142,12 @@ def agregar_peluquero():
     """, (nombre, usuario, password, es_admin, foto, telefono))
     nuevo_id = c.fetchone()[0]
 
-    # ➤ Solo si NO es admin: crear horarios base 10:00–21:00 cada 40 min
+    # ➤ Solo si NO es admin: crear horarios base (10:00–21:00 cada 40 min por defecto)
     if not es_admin:
-        dias = ['lunes','martes','miercoles','jueves','viernes','sabado','domingo']
-        hora_actual = datetime.strptime("10:00", "%H:%M")
-        fin = datetime.strptime("21:00", "%H:%M")
-
-        while hora_actual <= fin:
-            hora_str = hora_actual.strftime("%I:%M %p")
-            for d in dias:
-                c.execute(
-                    "INSERT INTO horarios (peluquero_id, dia, hora) VALUES (%s, %s, %s)",
-                    (nuevo_id, d, hora_str)
-                )
-            hora_actual += timedelta(minutes=40)
+        crear_horarios_base(c, [nuevo_id])
 
     conn.commit()
+    invalidar_lista_peluqueros()
     conn.close()
 
     return redirect(url_for('admin_peluqueros'))
@@ -612,18 +1168,21 @@ def editar_peluquero(id):
     c = conn.cursor()
 
     # ✅ 1. Obtener la foto actual de la base
-    c.execute("SELECT foto, telefono FROM peluqueros WHERE id=%s", (id,))
-    foto_actual, telefono_actual = c.fetchone()
+    contacto = repositorio.contacto_peluquero(c, id)
+    foto_actual, telefono_actual = contacto.foto, contacto.telefono
 
     # ✅ 2. Solo reemplazar si se subió una nueva
     foto_path = foto_actual
     if 'foto' in request.files:
         file = request.files['foto']
         if file and file.filename != "":
-            from werkzeug.utils import secure_filename
-            filename = secure_filename(file.filename)
-            file.save(os.path.join("static/img_peluqueros", filename))
-            foto_path = f"/static/img_peluqueros/{filename}"
+            try:
+                foto_path = imagenes.procesar_subida(file, UPLOAD_FOLDER, URL_FOTOS)
+            except imagenes.FotoInvalida as e:
+                conn.close()
+                log.warning("⚠️ Foto rechazada al editar peluquero %s: %s", id, e)
+                flash("La foto debe ser una imagen JPG, PNG, GIF o WebP válida.", "error")
+                return redirect(url_for("admin_peluqueros"))
 
     # Si el formulario no envía teléfono, usar el existente
     telefono_nuevo = request.form.get("telefono")
@@ -645,6 +1204,8 @@ def editar_peluquero(id):
         """, (nombre, usuario, es_admin, foto_path, telefono_nuevo, id))
 
     conn.commit()
+    invalidar_lista_peluqueros()
+    invalidar_peluquero(id)
     conn.close()
     return redirect(url_for('admin_peluqueros'))
 
@@ -659,6 +1220,8 @@ def eliminar_peluquero(id):
     c = conn.cursor()
     c.execute("DELETE FROM peluqueros WHERE id=%s", (id,))
     conn.commit()
+    invalidar_lista_peluqueros()
+    invalidar_peluquero(id)
     conn.close()
 
     return redirect(url_for('admin_peluqueros'))
@@ -675,19 +1238,14 @@ def ver_calendario_admin(peluquero_id):
     c = conn.cursor()
 
     semana_offset = int(request.args.get("semana_offset", 0))
-    
-    inicio_semana = inicio_semana_con_offset(semana_offset)
-    fin_semana = inicio_semana + timedelta(days=6)
-
-    
 
     # ✅ Cancelar cita (solo admin)
     cancelar_dia = request.args.get('cancelar_dia')
     cancelar_hora = request.args.get('cancelar_hora')
     if cancelar_dia and cancelar_hora:
-        c.execute("DELETE FROM citas WHERE peluquero_id=%s AND dia=%s AND hora=%s",
-                  (peluquero_id, cancelar_dia, cancelar_hora))
+        repositorio.cancelar_cita(c, peluquero_id, cancelar_dia, cancelar_hora)
         conn.commit()
+        avisar_cambio(peluquero_id)
 
        # ✅ Bloquear horario (marcar como bloqueado)
     bloquear_dia = request.args.get('bloquear_dia')
@@ -696,14 +1254,10 @@ def ver_calendario_admin(peluquero_id):
     
     if bloquear_dia and bloquear_hora:
         fecha = fecha_desde_dia(bloquear_dia, semana_offset)
-        c.execute("""
-            INSERT INTO horarios (peluquero_id, dia, hora, fecha, bloqueado)
-            VALUES (%s, %s, %s, %s, TRUE)
-            ON CONFLICT (peluquero_id, dia, hora, fecha)
-            DO UPDATE SET bloqueado = TRUE
-        """, (peluquero_id, bloquear_dia, bloquear_hora, fecha))
+        repositorio.bloquear_horario(c, peluquero_id, bloquear_dia, bloquear_hora, fecha)
         conn.commit()
-        print("DEBUG:", bloquear_dia, bloquear_hora, "fecha:", fecha,"bloquear")
+        avisar_cambio(peluquero_id)
+        log.debug("Horario bloqueado", extra={"datos": {"peluquero_id": peluquero_id, "dia": bloquear_dia, "hora": bloquear_hora, "fecha": fecha}})
         return redirect(url_for(
             'ver_calendario_admin',
             peluquero_id=peluquero_id,
@@ -716,113 +1270,34 @@ def ver_calendario_admin(peluquero_id):
     
     if activar_dia and activar_hora:
         fecha = fecha_desde_dia(activar_dia, semana_offset)
-        c.execute("""
-            UPDATE horarios
-            SET bloqueado = FALSE
-            WHERE peluquero_id=%s
-              AND dia=%s
-              AND hora=%s
-              AND fecha=%s
-        """, (peluquero_id, activar_dia, activar_hora, fecha))
+        repositorio.reactivar_horario(c, peluquero_id, activar_dia, activar_hora, fecha)
         conn.commit()
-        print("DEBUG:", activar_dia, activar_hora, "fecha:", fecha, "activar")
+        avisar_cambio(peluquero_id)
+        log.debug("Horario reactivado", extra={"datos": {"peluquero_id": peluquero_id, "dia": activar_dia, "hora": activar_hora, "fecha": fecha}})
         return redirect(url_for(
             'ver_calendario_admin',
             peluquero_id=peluquero_id,
             semana_offset=semana_offset
         ))
     
-    # Datos del peluquero
-    c.execute("SELECT nombre FROM peluqueros WHERE id=%s", (peluquero_id,))
-    peluquero = c.fetchone()
-    if not peluquero:
-        conn.close()
+    # Datos del peluquero y grilla de la semana
+    cal = armar_calendario_semana(peluquero_id, semana_offset)
+    if cal["nombre"] is None:
         return "Peluquero no encontrado"
-    nombre = peluquero[0]
-
-    
-
-    dias = ['lunes', 'martes', 'miercoles', 'jueves', 'viernes', 'sabado', 'domingo']
-
-    dias_con_fechas = {
-        d: (inicio_semana + timedelta(days=i)).strftime("%d %b %Y")  # "27", "28", etc.
-        for i, d in enumerate(dias)
-    }
-
-    # 🔹 Obtener solo las horas que realmente existan en la DB (horarios o citas)
-    c.execute("""
-        SELECT DISTINCT hora FROM horarios WHERE peluquero_id=%s
-        UNION
-        SELECT DISTINCT hora FROM citas    WHERE peluquero_id=%s
-    """, (peluquero_id, peluquero_id))
-    horas = sorted(
-        {row[0] for row in c.fetchall()},
-        key=lambda h: datetime.strptime(h, "%I:%M %p")
-    )
-
-    # Solo horarios NO bloqueados
-    c.execute("""
-        SELECT dia, hora
-        FROM horarios
-        WHERE peluquero_id = %s
-          AND bloqueado = FALSE
-          AND (
-                fecha IS NULL
-                OR fecha BETWEEN %s AND %s
-              )
-    """, (peluquero_id, inicio_semana, fin_semana))
-    
-    disponibles = {(d, h) for d, h in c.fetchall()}
-
-    # Horarios bloqueados
-    fecha_inicio = inicio_semana
-    fecha_fin = fecha_inicio + timedelta(days=6)
-    
-    c.execute("""
-        SELECT dia, hora
-        FROM horarios
-        WHERE peluquero_id = %s
-          AND bloqueado = TRUE
-          AND (
-                fecha = '2000-01-01'
-                OR fecha BETWEEN %s AND %s
-              )
-    """, (peluquero_id, inicio_semana, fin_semana))
-    
-    bloqueados = {(d, h) for d, h in c.fetchall()}
-
-    # Ocupados
-    c.execute("""
-        SELECT id, dia, hora, nombre, telefono
-        FROM citas
-        WHERE peluquero_id = %s
-          AND fecha BETWEEN %s AND %s
-    """, (peluquero_id, fecha_inicio, fecha_fin))
-    
-    ocupados = {
-        (d, h): {
-            "id": cita_id,
-            "nombre": n,
-            "telefono": t
-        }
-        for cita_id, d, h, n, t in c.fetchall()
-    }
-
-    conn.close()
-
 
     return render_template(
         "calendario.html",
-        inicio_semana=inicio_semana,
-        fin_semana=fin_semana,
-        nombre=nombre,
+        grilla=grilla_calendario(peluquero_id, semana_offset, cal, True),
+        inicio_semana=cal["inicio_semana"],
+        fin_semana=cal["fin_semana"],
+        nombre=cal["nombre"],
         peluquero_id=peluquero_id,
-        dias_con_fechas=dias_con_fechas,
-        dias=dias,
-        horas=horas,
-        disponibles=disponibles,
-        ocupados=ocupados,
-        bloqueados=bloqueados,
+        dias_con_fechas=cal["dias_con_fechas"],
+        dias=cal["dias"],
+        horas=cal["horas"],
+        disponibles=cal["disponibles"],
+        ocupados=cal["ocupados"],
+        bloqueados=cal["bloqueados"],
         semana_offset=semana_offset,
         es_admin=True
     )
@@ -833,27 +1308,24 @@ def bloquear_dia_completo(peluquero_id):
         return redirect(url_for('login'))
 
     dia = request.form.get("dia")
-    if not dia:
+    if dia not in DIAS_SEMANA:
         return "Día no especificado", 400
+    semana_offset = request.form.get("semana_offset", 0, type=int)
+    fecha = fecha_desde_dia(dia, semana_offset)
 
     conn = get_conn()
     c = conn.cursor()
-    fecha_inicio = inicio_semana.date()
-    fecha_fin = fecha_inicio + timedelta(days=6)
-    
 
-    # ✅ Bloquear todas las horas disponibles de ese día (sin tocar las citas existentes)
-    c.execute("""
-        UPDATE horarios
-        SET bloqueado = TRUE
-        WHERE peluquero_id = %s AND dia = %s
-    """, (peluquero_id, dia))
+    # ✅ Bloquear todas las horas de esa fecha (sin tocar las citas existentes)
+    repositorio.bloquear_fecha(c, peluquero_id, dia, fecha)
 
     conn.commit()
+    avisar_cambio(peluquero_id, inicio_semana_con_offset(semana_offset))
     conn.close()
 
-    flash(f"Se han bloqueado todos los horarios del día {dia}.", "success")
-    return redirect(url_for('ver_calendario_admin', peluquero_id=peluquero_id))
+    flash(f"Se han bloqueado todos los horarios del {dia} {fecha.strftime('%d/%m')}.", "success")
+    return redirect(url_for('ver_calendario_admin', peluquero_id=peluquero_id,
+                            semana_offset=semana_offset))
 
 @app.route("/admin/<int:peluquero_id>/calendario")
 def ver_calendario(peluquero_id):
@@ -861,9 +1333,6 @@ def ver_calendario(peluquero_id):
         return redirect(url_for("login"))
 
     semana_offset = int(request.args.get("semana_offset", 0))
-    
-    inicio_semana = inicio_semana_con_offset(semana_offset)
-    fin_semana = inicio_semana + timedelta(days=6)
 
     # Permitir que admin vea cualquier calendario
     if not session.get("es_admin") and session["peluquero_id"] != peluquero_id:
@@ -879,14 +1348,9 @@ def ver_calendario(peluquero_id):
         cancelar_dia = request.args.get("cancelar_dia")
         cancelar_hora = request.args.get("cancelar_hora")
         if cancelar_dia and cancelar_hora:
-            c.execute(
-                adapt_query("""
-                    DELETE FROM citas
-                    WHERE peluquero_id=%s AND dia=%s AND hora=%s
-                """),
-                (peluquero_id, cancelar_dia, cancelar_hora)
-            )
+            repositorio.cancelar_cita(c, peluquero_id, cancelar_dia, cancelar_hora)
             conn.commit()
+            avisar_cambio(peluquero_id)
 
     # ✅ Bloquear / Reactivar (solo admin) usando la columna 'bloqueado'
     if session.get("es_admin"):
@@ -895,14 +1359,10 @@ def ver_calendario(peluquero_id):
         
         if bloquear_dia and bloquear_hora:
             fecha = fecha_desde_dia(bloquear_dia, semana_offset)
-            c.execute("""
-                INSERT INTO horarios (peluquero_id, dia, hora, fecha, bloqueado)
-                VALUES (%s, %s, %s, %s, TRUE)
-                ON CONFLICT (peluquero_id, dia, hora, fecha)
-                DO UPDATE SET bloqueado = TRUE
-            """, (peluquero_id, bloquear_dia, bloquear_hora, fecha))
+            repositorio.bloquear_horario(c, peluquero_id, bloquear_dia, bloquear_hora, fecha)
             conn.commit()
-            print("DEBUG:", bloquear_dia, bloquear_hora, "fecha:", fecha,"bloquear")
+            avisar_cambio(peluquero_id)
+            log.debug("Horario bloqueado", extra={"datos": {"peluquero_id": peluquero_id, "dia": bloquear_dia, "hora": bloquear_hora, "fecha": fecha}})
             return redirect(url_for(
                 'ver_calendario_admin',
                 peluquero_id=peluquero_id,
@@ -915,110 +1375,34 @@ def ver_calendario(peluquero_id):
         
         if activar_dia and activar_hora:
             fecha = fecha_desde_dia(activar_dia, semana_offset)
-            c.execute("""
-                UPDATE horarios
-                SET bloqueado = FALSE
-                WHERE peluquero_id=%s
-                  AND dia=%s
-                  AND hora=%s
-                  AND fecha=%s
-            """, (peluquero_id, activar_dia, activar_hora, fecha))
+            repositorio.reactivar_horario(c, peluquero_id, activar_dia, activar_hora, fecha)
             conn.commit()
-            print("DEBUG:", activar_dia, activar_hora, "fecha:", fecha,"activar")
+            avisar_cambio(peluquero_id)
+            log.debug("Horario reactivado", extra={"datos": {"peluquero_id": peluquero_id, "dia": activar_dia, "hora": activar_hora, "fecha": fecha}})
             return redirect(url_for(
                 'ver_calendario_admin',
                 peluquero_id=peluquero_id,
                 semana_offset=semana_offset
             ))
 
-    # ✅ Obtener nombre del peluquero
-    c.execute(adapt_query("SELECT nombre FROM peluqueros WHERE id=%s"), (peluquero_id,))
-    row = c.fetchone()
-    if not row:
-        conn.close()
+    # ✅ Nombre del peluquero y grilla de la semana
+    cal = armar_calendario_semana(peluquero_id, semana_offset)
+    if cal["nombre"] is None:
         return "Peluquero no encontrado"
-    nombre = row[0]
-
-    dias = ['lunes', 'martes', 'miercoles', 'jueves', 'viernes', 'sabado', 'domingo']
-
-    dias_con_fechas = {
-        d: (inicio_semana + timedelta(days=i)).strftime("%d %b %Y")  # "27", "28", etc.
-        for i, d in enumerate(dias)
-    }
-
-    # ✅ Horas realmente existentes (en horarios o citas)
-    c.execute(adapt_query("""
-        SELECT DISTINCT hora FROM horarios WHERE peluquero_id=%s
-        UNION
-        SELECT DISTINCT hora FROM citas    WHERE peluquero_id=%s
-    """), (peluquero_id, peluquero_id))
-    horas = sorted(
-        {h for (h,) in c.fetchall()},
-        key=lambda h: datetime.strptime(h, "%I:%M %p")
-    )
-
-    # ✅ Disponibles: solo los NO bloqueados
-    c.execute("""
-        SELECT dia, hora
-        FROM horarios
-        WHERE peluquero_id = %s
-          AND bloqueado = FALSE
-          AND (
-                fecha IS NULL
-                OR fecha BETWEEN %s AND %s
-              )
-    """, (peluquero_id, inicio_semana, fin_semana))
-    
-    disponibles = {(d, h) for d, h in c.fetchall()}
-
-    # ✅ Ocupados
-    c.execute("""
-        SELECT id, dia, hora, nombre, telefono
-        FROM citas
-        WHERE peluquero_id = %s
-          AND fecha BETWEEN %s AND %s
-    """, (peluquero_id, fecha_inicio, fecha_fin))
-    
-    ocupados = {
-        (d, h): {
-            "id": cita_id,
-            "nombre": n,
-            "telefono": t
-        }
-        for cita_id, d, h, n, t in c.fetchall()
-    }
-
-    # ✅ Bloqueados: solo los que están marcados como bloqueados
-    fecha_inicio = inicio_semana
-    fecha_fin = fecha_inicio + timedelta(days=6)
-    
-    c.execute("""
-        SELECT dia, hora
-        FROM horarios
-        WHERE peluquero_id = %s
-          AND bloqueado = TRUE
-          AND (
-                fecha = '2000-01-01'
-                OR fecha BETWEEN %s AND %s
-              )
-    """, (peluquero_id, inicio_semana, fin_semana))
-    
-    bloqueados = {(d, h) for d, h in c.fetchall()}
-
-    conn.close()
 
     return render_template(
         "calendario.html",
-        inicio_semana=inicio_semana,
-        fin_semana=fin_semana,
-        nombre=nombre,
-        dias=dias,
-        dias_con_fechas=dias_con_fechas,
+        grilla=grilla_calendario(peluquero_id, semana_offset, cal, session.get("es_admin", False)),
+        inicio_semana=cal["inicio_semana"],
+        fin_semana=cal["fin_semana"],
+        nombre=cal["nombre"],
+        dias=cal["dias"],
+        dias_con_fechas=cal["dias_con_fechas"],
         peluquero_id=peluquero_id,
-        horas=horas,
-        disponibles=disponibles,
-        ocupados=ocupados,
-        bloqueados=bloqueados,
+        horas=cal["horas"],
+        disponibles=cal["disponibles"],
+        ocupados=cal["ocupados"],
+        bloqueados=cal["bloqueados"],
         semana_offset=semana_offset,
         es_admin=session.get("es_admin", False)
     )
@@ -1028,20 +1412,17 @@ def toggle_fijo(cita_id):
     conn = get_conn()
     c = conn.cursor()
     # Obtener valor actual
-    c.execute("SELECT fijo, peluquero_id FROM citas WHERE id = %s", (cita_id,))
-    row = c.fetchone()
-    if not row:
+    cita = repositorio.cita(c, cita_id)
+    if not cita:
         conn.close()
         return redirect(request.referrer or url_for('index'))
 
-    fijo_actual, peluquero_id = row
     # Invertir el valor
-    nuevo_valor = not fijo_actual
-
-    c.execute("UPDATE citas SET fijo = %s WHERE id = %s", (nuevo_valor, cita_id))
+    repositorio.marcar_fija(c, cita_id, not cita.fijo)
     conn.commit()
+    avisar_cambio(cita.peluquero_id)
     conn.close()
-    return redirect(url_for('ver_calendario_admin', peluquero_id=peluquero_id))
+    return redirect(url_for('ver_calendario_admin', peluquero_id=cita.peluquero_id))
 
 @app.route("/admin/liberar_todo/<int:peluquero_id>", methods=["POST"])
 def liberar_todo(peluquero_id):
@@ -1075,10 +1456,18 @@ def liberar_todo(peluquero_id):
         """, (peluquero_id, dia, hora))
 
     conn.commit()
+    avisar_cambio(peluquero_id)
     conn.close()
 
     return redirect(url_for('ver_calendario_admin', peluquero_id=peluquero_id))
 
+# Leer los totales de la semana desde contabilidad_resumen (mantenido por
+# trigger) en lugar de agrupar los movimientos en cada visita
+# (el resumen es de Postgres: con SQLite se agrupan los movimientos)
+USAR_RESUMEN_CONTABLE = os.getenv("USAR_RESUMEN_CONTABLE", "True" if db.USE_POSTGRES else "False").lower() == "true"
+
+MOVIMIENTOS_POR_PAGINA = int(os.getenv("MOVIMIENTOS_POR_PAGINA", "50"))
+
 @app.route("/contabilidad", methods=["GET", "POST"])
 def contabilidad_barbero():
     if 'peluquero_id' not in session:
@@ -1087,21 +1476,19 @@ def contabilidad_barbero():
      # Si el admin accede con ?peluquero_id=ID, usar ese
     peluquero_id = request.args.get("peluquero_id") or session['peluquero_id']
     es_admin = session.get('es_admin', False)
+    antes = request.args.get("antes", type=int)  # id del último movimiento de la página anterior
 
     conn = get_conn()
     c = conn.cursor()
 
-    # ✅ Registrar un nuevo movimiento (venta o consumo)
+    # ✅ Registrar un nuevo movimiento (venta o consumo); el trigger actualiza el resumen
     if request.method == "POST":
         tipo = request.form.get("tipo")
         categoria = request.form.get("categoria")
         descripcion = request.form.get("descripcion")
         valor = float(request.form.get("valor", 0))
 
-        c.execute("""
-            INSERT INTO contabilidad (peluquero_id, tipo, categoria, descripcion, valor, fecha)
-            VALUES (%s, %s, %s, %s, %s, NOW())
-        """, (peluquero_id, tipo, categoria, descripcion, valor))
+        repositorio.registrar_movimiento(c, peluquero_id, tipo, categoria, descripcion, valor)
         conn.commit()
 
     # ✅ Calcular rango de la semana (lunes a domingo)
@@ -1110,29 +1497,28 @@ def contabilidad_barbero():
     inicio_semana = hoy - timedelta(days=hoy.weekday())
     fin_semana = inicio_semana + timedelta(days=6)
 
-    # ✅ Obtener movimientos de la semana
-    c.execute("""
-        SELECT id, fecha, tipo, categoria, descripcion, valor
-        FROM contabilidad
-        WHERE peluquero_id = %s AND fecha::date BETWEEN %s AND %s
-        ORDER BY fecha DESC
-    """, (peluquero_id, inicio_semana, fin_semana))
+    # ✅ Movimientos de la semana, una página a la vez (keyset por fecha e id)
+    filas = repositorio.movimientos_semana(c, peluquero_id, inicio_semana, fin_semana + timedelta(days=1),
+                                           antes, MOVIMIENTOS_POR_PAGINA + 1)
 
     registros = [
         {
-            "id": r[0],
-            "fecha": r[1].strftime("%d/%m/%Y"),
-            "tipo": r[2],
-            "categoria": r[3],
-            "descripcion": r[4],
-            "valor": float(r[5]),
+            "id": m.id,
+            "fecha": m.fecha.strftime("%d/%m/%Y"),
+            "tipo": m.tipo,
+            "categoria": m.categoria,
+            "descripcion": m.descripcion,
+            "valor": float(m.valor),
         }
-        for r in c.fetchall()
+        for m in filas[:MOVIMIENTOS_POR_PAGINA]
     ]
+    siguiente = registros[-1]["id"] if len(filas) > MOVIMIENTOS_POR_PAGINA else None
 
-    # ✅ Calcular totales
-    total_ingresos = sum(r["valor"] for r in registros if r["tipo"] == "venta")
-    total_consumos = sum(r["valor"] for r in registros if r["tipo"] == "consumo")
+    # ✅ Totales de la semana: del resumen incremental (una fila) o agrupando en la base
+    totales = repositorio.totales_semana(c, peluquero_id, inicio_semana, fin_semana + timedelta(days=1),
+                                         USAR_RESUMEN_CONTABLE)
+    total_ingresos = totales.ingresos
+    total_consumos = totales.consumos
     total_neto = total_ingresos - total_consumos
 
     conn.close()
@@ -1146,8 +1532,53 @@ def contabilidad_barbero():
         total_neto=total_neto,
         inicio_semana=inicio_semana,
         fin_semana=fin_semana,
-        es_admin=es_admin
+        es_admin=es_admin,
+        siguiente=siguiente,
+        peluquero_id_param=request.args.get("peluquero_id")
+    )
+
+# Totales por barbero (excluyendo admin): desde el resumen o agrupando movimientos
+SQL_TOTALES_RESUMEN = """
+    SELECT p.id, p.nombre, COALESCE(p.porcentaje, 0) AS porcentaje,
+           COALESCE(r.cortes, 0)       AS total_cortes,
+           COALESCE(r.ventas_otras, 0) AS ventas_barberia,
+           COALESCE(r.consumos, 0)     AS consumos,
+           COALESCE(r.adelantos, 0)    AS adelantos
+    FROM peluqueros p
+    LEFT JOIN contabilidad_resumen r
+           ON r.peluquero_id = p.id AND r.semana_inicio = %(inicio)s
+    WHERE p.es_admin = 0
+"""
+
+SQL_TOTALES_MOVIMIENTOS = """
+    SELECT p.id, p.nombre, COALESCE(p.porcentaje, 0) AS porcentaje,
+           COALESCE(SUM(m.valor) FILTER (WHERE m.tipo = 'venta' AND m.categoria = 'cortes'), 0) AS total_cortes,
+           COALESCE(SUM(m.valor) FILTER (WHERE m.tipo = 'venta' AND m.categoria IS DISTINCT FROM 'cortes'), 0) AS ventas_barberia,
+           COALESCE(SUM(m.valor) FILTER (WHERE m.tipo = 'consumo'), 0) AS consumos,
+           COALESCE(SUM(m.valor) FILTER (WHERE m.tipo = 'adelanto'), 0) AS adelantos
+    FROM peluqueros p
+    LEFT JOIN contabilidad m
+           ON m.peluquero_id = p.id
+          AND m.fecha >= %(inicio)s AND m.fecha < %(fin)s
+    WHERE p.es_admin = 0
+    GROUP BY p.id, p.nombre, p.porcentaje
+"""
+
+# Cálculos de pago sobre los totales, con el total de la barbería como ventana
+SQL_REPORTE_SEMANAL = """
+    WITH totales AS ({totales}),
+    pagos AS (
+        SELECT t.*, t.total_cortes * t.porcentaje / 100 AS pago_barbero
+        FROM totales t
     )
+    SELECT id, nombre, porcentaje, total_cortes, ventas_barberia, consumos, adelantos,
+           pago_barbero,
+           pago_barbero - consumos - adelantos AS total_neto,
+           ventas_barberia + total_cortes - pago_barbero AS ganancia_barberia,
+           SUM(ventas_barberia + total_cortes - pago_barbero) OVER () AS total_barberia
+    FROM pagos
+    ORDER BY nombre
+"""
 
 @app.route("/admin/contabilidad", methods=["GET", "POST"])
 def admin_contabilidad():
@@ -1163,51 +1594,24 @@ def admin_contabilidad():
     inicio_semana = hoy - timedelta(days=hoy.weekday())  # lunes
     fin_semana = inicio_semana + timedelta(days=6)       # domingo
 
-    # Traer todos los barberos (excluyendo admin)
-    c.execute("""
-        SELECT id, nombre, porcentaje
-        FROM peluqueros
-        WHERE es_admin = 0
-        ORDER BY nombre
-    """)
-    barberos = c.fetchall()
+    # Todo el reporte en una sola consulta agrupada
+    totales = SQL_TOTALES_RESUMEN if USAR_RESUMEN_CONTABLE else SQL_TOTALES_MOVIMIENTOS
+    c.execute(SQL_REPORTE_SEMANAL.format(totales=totales),
+              {"inicio": inicio_semana, "fin": fin_semana + timedelta(days=1)})
 
     reporte = []
     total_barberia = 0
-
-    for (pid, nombre, porcentaje) in barberos:
-
-        # Obtener movimientos del barbero de esta semana
-        c.execute("""
-            SELECT tipo, categoria, valor
-            FROM contabilidad
-            WHERE peluquero_id = %s
-            AND fecha::date BETWEEN %s AND %s
-        """, (pid, inicio_semana, fin_semana))
-
-        registros = c.fetchall()
-
-        # Cálculos
-        total_cortes = sum(v for (t, cat, v) in registros if t == 'venta' and cat == 'cortes')
-        ventas_barberia = sum(v for (t, cat, v) in registros if t == 'venta' and cat != 'cortes')
-        consumos = sum(v for (t, cat, v) in registros if t == 'consumo')
-        adelantos = sum(v for (t, cat, v) in registros if t == 'adelanto')
-
-        pago_por_cortes = total_cortes * (porcentaje / 100)
-        total_neto = pago_por_cortes - consumos - adelantos
-        ganancia_barberia = ventas_barberia + (total_cortes - pago_por_cortes)
-
-        total_barberia += ganancia_barberia
-
+    for (pid, nombre, porcentaje, total_cortes, ventas_barberia, consumos, adelantos,
+         pago_barbero, total_neto, ganancia_barberia, total_barberia) in c.fetchall():
         reporte.append({
             "id": pid,
             "nombre": nombre,
             "porcentaje": porcentaje,
             "total_cortes": total_cortes,
-            "ventas_barberia": ventas_barberia,
+            "total_barberia_ventas": ventas_barberia,
             "consumos": consumos,
             "adelantos": adelantos,
-            "pago_por_cortes": pago_por_cortes,
+            "pago_barbero": pago_barbero,
             "total_neto": total_neto,
             "ganancia_barberia": ganancia_barberia
         })
@@ -1241,221 +1645,455 @@ def eliminar_movimiento(id):
     else:
         return redirect(url_for('contabilidad_barbero', peluquero_id=peluquero_id))
 
+@app.route("/admin/exportar/<tabla>.csv")
+def exportar_csv(tabla):
+    if 'peluquero_id' not in session or not session.get('es_admin'):
+        return redirect(url_for('login'))
+    if tabla not in exportar.EXPORTACIONES:
+        return "Exportación no encontrada", 404
+
+    try:
+        desde = date.fromisoformat(request.args["desde"]) if request.args.get("desde") else None
+        hasta = date.fromisoformat(request.args["hasta"]) if request.args.get("hasta") else None
+    except ValueError:
+        return "Fecha no válida", 400
+
+    # Respuesta en streaming: cada lote del cursor se envía apenas se lee
+    conn = get_conn()
+    return Response(
+        stream_with_context(exportar.csv_en_trozos(conn, tabla, desde, hasta)),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={tabla}.csv"}
+    )
+
+@app.cli.command("exportar")
+@click.argument("tabla", type=click.Choice(sorted(exportar.EXPORTACIONES)))
+@click.option("--formato", type=click.Choice(["csv", "parquet"]), default="csv")
+@click.option("--salida", help="Archivo de salida (por defecto <tabla>.<formato>).")
+@click.option("--desde", type=click.DateTime(formats=["%Y-%m-%d"]))
+@click.option("--hasta", type=click.DateTime(formats=["%Y-%m-%d"]))
+def exportar_cli(tabla, formato, salida, desde, hasta):
+    """Exporta citas o contabilidad a CSV (o Parquet, con pyarrow) sin cargar todo en memoria."""
+    salida = salida or f"{tabla}.{formato}"
+    desde = desde.date() if desde else None
+    hasta = hasta.date() if hasta else None
+    conn = get_conn()
+    if formato == "parquet":
+        try:
+            filas = exportar.escribir_parquet(conn, tabla, salida, desde, hasta)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+    else:
+        with open(salida, "w", newline="", encoding="utf-8") as archivo:
+            filas = exportar.escribir_csv(conn, tabla, archivo, desde, hasta)
+    conn.close()
+    if filas:
+        click.echo(f"✅ Exportado {tabla} a {salida}: {filas} filas")
+    else:
+        click.echo(f"⚠️ {tabla} no tiene filas en ese rango: {salida} queda solo con las columnas")
+
+HISTORIAL_SEMANAS = int(os.getenv("HISTORIAL_SEMANAS", "12"))  # semanas por página
+
 @app.route("/admin/contabilidad_historial")
 def ver_contabilidad_historial():
     if 'peluquero_id' not in session or not session.get('es_admin'):
         return redirect(url_for('login'))
 
+    # Filtros opcionales (AAAA-MM-DD) y paginación keyset: ?antes=<semana_fin>
+    # de la última semana mostrada en la página anterior
+    try:
+        desde = date.fromisoformat(request.args["desde"]) if request.args.get("desde") else None
+        hasta = date.fromisoformat(request.args["hasta"]) if request.args.get("hasta") else None
+        antes = date.fromisoformat(request.args["antes"]) if request.args.get("antes") else None
+    except ValueError:
+        return "Fecha no válida", 400
+
     conn = get_conn()
     c = conn.cursor()
+    # Primero las semanas de la página (una más para saber si hay siguiente),
+    # luego sus filas del resumen; el costo depende de lo que se muestra
     c.execute("""
-        SELECT semana_inicio, semana_fin, nombre_peluquero,
-               SUM(CASE WHEN tipo='venta' AND categoria='cortes' THEN valor ELSE 0 END) AS total_cortes,
-               SUM(CASE WHEN tipo='venta' AND categoria='barberia' THEN valor ELSE 0 END) AS total_barberia,
-               SUM(CASE WHEN tipo='consumo' THEN valor ELSE 0 END) AS total_consumos
-        FROM contabilidad_historial
-        GROUP BY semana_inicio, semana_fin, nombre_peluquero
-        ORDER BY semana_fin DESC
-    """)
-    historial = c.fetchall()
+        WITH semanas AS (
+            SELECT DISTINCT semana_fin
+            FROM contabilidad_historial_resumen
+            WHERE (%(desde)s::date IS NULL OR semana_fin >= %(desde)s)
+              AND (%(hasta)s::date IS NULL OR semana_fin <= %(hasta)s)
+              AND (%(antes)s::date IS NULL OR semana_fin < %(antes)s)
+            ORDER BY semana_fin DESC
+            LIMIT %(limite)s
+        )
+        SELECT r.semana_inicio, r.semana_fin, r.nombre_peluquero,
+               r.total_cortes, r.total_barberia, r.total_consumos
+        FROM contabilidad_historial_resumen r
+        JOIN semanas USING (semana_fin)
+        ORDER BY r.semana_fin DESC, r.nombre_peluquero
+    """, {"desde": desde, "hasta": hasta, "antes": antes, "limite": HISTORIAL_SEMANAS + 1})
+    filas = c.fetchall()
     conn.close()
 
-    return render_template("admin_contabilidad_historial.html", historial=historial)
+    semanas = sorted({fila[1] for fila in filas}, reverse=True)
+    siguiente = None
+    if len(semanas) > HISTORIAL_SEMANAS:
+        siguiente = semanas[HISTORIAL_SEMANAS - 1]
+        filas = [fila for fila in filas if fila[1] >= siguiente]
+
+    return render_template(
+        "admin_contabilidad_historial.html",
+        historial=filas,
+        desde=desde,
+        hasta=hasta,
+        siguiente=siguiente
+    )
 
 @app.route("/admin/gestionar_turno_global", methods=["POST"])
 def gestionar_turno_global():
     if "peluquero_id" not in session or not session.get("es_admin"):
         return redirect(url_for("login"))
 
-    dia = request.form.get("dia").lower()
-    hora = request.form.get("hora")      # ej: '08:40'
-    am_pm = request.form.get("am_pm")    # 'AM' o 'PM'
-    accion = request.form.get("accion")  # 'agregar' o 'eliminar'
+    dia = (request.form.get("dia") or "").lower()
+    hora = request.form.get("hora")              # ej: '08:40'
+    am_pm = request.form.get("am_pm")            # 'AM' o 'PM'
+    hora_fin = request.form.get("hora_fin")      # opcional: agrega/elimina un rango
+    am_pm_fin = request.form.get("am_pm_fin")
+    accion = request.form.get("accion")          # 'agregar' o 'eliminar'
 
-    # Normalizar a formato %I:%M %p (ej: "08:40 PM")
-    from datetime import datetime
-    hora_norm = datetime.strptime(f"{hora} {am_pm}", "%I:%M %p").strftime("%I:%M %p")
+    if not dia or not hora:
+        return "Día u hora no especificados", 400
+
+    # Minutos entre turnos del rango; fuera de estos límites la grilla no tiene sentido
+    try:
+        intervalo = int(request.form.get("intervalo") or HORARIO_INTERVALO)
+    except ValueError:
+        return "Intervalo no válido", 400
+    if not 5 <= intervalo <= 240:
+        return "El intervalo debe estar entre 5 y 240 minutos", 400
+
+    # Normalizar a formato %I:%M %p (ej: "08:40 PM"); con rango, cada 'intervalo' minutos
+    try:
+        inicio = datetime.strptime(f"{hora} {am_pm}", "%I:%M %p")
+        if hora_fin:
+            fin = datetime.strptime(f"{hora_fin} {am_pm_fin or am_pm}", "%I:%M %p")
+            horas = horas_grilla(inicio.strftime("%H:%M"), fin.strftime("%H:%M"), intervalo)
+        else:
+            horas = [inicio.strftime("%I:%M %p")]
+    except ValueError:
+        return "Hora no válida", 400
 
     # Si el admin eligió “TODOS” los días, usar toda la semana
-    dias_semana = ["lunes", "martes", "miercoles", "jueves",
-                   "viernes", "sabado", "domingo"]
-    dias_a_usar = dias_semana if dia == "todos" else [dia]
+    dias_a_usar = DIAS_SEMANA if dia == "todos" else [dia]
 
     conn = get_conn()
     c = conn.cursor()
 
-    # Obtener todos los peluqueros que NO son administradores
-    c.execute("SELECT id FROM peluqueros WHERE es_admin = 0")
-    peluqueros = [row[0] for row in c.fetchall()]
-
+    # Una sola sentencia para peluqueros (no admin) × días × horas
+    afectados = 0
     if accion == "agregar":
         # Inserta el turno para todos los barberos (reactiva si existía y estaba bloqueado)
-        for pid in peluqueros:
-            for d in dias_a_usar:
-                c.execute("""
-                    INSERT INTO horarios (peluquero_id, dia, hora, bloqueado)
-                    VALUES (%s, %s, %s, FALSE)
-                    ON CONFLICT (peluquero_id, dia, hora)
-                    DO UPDATE SET bloqueado = FALSE
-                """, (pid, d, hora_norm))
+        c.execute("""
+            INSERT INTO horarios (peluquero_id, dia, hora, bloqueado)
+            SELECT p.id, d.dia, h.hora, FALSE
+            FROM peluqueros p
+            CROSS JOIN unnest(%s::text[]) AS d(dia)
+            CROSS JOIN unnest(%s::text[]) AS h(hora)
+            WHERE p.es_admin = 0
+            ON CONFLICT (peluquero_id, dia, hora) WHERE fecha IS NULL
+            DO UPDATE SET bloqueado = FALSE
+        """, (dias_a_usar, horas))
+        afectados = c.rowcount
 
     elif accion == "eliminar":
         # Borra por completo la fila de cada barbero
-        for pid in peluqueros:
-            for d in dias_a_usar:
-                c.execute("""
-                    DELETE FROM horarios
-                    WHERE peluquero_id = %s AND dia = %s AND hora = %s
-                """, (pid, d, hora_norm))
+        c.execute("""
+            DELETE FROM horarios h
+            USING peluqueros p
+            WHERE h.peluquero_id = p.id
+              AND p.es_admin = 0
+              AND h.dia = ANY(%s)
+              AND h.hora = ANY(%s)
+        """, (dias_a_usar, horas))
+        afectados = c.rowcount
 
     conn.commit()
+    invalidar_todos()
     conn.close()
 
+    flash(f"Turno global ({accion}): {afectados} horarios afectados.", "success")
     return redirect(url_for("admin_panel"))
 
-def cierre_automatico_semanal():
-    """
-    Cierra automáticamente la semana cada domingo a las 11:59 PM.
-    Copia los registros de 'contabilidad' a 'contabilidad_historial'
-    y luego limpia la tabla principal.
-    """
-    while True:
-        try:
-            ahora = datetime.now()
-            # Calcular próximo domingo a las 11:59 PM
-            dias_hasta_domingo = (6 - ahora.weekday()) % 7  # 0=Lunes, 6=Domingo
-            proximo_domingo = ahora + timedelta(days=dias_hasta_domingo)
-            fecha_cierre = proximo_domingo.replace(hour=23, minute=59, second=0, microsecond=0)
+def calcular_proximo_cierre(ahora):
+    """Próximo domingo a las 11:59 PM estrictamente posterior a 'ahora'."""
+    dias_hasta_domingo = (6 - ahora.weekday()) % 7  # 0=Lunes, 6=Domingo
+    fecha_cierre = (ahora + timedelta(days=dias_hasta_domingo)).replace(hour=23, minute=59, second=0, microsecond=0)
+    if fecha_cierre <= ahora:
+        fecha_cierre += timedelta(days=7)
+    return fecha_cierre
 
-            espera = (fecha_cierre - ahora).total_seconds()
-            print(f"🕒 Próximo cierre semanal programado para: {fecha_cierre}")
-            time.sleep(espera)
+_proximo_cierre = None
 
-            conn = get_conn()
-            c = conn.cursor()
+CIERRE_LOTE = int(os.getenv("CIERRE_LOTE", "500"))  # movimientos por transacción al cerrar
 
-            fin_semana = datetime.now().date()
-            inicio_semana = fin_semana - timedelta(days=6)
+def cerrar_semana(semana_inicio, lote=CIERRE_LOTE):
+    """
+    Pasa al historial los movimientos de la semana (lunes a domingo) que
+    empieza en 'semana_inicio', en lotes de 'lote' filas. Cada lote borra de
+    'contabilidad' e inserta en 'contabilidad_historial' en una sola sentencia
+    y transacción, así que un corte a mitad de camino no duplica ni pierde
+    nada: volver a llamarla simplemente continúa. Devuelve cuántos movió.
+    """
+    semana_inicio = semana_inicio - timedelta(days=semana_inicio.weekday())
+    semana_fin = semana_inicio + timedelta(days=6)
+    conn = get_conn()
+    c = conn.cursor()
+    movidos = 0
+    try:
+        c.execute("SELECT contabilidad_historial_particion(%s)", (semana_inicio,))
+        c.execute("""
+            INSERT INTO cierres_semanales (semana_inicio, semana_fin)
+            VALUES (%s, %s)
+            ON CONFLICT (semana_inicio) DO NOTHING
+        """, (semana_inicio, semana_fin))
+        conn.commit()
 
-            # Copiar registros actuales
+        while True:
             c.execute("""
+                WITH lote AS (
+                    DELETE FROM contabilidad
+                    WHERE id IN (
+                        SELECT id FROM contabilidad
+                        WHERE fecha >= %(inicio)s AND fecha < %(fin)s
+                        ORDER BY id
+                        LIMIT %(lote)s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING *
+                )
                 INSERT INTO contabilidad_historial (peluquero_id, nombre_peluquero, tipo, categoria,
-                                                    nombre_item, valor, semana_inicio, semana_fin)
-                SELECT peluquero_id, nombre_peluquero, tipo, categoria, nombre_item, valor,
-                       %s, %s
-                FROM contabilidad
-            """, (inicio_semana, fin_semana))
-
-            # Limpiar tabla principal
-            c.execute("DELETE FROM contabilidad")
+                                                    nombre_item, valor, semana_inicio, semana_fin, fecha)
+                SELECT l.peluquero_id, COALESCE(l.nombre_peluquero, p.nombre), l.tipo, l.categoria,
+                       COALESCE(l.nombre_item, l.descripcion), l.valor, %(inicio)s, %(semana_fin)s, l.fecha
+                FROM lote l
+                LEFT JOIN peluqueros p ON p.id = l.peluquero_id
+            """, {"inicio": semana_inicio, "fin": semana_fin + timedelta(days=1),
+                  "semana_fin": semana_fin, "lote": lote})
+            n = c.rowcount
+            c.execute("UPDATE cierres_semanales SET movimientos = movimientos + %s WHERE semana_inicio = %s",
+                      (n, semana_inicio))
             conn.commit()
-            conn.close()
-            print("✅ Cierre semanal automático ejecutado correctamente.")
-
-        except Exception as e:
-            print(f"❌ Error en cierre semanal: {e}")
-            time.sleep(60)  # evitar bucles en caso de error
-
-def enviar_recordatorios():
-    while True:
-        try:
-            conn = get_conn()
-            c = conn.cursor()
+            movidos += n
+            if n < lote:
+                break
 
-            # Hora actual
-            ahora = datetime.now()
-
-            # Buscamos citas dentro de la próxima hora que aún no tengan recordatorio enviado
-            c.execute("""
-                SELECT id, nombre, telefono, dia, hora, peluquero_id
-                FROM citas
-                WHERE recordatorio_enviado = FALSE
-            """)
-            citas = c.fetchall()
-
-            for id_cita, nombre, telefono, dia, hora, peluquero_id in citas:
-                try:
-                    # Convertir hora de texto ("02:00 PM") a datetime de hoy
-                    hora_cita = datetime.strptime(hora, "%I:%M %p")
-
-                    # Obtener el próximo día correspondiente (ej: lunes → fecha exacta)
-                    from zoneinfo import ZoneInfo
-                    tz = ZoneInfo("America/Bogota")
-                    ahora_local = ahora.astimezone(tz)
-
-                    # Saltar si ya pasó la cita
-                    if hora_cita.hour < ahora_local.hour - 1:
-                        continue
-
-                    # Diferencia de tiempo
-                    diferencia = abs((hora_cita.hour - ahora_local.hour) * 60 + (hora_cita.minute - ahora_local.minute))
+        # Recalcular el resumen de la semana (solo lee su partición) junto con la marca de cierre
+        rango = {"inicio": semana_inicio, "fin": semana_inicio + timedelta(days=7)}
+        c.execute("""
+            DELETE FROM contabilidad_historial_resumen
+            WHERE semana_inicio >= %(inicio)s AND semana_inicio < %(fin)s
+        """, rango)
+        c.execute("""
+            INSERT INTO contabilidad_historial_resumen (semana_inicio, semana_fin, nombre_peluquero,
+                                                        total_cortes, total_barberia, total_consumos)
+            SELECT semana_inicio, semana_fin, COALESCE(nombre_peluquero, ''),
+                   COALESCE(SUM(valor) FILTER (WHERE tipo = 'venta' AND categoria = 'cortes'), 0),
+                   COALESCE(SUM(valor) FILTER (WHERE tipo = 'venta' AND categoria = 'barberia'), 0),
+                   COALESCE(SUM(valor) FILTER (WHERE tipo = 'consumo'), 0)
+            FROM contabilidad_historial
+            WHERE semana_inicio >= %(inicio)s AND semana_inicio < %(fin)s AND semana_fin IS NOT NULL
+            GROUP BY semana_inicio, semana_fin, COALESCE(nombre_peluquero, '')
+        """, rango)
+        c.execute("UPDATE cierres_semanales SET cerrado_en = NOW() WHERE semana_inicio = %s", (semana_inicio,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return movidos
 
-                    if diferencia <= 60:  # dentro de una hora
-                        # Obtener el nombre del peluquero
-                        c2 = conn.cursor()
-                        c2.execute("SELECT nombre FROM peluqueros WHERE id=%s", (peluquero_id,))
-                        row = c2.fetchone()
-                        nombre_peluquero = row[0] if row else "tu barbero"
-                        c2.close()
+def cerrar_semanas_pendientes(hasta):
+    """
+    Cierra, de la más antigua a la más reciente, todas las semanas con
+    movimientos anteriores a 'hasta' (un lunes). Sirve tanto para el cierre
+    de cada domingo como para ponerse al día si alguno no se ejecutó.
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("""
+        SELECT DISTINCT date_trunc('week', fecha)::date
+        FROM contabilidad
+        WHERE fecha < %s
+        ORDER BY 1
+    """, (hasta,))
+    semanas = [fila[0] for fila in c.fetchall()]
+    conn.close()
 
-                        # Enviar mensaje
-                        account_sid = os.getenv("TWILIO_ACCOUNT_SID")
-                        auth_token = os.getenv("TWILIO_AUTH_TOKEN")
-                        from_whatsapp = os.getenv("TWILIO_WHATSAPP_NUMBER")
+    for semana in semanas:
+        movidos = cerrar_semana(semana)
+        log.info("✅ Semana %s cerrada: %s movimientos al historial.", semana, movidos)
+    return semanas
 
-                        client = Client(account_sid, auth_token)
-                        to_number = f"whatsapp:+57{telefono}"
+def cierre_automatico_semanal():
+    """
+    Cierra automáticamente la semana cada domingo a las 11:59 PM pasando sus
+    movimientos de 'contabilidad' a 'contabilidad_historial'. Al arrancar
+    también cierra las semanas anteriores que hayan quedado pendientes.
+    Es una pasada de la tarea periódica: devuelve los segundos hasta el próximo cierre.
+    """
+    global _proximo_cierre
+    ahora = datetime.now(tz).replace(tzinfo=None)
+    lunes_actual = ahora.date() - timedelta(days=ahora.weekday())
+    hasta = None
+    if _proximo_cierre is None:
+        hasta = lunes_actual  # ponerse al día con semanas ya terminadas
+    elif ahora >= _proximo_cierre:
+        hasta = _proximo_cierre.date() + timedelta(days=1)  # incluye la semana de ese domingo
+
+    if hasta is not None:
+        try:
+            cerrar_semanas_pendientes(hasta)
+        except Exception:
+            log.exception("❌ Error en cierre semanal")
+            return 60  # reintentar en un minuto; lo ya movido no se repite
+        _proximo_cierre = calcular_proximo_cierre(ahora)
+        log.info("🕒 Próximo cierre semanal programado para: %s", _proximo_cierre)
+
+    return (_proximo_cierre - ahora).total_seconds()
+
+@app.cli.command("cerrar-semana")
+@click.option("--semana", type=click.DateTime(formats=["%Y-%m-%d"]),
+              help="Cerrar solo la semana que contiene esta fecha (AAAA-MM-DD).")
+@click.option("--hasta", type=click.DateTime(formats=["%Y-%m-%d"]),
+              help="Cerrar todas las semanas con movimientos anteriores a esta fecha (por defecto, el lunes actual).")
+def cerrar_semana_cli(semana, hasta):
+    """Cierra semanas contables a demanda (backfills o cierres que no corrieron)."""
+    if semana:
+        movidos = cerrar_semana(semana.date())
+        click.echo(f"✅ Semana de {semana.date()} cerrada: {movidos} movimientos al historial.")
+        return
+    if hasta:
+        limite = hasta.date()
+    else:
+        hoy = datetime.now(tz).date()
+        limite = hoy - timedelta(days=hoy.weekday())
+    semanas = cerrar_semanas_pendientes(limite)
+    if not semanas:
+        click.echo("Nada que cerrar.")
+
+_despertar_recordatorios = threading.Event()
+# Cada aviso de cambio de citas u horarios (también los de otros procesos, que
+# llegan por LISTEN/NOTIFY) despierta la tarea en el proceso que la ejecuta,
+# por si la cita nueva cae dentro de la ventana de recordatorio
+eventos.al_avisar(lambda peluquero_id, semana: _despertar_recordatorios.set())
+
+def encolar_recordatorios(c, ahora):
+    """
+    Marca como recordadas las citas que empiezan dentro de la ventana y encola
+    sus WhatsApp en el outbox, todo con el cursor (y la transacción) de quien
+    llama. Usa el índice parcial sobre citas.inicio. Devuelve cuántas encoló.
+    """
+    c.execute("""
+        UPDATE citas AS ci
+        SET recordatorio_enviado = TRUE
+        FROM peluqueros p
+        WHERE p.id = ci.peluquero_id
+          AND ci.recordatorio_enviado = FALSE
+          AND ci.inicio BETWEEN %s AND %s
+        RETURNING ci.nombre, ci.telefono, ci.hora, p.nombre
+    """, (ahora, ahora + timedelta(minutes=RECORDATORIO_VENTANA)))
+
+    mensajes = [
+        (
+            f"+57{telefono}",
+            f"⏰ *Recuerda tu cita*\n\n"
+            f"Hola {nombre}, te recordamos tu cita con *{nombre_peluquero or 'tu barbero'}* "
+            f"programada para hoy a las *{hora}*.\n\n"
+            f"💈 ¡Te esperamos en VIP BARBER TOP!"
+        )
+        for nombre, telefono, hora, nombre_peluquero in c.fetchall()
+    ]
+    notificaciones.encolar_varios(c, mensajes)
+    return len(mensajes)
 
-                        mensaje = (
-                            f"⏰ *Recuerda tu cita*\n\n"
-                            f"Hola {nombre}, te recordamos tu cita con *{nombre_peluquero}* "
-                            f"programada para hoy a las *{hora}*.\n\n"
-                            f"💈 ¡Te esperamos en VIP BARBER TOP!"
-                        )
+def enviar_recordatorios():
+    """
+    Encola los recordatorios que vencen y devuelve cuántos segundos faltan
+    para que el próximo entre en la ventana (como máximo
+    RECORDATORIO_MAX_ESPERA). Cualquier aviso de cambio (eventos.al_avisar)
+    la despierta antes, aunque la cita se reserve en otro proceso.
+    """
+    espera = RECORDATORIO_MAX_ESPERA
+    conn = get_conn()
+    c = conn.cursor()
+    try:
+        # citas.inicio está en hora local de Bogotá, sin zona
+        ahora = datetime.now(tz).replace(tzinfo=None)
+        enviados = encolar_recordatorios(c, ahora)
+        conn.commit()
+        if enviados:
+            notificaciones.avisar()
+            log.info("✅ %s recordatorios encolados", enviados)
 
-                        client.messages.create(
-                            from_=from_whatsapp,
-                            to=to_number,
-                            body=mensaje
-                        )
+        # ¿Cuándo entra la siguiente cita en la ventana?
+        c.execute("""
+            SELECT MIN(inicio) FROM citas
+            WHERE recordatorio_enviado = FALSE AND inicio > %s
+        """, (ahora,))
+        proxima = c.fetchone()[0]
+    except Exception:
+        conn.rollback()
+        log.exception("❌ Error en tarea de recordatorios")
+        return 60
+    finally:
+        conn.close()
 
-                        # Marcar como recordatorio enviado
-                        c.execute("UPDATE citas SET recordatorio_enviado = TRUE WHERE id=%s", (id_cita,))
-                        conn.commit()
+    if proxima is not None:
+        vence = proxima - timedelta(minutes=RECORDATORIO_VENTANA)
+        espera = min(espera, max((vence - ahora).total_seconds(), 1))
+    return espera
 
-                        print(f"✅ Recordatorio enviado a {nombre} ({telefono})")
+# ---------- TAREAS EN SEGUNDO PLANO ----------
+# Recordatorios y cierre semanal corren en un solo proceso a la vez (advisory
+# lock, ver tareas.py). Con JOBS_EN_WEB=False los workers web no las lanzan y
+# las ejecuta el proceso 'worker' del Procfile (worker.py).
+JOBS_EN_WEB = os.getenv("JOBS_EN_WEB", "True").lower() == "true"
 
-                except Exception as e:
-                    print(f"⚠️ Error procesando cita {id_cita}: {e}")
+def iniciar_tareas():
+    # Los avisos de otros procesos despiertan los recordatorios (ver al_avisar)
+    eventos.iniciar_escucha()
 
-            conn.close()
+    # Enviar recordatorios
+    threading.Thread(target=ejecutar_como_lider,
+                     args=("recordatorios", enviar_recordatorios, _despertar_recordatorios),
+                     daemon=True).start()
 
-        except Exception as e:
-            print(f"❌ Error en tarea de recordatorios: {e}")
+    # 🔁 Cierre semanal
+    threading.Thread(target=ejecutar_como_lider,
+                     args=("cierre_semanal", cierre_automatico_semanal),
+                     daemon=True).start()
 
-        # Esperar 5 minutos antes de revisar de nuevo
-        time.sleep(300)
+    # 📨 Despachador del outbox de WhatsApp (puede correr en varios procesos: usa SKIP LOCKED)
+    threading.Thread(target=notificaciones.despachador, args=(get_conn,), daemon=True).start()
 
-# Iniciar hilo en segundo plano para enviar recordatorios
-threading.Thread(target=enviar_recordatorios, daemon=True).start()
+# Las tareas usan advisory locks y SKIP LOCKED: solo con Postgres
+if JOBS_EN_WEB and db.USE_POSTGRES:
+    iniciar_tareas()
 
-# 🔁 Lanzar hilo automático de cierre semanal
-threading.Thread(target=cierre_automatico_semanal, daemon=True).start()
+# Con la caché local cada worker escucha los avisos desde el arranque (no
+# desde el primer suscriptor SSE) para invalidar lo que cambian los demás
+if not cache.compartida:
+    eventos.iniciar_escucha()
 
 # ---------- ARRANQUE ----------
 if __name__ == "__main__":
-    init_schema()
-    init_db_legacy()
-
     conn = get_conn()
     c = conn.cursor()
     c.execute(adapt_query("SELECT id FROM peluqueros"))
     peluqueros_ids = [row[0] for row in c.fetchall()]
-    conn.close()
 
-    for pid in peluqueros_ids:
-        if pid:
-            cargar_horarios_40_minutos(pid)
+    # Grilla base de todos los peluqueros en un solo INSERT
+    creados = crear_horarios_base(c, peluqueros_ids)
+    conn.commit()
+    conn.close()
+    log.info("🕒 Horarios base creados: %s", creados)
 
-    print("✅ Base de datos lista y horarios cargados")
+    log.info("✅ Base de datos lista y horarios cargados")
     app.run(debug=True)
@@ -0,0 +1,407 @@
+# benchmark.py
+# Banco de carga reproducible para las rutas de reservas y calendario
+# (index, calendario_cliente, agendar, admin_contabilidad).
+#
+#   python benchmark.py                                   # SQLite temporal, 5 peluqueros × 4 semanas
+#   python benchmark.py --peluqueros 20 --semanas 12 --concurrencia 16
+#   python benchmark.py --modo http --procesos 4          # servidor HTTP local + clientes en varios procesos
+#   DB_BACKEND=postgres DATABASE_URL=postgresql://... python benchmark.py --comparar benchmarks/anterior.json
+#
+# ⚠️ Siembra peluqueros 'bench_*' (con sus citas y movimientos) en la base
+# configurada: usar una base de pruebas, nunca la de producción.
+#
+# Cada corrida guarda un JSON en benchmarks/ con el commit actual, para
+# comparar latencias (p50/p95/p99), peticiones por segundo y consultas por
+# petición entre commits. Las consultas se cuentan dos veces: con la caché
+# caliente (lo que ve la carga) y fría (la consulta real de cada ruta).
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from http.cookiejar import CookieJar
+from multiprocessing import Pool
+
+import click
+
+# La configuración tiene que quedar lista antes de importar app
+os.environ.setdefault("DB_BACKEND", "sqlite")
+os.environ["JOBS_EN_WEB"] = "False"
+os.environ.setdefault("LOG_NIVEL", "WARNING")  # sin una línea de log por petición medida
+if os.environ["DB_BACKEND"] == "sqlite" and "DB_SQLITE_PATH" not in os.environ:
+    os.environ["DB_SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="barberia-bench-"), "bench.db")
+
+import app as aplicacion
+import db
+
+RUTAS = ["index", "calendario_cliente", "agendar", "admin_contabilidad"]
+USUARIO_ADMIN = "bench_admin"
+PASSWORD = "bench"
+TELEFONO_BENCH = "+5730000"   # prefijo de los teléfonos sembrados
+
+
+# ---------- DATOS DE PRUEBA ----------
+
+def sembrar(peluqueros, semanas, ocupacion, movimientos, semilla):
+    """
+    Borra lo sembrado en corridas anteriores y crea 'peluqueros' barberos con
+    su grilla base, 'semanas' semanas de citas (hasta la semana siguiente a la
+    actual) y 'movimientos' movimientos de contabilidad por semana.
+    Devuelve (ids de peluqueros, [(dia, hora)] de la grilla base).
+    """
+    azar = random.Random(semilla)
+    conn = aplicacion.get_conn()
+    c = conn.cursor()
+    c.execute("DELETE FROM peluqueros WHERE usuario LIKE 'bench%%'")
+    limpiar_notificaciones(c)
+
+    clave = aplicacion.generate_password_hash(PASSWORD)
+    c.execute("INSERT INTO peluqueros (nombre, usuario, password, es_admin) VALUES (%s, %s, %s, 1)",
+              ("Bench Admin", USUARIO_ADMIN, clave))
+    ids = []
+    for i in range(peluqueros):
+        c.execute("INSERT INTO peluqueros (nombre, usuario, password, es_admin, telefono, porcentaje)"
+                  " VALUES (%s, %s, %s, 0, %s, 50) RETURNING id",
+                  (f"Bench {i + 1:03d}", f"bench_{i + 1:03d}", clave, f"{TELEFONO_BENCH}{i:05d}"))
+        ids.append(c.fetchone()[0])
+
+    aplicacion.crear_horarios_base(c, ids)
+    c.execute("SELECT DISTINCT dia, hora FROM horarios WHERE fecha IS NULL AND peluquero_id = %s", (ids[0],))
+    grilla = sorted(c.fetchall())
+
+    lunes_actual = aplicacion.inicio_semana_con_offset(0)
+    citas, movs = [], []
+    for semana in range(semanas):
+        lunes = lunes_actual + timedelta(weeks=semana - semanas + 2)
+        for pid in ids:
+            for dia, hora in grilla:
+                if azar.random() < ocupacion:
+                    fecha = lunes + timedelta(days=aplicacion.DIAS_SEMANA.index(dia))
+                    citas.append((pid, dia, hora, fecha, f"Cliente {azar.randrange(10000)}", "3000000000"))
+            for _ in range(movimientos):
+                tipo = azar.choice(["venta", "venta", "venta", "consumo", "adelanto"])
+                categoria = "cortes" if tipo == "venta" and azar.random() < 0.7 else "productos"
+                fecha = datetime.combine(lunes, datetime.min.time()) + timedelta(minutes=azar.randrange(7 * 24 * 60))
+                movs.append((pid, tipo, categoria, "bench", azar.randrange(5, 60) * 1000, fecha))
+
+    for inicio in range(0, len(citas), 5000):
+        db.insertar_varios(c, "INSERT INTO citas (peluquero_id, dia, hora, fecha, nombre, telefono)"
+                              " VALUES %s ON CONFLICT DO NOTHING", citas[inicio:inicio + 5000])
+    for inicio in range(0, len(movs), 5000):
+        db.insertar_varios(c, "INSERT INTO contabilidad (peluquero_id, tipo, categoria, descripcion, valor, fecha)"
+                              " VALUES %s", movs[inicio:inicio + 5000])
+    conn.commit()
+    conn.close()
+    aplicacion.invalidar_todos()
+    return ids, grilla
+
+
+def limpiar_notificaciones(c):
+    """Descarta los WhatsApp que encoló 'agendar' para los peluqueros sembrados (nadie debe recibirlos)."""
+    c.execute("DELETE FROM notificaciones WHERE destinatario LIKE %s AND enviado_en IS NULL",
+              (TELEFONO_BENCH + "%",))
+
+
+def peticion(ruta, azar, ids, grilla):
+    """(método, url, formulario) de una petición al azar para la ruta."""
+    if ruta == "index":
+        return "GET", "/", None
+    if ruta == "calendario_cliente":
+        return "GET", f"/cliente/{azar.choice(ids)}/calendario?semana_offset={azar.randrange(2)}", None
+    if ruta == "agendar":
+        dia, hora = azar.choice(grilla)
+        return "POST", "/agendar", {"peluquero_id": str(azar.choice(ids)), "dia": dia, "hora": hora,
+                                    "semana_offset": str(azar.randrange(2)),
+                                    "nombre": "Bench", "telefono": "3000000000"}
+    return "GET", "/admin/contabilidad", None
+
+
+def _valida(ruta, estado):
+    # En agendar un 409 es una respuesta correcta: el horario ya estaba tomado
+    return estado == 200 or (ruta == "agendar" and estado == 409)
+
+
+# ---------- CLIENTES ----------
+
+def _cliente_flask():
+    cliente = aplicacion.app.test_client()
+    cliente.post("/login", data={"usuario": USUARIO_ADMIN, "password": PASSWORD})
+    return cliente
+
+
+def _pedir_flask(cliente, metodo, url, formulario):
+    resp = cliente.open(url, method=metodo, data=formulario)
+    resp.get_data()
+    resp.close()
+    return resp.status_code
+
+
+def _abridor_http(base):
+    abridor = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+    datos = urllib.parse.urlencode({"usuario": USUARIO_ADMIN, "password": PASSWORD}).encode()
+    try:
+        abridor.open(base + "/login", data=datos).read()
+    except urllib.error.HTTPError:
+        pass
+    return abridor
+
+
+def _pedir_http(abridor, base, metodo, url, formulario):
+    datos = urllib.parse.urlencode(formulario).encode() if formulario else None
+    try:
+        with abridor.open(urllib.request.Request(base + url, data=datos, method=metodo)) as resp:
+            resp.read()
+            return resp.status
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code
+
+
+def _ejecutar(ruta, cantidad, hilos, semilla, ids, grilla, base=None):
+    """
+    Lanza 'cantidad' peticiones con 'hilos' hilos. Los clientes inician sesión
+    antes de arrancar el reloj (el hash de la contraseña no cuenta en el
+    throughput). Devuelve (latencias en ms, {estado: n}, (inicio, fin)) con
+    inicio y fin en time.time() para poder juntar varios procesos.
+    """
+    clientes = [_cliente_flask() if base is None else _abridor_http(base) for _ in range(hilos)]
+    contador = iter(range(cantidad))
+    candado = threading.Lock()
+    latencias, estados = [], {}
+
+    def trabajar(n_hilo):
+        azar = random.Random(f"{semilla}-{ruta}-{n_hilo}")
+        cliente = clientes[n_hilo]
+        while True:
+            with candado:
+                if next(contador, None) is None:
+                    return
+            metodo, url, formulario = peticion(ruta, azar, ids, grilla)
+            inicio = time.perf_counter()
+            if base is None:
+                estado = _pedir_flask(cliente, metodo, url, formulario)
+            else:
+                estado = _pedir_http(cliente, base, metodo, url, formulario)
+            ms = (time.perf_counter() - inicio) * 1000
+            with candado:
+                latencias.append(ms)
+                estados[estado] = estados.get(estado, 0) + 1
+
+    inicio = time.time()
+    with ThreadPoolExecutor(max_workers=hilos) as ejecutor:
+        list(ejecutor.map(trabajar, range(hilos)))
+    return latencias, estados, (inicio, time.time())
+
+
+def _ejecutar_proceso(argumentos):
+    # Punto de entrada de cada proceso cliente en --modo http
+    return _ejecutar(*argumentos)
+
+
+# ---------- MEDICIÓN ----------
+
+def percentil(valores, p):
+    """Percentil por rango más cercano sobre una lista ya ordenada."""
+    if not valores:
+        return None
+    return valores[min(len(valores) - 1, max(0, math.ceil(p / 100 * len(valores)) - 1))]
+
+
+def muestras_en_secuencia(ruta, muestras, semilla, ids, grilla, frio):
+    """
+    Peticiones en secuencia y en este mismo hilo, contadas con la medición de
+    db.py (la misma que alimenta Server-Timing). Con 'frio' se invalida la
+    caché antes de cada una, así se recorre la consulta de la grilla y no
+    solo el acierto de caché. Devuelve (consultas, ms en la base, p50 ms).
+    """
+    cliente = _cliente_flask()
+    azar = random.Random(f"{semilla}-{ruta}-{'frio' if frio else 'caliente'}")
+    consultas = segundos = 0
+    latencias = []
+    for _ in range(muestras):
+        metodo, url, formulario = peticion(ruta, azar, ids, grilla)
+        if frio:
+            aplicacion.invalidar_todos()
+        db.reiniciar_medicion()
+        inicio = time.perf_counter()
+        _pedir_flask(cliente, metodo, url, formulario)
+        latencias.append((time.perf_counter() - inicio) * 1000)
+        n, s = db.medicion()
+        consultas += n
+        segundos += s
+    latencias.sort()
+    return consultas / muestras, segundos * 1000 / muestras, percentil(latencias, 50)
+
+
+def medir_ruta(ruta, opciones, ids, grilla, base):
+    cantidad, hilos, procesos, semilla = (opciones["peticiones"], opciones["concurrencia"],
+                                          opciones["procesos"], opciones["semilla"])
+    # Calentar (cachés, sentencias preparadas, pool) sin contar
+    _ejecutar(ruta, min(cantidad, 20), 1, semilla + 1, ids, grilla, base)
+
+    if base is not None and procesos > 1:
+        partes = [(ruta, cantidad // procesos + (1 if i < cantidad % procesos else 0), hilos,
+                   semilla + 100 + i, ids, grilla, base) for i in range(procesos)]
+        with Pool(procesos) as pool:
+            resultados = pool.map(_ejecutar_proceso, partes)
+        latencias = [ms for lat, _, _ in resultados for ms in lat]
+        estados = {}
+        for _, est, _ in resultados:
+            for estado, n in est.items():
+                estados[estado] = estados.get(estado, 0) + n
+        # Ventana desde que arrancó el primer proceso hasta que terminó el último
+        duracion = max(fin for _, _, (_, fin) in resultados) - min(ini for _, _, (ini, _) in resultados)
+    else:
+        latencias, estados, (ini, fin) = _ejecutar(ruta, cantidad, hilos, semilla, ids, grilla, base)
+        duracion = fin - ini
+
+    consultas, ms_bd, _ = muestras_en_secuencia(ruta, opciones["muestras"], semilla, ids, grilla, frio=False)
+    consultas_frio, ms_bd_frio, p50_frio = muestras_en_secuencia(ruta, opciones["muestras"], semilla, ids, grilla,
+                                                                 frio=True)
+    latencias.sort()
+    return {
+        "peticiones": len(latencias),
+        "errores": sum(n for estado, n in estados.items() if not _valida(ruta, estado)),
+        "estados": {str(estado): n for estado, n in sorted(estados.items())},
+        "p50_ms": round(percentil(latencias, 50), 2),
+        "p95_ms": round(percentil(latencias, 95), 2),
+        "p99_ms": round(percentil(latencias, 99), 2),
+        "media_ms": round(sum(latencias) / len(latencias), 2),
+        "peticiones_por_segundo": round(len(latencias) / duracion, 1),
+        "consultas_por_peticion": round(consultas, 2),
+        "ms_bd_por_peticion": round(ms_bd, 2),
+        # Con la caché vacía antes de cada petición (en secuencia)
+        "frio": {
+            "p50_ms": round(p50_frio, 2),
+            "consultas_por_peticion": round(consultas_frio, 2),
+            "ms_bd_por_peticion": round(ms_bd_frio, 2),
+        },
+    }
+
+
+def _commit_actual():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "desconocido"
+
+
+def _servidor_local():
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class SinRegistro(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass  # una línea por petición taparía los resultados
+
+    servidor = make_server("127.0.0.1", 0, aplicacion.app, threaded=True, request_handler=SinRegistro)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_port}"
+
+
+def comparar(anterior, actual):
+    """Imprime la variación de p95 y peticiones por segundo contra una corrida anterior."""
+    click.echo(f"\n📊 Comparación contra {anterior.get('commit')} ({anterior.get('fecha')}):")
+    if (anterior.get("motor"), anterior.get("modo")) != (actual["motor"], actual["modo"]):
+        click.echo(f"⚠️ La corrida anterior usó {anterior.get('motor')}/{anterior.get('modo')}: los números no son comparables")
+    for ruta, datos in actual["rutas"].items():
+        previo = anterior.get("rutas", {}).get(ruta)
+        if not previo:
+            continue
+        d_p95 = (datos["p95_ms"] - previo["p95_ms"]) / previo["p95_ms"] * 100 if previo["p95_ms"] else 0
+        d_rps = ((datos["peticiones_por_segundo"] - previo["peticiones_por_segundo"])
+                 / previo["peticiones_por_segundo"] * 100 if previo["peticiones_por_segundo"] else 0)
+        marca = "⚠️" if d_p95 > 20 or d_rps < -20 else "  "
+        click.echo(f"{marca} {ruta:<20} p95 {previo['p95_ms']:>8.2f} → {datos['p95_ms']:>8.2f} ms ({d_p95:+.0f}%)"
+              f"   rps {previo['peticiones_por_segundo']:>8.1f} → {datos['peticiones_por_segundo']:>8.1f}"
+              f" ({d_rps:+.0f}%)")
+
+
+@click.command()
+@click.option("--peluqueros", default=5, show_default=True, help="Peluqueros sembrados.")
+@click.option("--semanas", default=4, show_default=True, help="Semanas de citas y movimientos (hasta la siguiente).")
+@click.option("--ocupacion", default=0.4, show_default=True, help="Fracción de horarios con cita.")
+@click.option("--movimientos", default=30, show_default=True, help="Movimientos de contabilidad por peluquero y semana.")
+@click.option("--peticiones", default=300, show_default=True, help="Peticiones por ruta.")
+@click.option("--concurrencia", default=8, show_default=True, help="Hilos cliente (por proceso).")
+@click.option("--modo", type=click.Choice(["cliente", "http"]), default="cliente", show_default=True,
+              help="cliente: test client de Flask en hilos; http: servidor HTTP y clientes urllib.")
+@click.option("--procesos", default=1, show_default=True, help="Procesos cliente en --modo http.")
+@click.option("--url", default=None, help="En --modo http, apuntar a un servidor ya levantado (misma base).")
+@click.option("--rutas", default=",".join(RUTAS), show_default=True, help="Rutas a medir, separadas por coma.")
+@click.option("--muestras", default=20, show_default=True,
+              help="Peticiones en secuencia para contar consultas (con caché caliente y fría).")
+@click.option("--semilla", default=42, show_default=True)
+@click.option("--salida", default=None, help="Archivo JSON de resultados (por defecto benchmarks/<fecha>-<commit>.json).")
+@click.option("--comparar", "archivo_anterior", default=None, type=click.Path(exists=True),
+              help="Resultados anteriores contra los que comparar.")
+def main(**opciones):
+    rutas = [r.strip() for r in opciones["rutas"].split(",") if r.strip()]
+    desconocidas = set(rutas) - set(RUTAS)
+    if desconocidas:
+        raise click.BadParameter(f"rutas desconocidas: {', '.join(sorted(desconocidas))}", param_hint="--rutas")
+
+    motor = "postgres" if db.USE_POSTGRES else f"sqlite ({db.DB_SQLITE_PATH})"
+    click.echo(f"🌱 Sembrando {opciones['peluqueros']} peluqueros × {opciones['semanas']} semanas en {motor}")
+    ids, grilla = sembrar(opciones["peluqueros"], opciones["semanas"], opciones["ocupacion"],
+                          opciones["movimientos"], opciones["semilla"])
+
+    servidor = base = None
+    if opciones["modo"] == "http":
+        if opciones["url"]:
+            base = opciones["url"].rstrip("/")
+        else:
+            servidor, base = _servidor_local()
+
+    resultados = {
+        "commit": _commit_actual(),
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "motor": "postgres" if db.USE_POSTGRES else "sqlite",
+        "modo": opciones["modo"],
+        "parametros": {k: v for k, v in opciones.items() if k not in ("salida", "archivo_anterior", "url")},
+        "rutas": {},
+    }
+    try:
+        for ruta in rutas:
+            datos = medir_ruta(ruta, opciones, ids, grilla, base)
+            resultados["rutas"][ruta] = datos
+            click.echo(f"⏱️ {ruta:<20} p50 {datos['p50_ms']:>8.2f}  p95 {datos['p95_ms']:>8.2f}  p99 {datos['p99_ms']:>8.2f} ms"
+                  f"  {datos['peticiones_por_segundo']:>8.1f} pet/s  {datos['consultas_por_peticion']:>5.1f} consultas"
+                  f"  errores {datos['errores']}")
+            frio = datos["frio"]
+            click.echo(f"   {'(caché fría)':<20} p50 {frio['p50_ms']:>8.2f} ms"
+                  f"  {frio['consultas_por_peticion']:>5.1f} consultas  {frio['ms_bd_por_peticion']:>6.2f} ms en la base")
+    finally:
+        if servidor is not None:
+            servidor.shutdown()
+        conn = aplicacion.get_conn()
+        limpiar_notificaciones(conn.cursor())
+        conn.commit()
+        conn.close()
+
+    salida = opciones["salida"] or os.path.join(
+        "benchmarks", f"{date.today().isoformat()}-{resultados['commit']}.json")
+    os.makedirs(os.path.dirname(salida) or ".", exist_ok=True)
+    with open(salida, "w", encoding="utf-8") as f:
+        json.dump(resultados, f, ensure_ascii=False, indent=2)
+    click.echo(f"💾 Resultados en {salida}")
+
+    if opciones["archivo_anterior"]:
+        with open(opciones["archivo_anterior"], encoding="utf-8") as f:
+            comparar(json.load(f), resultados)
+
+    if any(d["errores"] for d in resultados["rutas"].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# cache.py
+import logging
+import os
+import pickle
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Si hay CACHE_URL (redis://...) y está instalado el paquete 'redis', la caché
+# se comparte entre todos los workers de gunicorn; si no, cada proceso usa la suya.
+CACHE_URL = os.getenv("CACHE_URL", "").strip()
+CACHE_TTL = int(os.getenv("CACHE_TTL", "30"))          # segundos
+CACHE_MAX_ITEMS = int(os.getenv("CACHE_MAX_ITEMS", "1000"))
+
+
+class CacheLocal:
+    """Caché en memoria del proceso, con vencimiento por clave y segura entre hilos."""
+
+    compartida = False  # las versiones no se ven desde otros workers
+
+    def __init__(self, max_items=CACHE_MAX_ITEMS):
+        self._datos = {}
+        self._contadores = {}
+        self._lock = threading.Lock()
+        self._max_items = max_items
+
+    def get(self, clave):
+        with self._lock:
+            item = self._datos.get(clave)
+            if item is None:
+                return None
+            valor, vence = item
+            if vence is not None and vence < time.monotonic():
+                del self._datos[clave]
+                return None
+            return valor
+
+    def set(self, clave, valor, ttl=CACHE_TTL):
+        vence = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            if len(self._datos) >= self._max_items and clave not in self._datos:
+                self._purgar()
+            self._datos[clave] = (valor, vence)
+
+    def delete(self, clave):
+        with self._lock:
+            self._datos.pop(clave, None)
+
+    def contador(self, clave):
+        with self._lock:
+            return self._contadores.get(clave, 0)
+
+    def incr(self, clave):
+        # Los contadores van aparte para que la purga nunca los descarte
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + 1
+            return self._contadores[clave]
+
+    def _purgar(self):
+        # Primero lo vencido; si no alcanza, lo más antiguo (los dict conservan el orden)
+        ahora = time.monotonic()
+        for clave in [k for k, (_, vence) in self._datos.items() if vence is not None and vence < ahora]:
+            del self._datos[clave]
+        while len(self._datos) >= self._max_items:
+            del self._datos[next(iter(self._datos))]
+
+
+class CacheRedis:
+    """Misma interfaz que CacheLocal, pero compartida entre procesos vía Redis."""
+
+    compartida = True
+
+    def __init__(self, url):
+        import redis
+        self._r = redis.Redis.from_url(url)
+
+    def get(self, clave):
+        crudo = self._r.get(clave)
+        return pickle.loads(crudo) if crudo is not None else None
+
+    def set(self, clave, valor, ttl=CACHE_TTL):
+        self._r.set(clave, pickle.dumps(valor), ex=ttl or None)
+
+    def delete(self, clave):
+        self._r.delete(clave)
+
+    def contador(self, clave):
+        return int(self._r.get(clave) or 0)
+
+    def incr(self, clave):
+        return self._r.incr(clave)
+
+
+def crear_cache():
+    if CACHE_URL:
+        try:
+            return CacheRedis(CACHE_URL)
+        except ImportError:
+            log.warning("⚠️ CACHE_URL definido pero falta el paquete 'redis'; usando caché local")
+    return CacheLocal()
+
+
+cache = crear_cache()
+
+
+def leer_o_calcular(clave, calcular, ttl=CACHE_TTL):
+    """Devuelve el valor en caché o lo calcula y lo guarda (read-through)."""
+    valor = cache.get(clave)
+    if valor is None:
+        valor = calcular()
+        cache.set(clave, valor, ttl)
+    return valor
+
+
+# ---------- Versiones para invalidar ----------
+# En lugar de borrar claves por patrón, cada peluquero tiene un contador de
+# versión que forma parte de la clave; al escribir se incrementa y las
+# entradas viejas simplemente dejan de leerse hasta que vencen.
+
+def version_peluquero(peluquero_id):
+    return f"{cache.contador('version:todos')}.{cache.contador(f'version:{peluquero_id}')}"
+
+
+def invalidar_peluquero(peluquero_id):
+    cache.incr(f"version:{peluquero_id}")
+
+
+def invalidar_todos():
+    cache.incr("version:todos")
+    cache.delete("peluqueros_publicos")
+
+
+def invalidar_lista_peluqueros():
+    cache.delete("peluqueros_publicos")
@@ -0,0 +1,51 @@
+# compresion.py
+import gzip
+import os
+
+# Compresión de respuestas dinámicas (HTML/JSON) según Accept-Encoding.
+# Brotli se usa solo si está instalado el paquete 'brotli'. Los archivos
+# estáticos y las respuestas en streaming (SSE, exportaciones) no pasan por aquí.
+
+COMPRESION_MIN = int(os.getenv("COMPRESION_MIN", "1024"))          # bytes
+COMPRESION_NIVEL_GZIP = int(os.getenv("COMPRESION_NIVEL_GZIP", "6"))
+COMPRESION_NIVEL_BR = int(os.getenv("COMPRESION_NIVEL_BR", "5"))
+COMPRESION_TIPOS = {"text/html", "application/json", "text/css", "text/plain",
+                    "application/javascript", "text/javascript", "image/svg+xml"}
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _elegir(accept_encoding):
+    aceptadas = {parte.split(";")[0].strip() for parte in (accept_encoding or "").split(",")}
+    if brotli is not None and "br" in aceptadas:
+        return "br"
+    if "gzip" in aceptadas:
+        return "gzip"
+    return None
+
+
+def comprimir_respuesta(resp, accept_encoding):
+    if (resp.status_code != 200 or resp.direct_passthrough or resp.is_streamed
+            or "Content-Encoding" in resp.headers or resp.mimetype not in COMPRESION_TIPOS):
+        return resp
+
+    resp.vary.add("Accept-Encoding")
+    codificacion = _elegir(accept_encoding)
+    datos = resp.get_data()
+    if codificacion is None or len(datos) < COMPRESION_MIN:
+        return resp
+
+    if codificacion == "br":
+        resp.set_data(brotli.compress(datos, quality=COMPRESION_NIVEL_BR))
+    else:
+        resp.set_data(gzip.compress(datos, compresslevel=COMPRESION_NIVEL_GZIP))
+    resp.headers["Content-Encoding"] = codificacion
+
+    # El cuerpo comprimido es otra representación: el ETag pasa a ser débil
+    etag, debil = resp.get_etag()
+    if etag and not debil:
+        resp.set_etag(etag, weak=True)
+    return resp
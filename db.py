@@ -1,76 +1,423 @@
 # db.py
+import logging
 import os
 import re
-import psycopg2
 import sqlite3
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from psycopg2.extras import execute_values
+
+import metricas
+
+log = logging.getLogger(__name__)
+
+# Capa de acceso a datos de la app. Dos motores:
+# - 'postgres' (producción): pool de conexiones por proceso sobre DATABASE_URL.
+# - 'sqlite': archivo local en modo WAL, para desarrollo y pruebas de carga
+#   sin ningún servicio externo (DB_BACKEND=sqlite).
+# Las consultas del flujo de reservas viven en repositorio.py y corren en
+# ambos; el resto de app.py (migraciones, contabilidad, tareas) es de Postgres.
 
-# Detectar si hay variable de entorno DATABASE_URL
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
-USE_POSTGRES = DATABASE_URL.startswith("postgres://") or DATABASE_URL.startswith("postgresql://")
+DB_BACKEND = os.getenv("DB_BACKEND", "postgres").strip().lower()
+DB_SQLITE_PATH = os.getenv("DB_SQLITE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "database.db"))
+DB_SQLITE_CACHE = int(os.getenv("DB_SQLITE_CACHE", "256"))  # sentencias preparadas por conexión
+USE_POSTGRES = DB_BACKEND == "postgres"
+
+# ---------- MEDICIÓN ----------
+# Consultas ejecutadas y segundos dentro de la base, acumulados por hilo (un
+# hilo atiende una petición a la vez). Quien quiera medir algo llama a
+# reiniciar_medicion() antes y lee medicion() después.
+DB_CONSULTA_LENTA_MS = float(os.getenv("DB_CONSULTA_LENTA_MS", "0"))  # 0 = no registrar consultas lentas
+
+_medicion = threading.local()
+
+CONSULTAS_LENTAS = metricas.Contador("barberia_consultas_lentas_total",
+                                     "Consultas que superaron DB_CONSULTA_LENTA_MS.")
+
+def reiniciar_medicion():
+    _medicion.consultas = 0
+    _medicion.segundos = 0.0
+
+def medicion():
+    """(consultas, segundos) desde el último reiniciar_medicion() en este hilo."""
+    return getattr(_medicion, "consultas", 0), getattr(_medicion, "segundos", 0.0)
+
+def _registrar(sql, segundos):
+    _medicion.consultas = getattr(_medicion, "consultas", 0) + 1
+    _medicion.segundos = getattr(_medicion, "segundos", 0.0) + segundos
+    if DB_CONSULTA_LENTA_MS and segundos * 1000 >= DB_CONSULTA_LENTA_MS:
+        CONSULTAS_LENTAS.sumar()
+        log.warning("🐢 Consulta lenta", extra={"datos": {"ms": round(segundos * 1000, 1),
+                                                        "sql": " ".join(str(sql).split())[:300]}})
+
+
+class CursorMedido(psycopg2.extensions.cursor):
+    """Cursor de psycopg2 que cuenta cada execute en la medición del hilo."""
+
+    def execute(self, sql, params=None):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            _registrar(sql, time.perf_counter() - inicio)
+
+    def executemany(self, sql, filas):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, filas)
+        finally:
+            _registrar(sql, time.perf_counter() - inicio)
+
+
+# ---------- POOL DE CONEXIONES (Postgres) ----------
+# Un pool por proceso (cada worker de gunicorn tiene el suyo), seguro entre hilos.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))            # segundos esperando un cupo libre
+DB_POOL_CHECK = os.getenv("DB_POOL_CHECK", "True").lower() == "true"  # SELECT 1 al prestar
+
+
+class ConexionPreparada(psycopg2.extensions.connection):
+    """Conexión de psycopg2 que recuerda qué sentencias ya preparó (PREPARE dura lo que la sesión)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparadas = set()
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault("cursor_factory", CursorMedido)
+        return super().cursor(*args, **kwargs)
+
+
+_pool = None
+_pool_pid = None
+_pool_cupos = None
+_pool_lock = threading.Lock()
+_pool_en_uso = 0
+
+def _contar_prestamo(delta):
+    global _pool_en_uso
+    with _pool_lock:
+        _pool_en_uso += delta
+
+metricas.Medidor("barberia_pool_conexiones_en_uso", "Conexiones del pool prestadas en este momento.",
+                 lambda: _pool_en_uso)
+metricas.Medidor("barberia_pool_conexiones_max", "Tamaño máximo del pool (DB_POOL_MAX).", lambda: DB_POOL_MAX)
+ESPERA_POOL = metricas.Histograma("barberia_pool_espera_segundos", "Espera por un cupo libre del pool.",
+                                  limites=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10))
+
+def get_pool():
+    """Devuelve el pool del proceso actual; lo crea (o recrea tras un fork) la primera vez."""
+    global _pool, _pool_pid, _pool_cupos
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                database_url = os.getenv("DATABASE_URL")
+                if not database_url:
+                    raise Exception("❌ No se encontró la variable DATABASE_URL")
+                # Las conexiones heredadas del proceso padre no se cierran aquí:
+                # cerrarlas terminaría también las sesiones del padre.
+                _pool = psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, database_url,
+                                                             connection_factory=ConexionPreparada)
+                _pool_cupos = threading.BoundedSemaphore(DB_POOL_MAX)
+                _pool_pid = os.getpid()
+    return _pool
+
+def _conexion_sana(conn):
+    if conn.closed:
+        return False
+    if not DB_POOL_CHECK:
+        return True
+    try:
+        c = conn.cursor()
+        c.execute("SELECT 1")
+        c.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _tomar_conexion_pool():
+    pool = get_pool()
+    cupos = _pool_cupos
+    # ThreadedConnectionPool lanza error si está agotado; el semáforo hace que se espere.
+    inicio = time.perf_counter()
+    obtenido = cupos.acquire(timeout=DB_POOL_TIMEOUT)
+    ESPERA_POOL.observar(time.perf_counter() - inicio)
+    if not obtenido:
+        raise psycopg2.pool.PoolError("❌ Pool de conexiones agotado")
+    _contar_prestamo(1)
+    try:
+        for _ in range(DB_POOL_MAX + 1):
+            conn = pool.getconn()
+            if _conexion_sana(conn):
+                return ConexionPool(conn, pool, cupos)
+            pool.putconn(conn, close=True)
+        raise psycopg2.pool.PoolError("❌ No se pudo obtener una conexión sana")
+    except Exception:
+        _contar_prestamo(-1)
+        cupos.release()
+        raise
+
+class ConexionPool:
+    """
+    Conexión prestada por el pool. Se usa igual que una conexión de psycopg2,
+    pero close() la devuelve al pool en lugar de cerrarla.
+    """
+
+    def __init__(self, conn, pool, cupos):
+        self._conn = conn
+        self._pool = pool
+        self._cupos = cupos
+        self._en_request = False
+        self._devuelta = False
+
+    def __getattr__(self, nombre):
+        return getattr(self._conn, nombre)
+
+    def __enter__(self):
+        return self._conn.__enter__()
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def close(self):
+        # Dentro de un request se devuelve en el teardown, así las rutas que
+        # piden get_conn() varias veces reutilizan la misma conexión.
+        if not self._en_request:
+            self.devolver()
+
+    def devolver(self):
+        if self._devuelta:
+            return
+        self._devuelta = True
+        descartar = self._conn.closed
+        if not descartar:
+            try:
+                self._conn.rollback()  # lo que no se confirmó no pasa a la siguiente petición
+            except psycopg2.Error:
+                descartar = True
+        try:
+            self._pool.putconn(self._conn, close=descartar)
+        finally:
+            _contar_prestamo(-1)
+            self._cupos.release()
+
+    def __del__(self):
+        # Red de seguridad para hilos que no llegan al close() por una excepción
+        try:
+            self.devolver()
+        except Exception:
+            pass
+
+
+# ---------- SQLITE (modo WAL) ----------
+
+_MARCA_PSYCOPG = re.compile(r"%%|%\((\w+)\)s|%s")
+
+def _marca_sqlite(m):
+    if m.group(0) == "%%":
+        return "%"
+    return f":{m.group(1)}" if m.group(1) else "?"
+
+def sql_sqlite(sql):
+    """Placeholders de psycopg2 (%s, %(nombre)s, %%) al estilo de sqlite3 (?, :nombre, %)."""
+    return _MARCA_PSYCOPG.sub(_marca_sqlite, sql)
+
+
+class CursorSqlite:
+    """Cursor de sqlite3 que acepta el SQL con placeholders de psycopg2."""
+
+    def __init__(self, cur):
+        self._cur = cur
+
+    def __getattr__(self, nombre):
+        return getattr(self._cur, nombre)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def execute(self, sql, params=()):
+        inicio = time.perf_counter()
+        try:
+            self._cur.execute(sql_sqlite(sql), params or ())
+        finally:
+            _registrar(sql, time.perf_counter() - inicio)
+        return self
+
+    def executemany(self, sql, filas):
+        inicio = time.perf_counter()
+        try:
+            self._cur.executemany(sql_sqlite(sql), filas)
+        finally:
+            _registrar(sql, time.perf_counter() - inicio)
+        return self
+
+
+class ConexionSqlite:
+    """
+    Conexión SQLite del hilo, reutilizada entre peticiones (como una del pool):
+    close() solo descarta lo no confirmado. sqlite3 guarda hasta
+    DB_SQLITE_CACHE sentencias ya preparadas por conexión.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._en_request = False
+
+    def __getattr__(self, nombre):
+        return getattr(self._conn, nombre)
+
+    def cursor(self, name=None):
+        return CursorSqlite(self._conn.cursor())
+
+    def close(self):
+        if not self._en_request:
+            self.devolver()
+
+    def devolver(self):
+        self._conn.rollback()
+
+
+_sqlite_local = threading.local()
+
+def _tomar_conexion_sqlite():
+    conn = getattr(_sqlite_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_SQLITE_PATH, timeout=DB_POOL_TIMEOUT, check_same_thread=False,
+                               cached_statements=DB_SQLITE_CACHE,
+                               detect_types=sqlite3.PARSE_DECLTYPES)
+        # WAL: los lectores no bloquean al escritor (y viceversa)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        _sqlite_local.conn = conn
+    return ConexionSqlite(conn)
+
+
+def tomar_conexion():
+    """Conexión del motor configurado; close() la devuelve (no la cierra)."""
+    return _tomar_conexion_pool() if USE_POSTGRES else _tomar_conexion_sqlite()
 
-def get_conn():
-    """Devuelve conexión según el entorno: PostgreSQL si hay DATABASE_URL, SQLite si no."""
-    if USE_POSTGRES:
-        return psycopg2.connect(DATABASE_URL, sslmode="require")
-    else:
-        db_path = os.path.join(os.path.dirname(__file__), "database.db")
-        return sqlite3.connect(db_path, check_same_thread=False)
 
 _qmark_pattern = re.compile(r'\?')
 
 def adapt_query(sql: str) -> str:
-    """Convierte placeholders '?' → '%s' solo cuando usamos PostgreSQL."""
+    """Convierte placeholders '?' → '%s' (el cursor de SQLite vuelve a traducirlos)."""
+    return _qmark_pattern.sub('%s', sql)
+
+
+def insertar_varios(c, sql, filas):
+    """
+    INSERT multi-fila: 'sql' lleva 'VALUES %s'. En Postgres va en una sola
+    sentencia (execute_values); en SQLite se repite la sentencia preparada.
+    """
     if USE_POSTGRES:
-        return _qmark_pattern.sub('%s', sql)
-    return sql
+        execute_values(c, sql, filas, page_size=len(filas))
+    else:
+        marcas = "(" + ", ".join(["?"] * len(filas[0])) + ")"
+        c.executemany(sql.replace("VALUES %s", f"VALUES {marcas}"), filas)
 
-def init_schema():
-    """Crea tablas y asegura un admin por defecto."""
-    conn = get_conn()
-    c = conn.cursor()
 
-    # Peluqueros
-    c.execute(adapt_query("""
+def ejecutar_preparada(c, nombre, sql, params=()):
+    """
+    Ejecuta 'sql' (con $1, $2...) como sentencia preparada. En Postgres se
+    hace PREPARE una vez por conexión y luego EXECUTE; en SQLite la caché de
+    sentencias de sqlite3 ya cumple ese papel.
+    """
+    if not USE_POSTGRES:
+        c.execute(re.sub(r"\$(\d+)", r"?\1", sql), params)
+        return c
+    conn = c.connection
+    if nombre not in conn.preparadas:
+        c.execute(f"PREPARE {nombre} AS {sql}")
+        conn.preparadas.add(nombre)
+    if params:
+        c.execute(f"EXECUTE {nombre} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        c.execute(f"EXECUTE {nombre}")
+    return c
+
+
+# ---------- ESQUEMA SQLITE ----------
+# Lo que necesita el flujo de reservas (portada, calendario, agendar) y los
+# turnos de prueba; en Postgres el esquema lo manejan init_schema/migrar_schema.
+
+ESQUEMA_SQLITE = [
+    """
     CREATE TABLE IF NOT EXISTS peluqueros (
-        id SERIAL PRIMARY KEY,
-        nombre VARCHAR(100) NOT NULL,
-        password VARCHAR(100) NOT NULL,
-        foto VARCHAR(255),
-        es_admin BOOLEAN DEFAULT FALSE
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nombre TEXT NOT NULL,
+        usuario TEXT UNIQUE,
+        password TEXT NOT NULL,
+        foto TEXT,
+        es_admin INTEGER DEFAULT 0,
+        telefono TEXT,
+        porcentaje NUMERIC DEFAULT 50
     )
-    """))
-
-    # Horarios
-    c.execute(adapt_query("""
+    """,
+    """
     CREATE TABLE IF NOT EXISTS horarios (
-        id SERIAL PRIMARY KEY,
-        peluquero_id INTEGER NOT NULL,
-        dia VARCHAR(20) NOT NULL,
-        hora VARCHAR(5) NOT NULL,
-        UNIQUE(peluquero_id, dia, hora)
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        peluquero_id INTEGER NOT NULL REFERENCES peluqueros(id) ON DELETE CASCADE,
+        dia TEXT NOT NULL,
+        hora TEXT NOT NULL,
+        fecha DATE,
+        bloqueado BOOLEAN DEFAULT 0
     )
-    """))
-
-    # Citas
-    c.execute(adapt_query("""
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_horarios_base ON horarios (peluquero_id, dia, hora) WHERE fecha IS NULL",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_horarios_fecha ON horarios (peluquero_id, dia, hora, fecha)",
+    """
     CREATE TABLE IF NOT EXISTS citas (
-        id SERIAL PRIMARY KEY,
-        peluquero_id INTEGER NOT NULL,
-        dia VARCHAR(20) NOT NULL,
-        hora VARCHAR(5) NOT NULL,
-        nombre VARCHAR(100) NOT NULL,
-        telefono VARCHAR(30),
-        UNIQUE(peluquero_id, dia, hora)
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        peluquero_id INTEGER NOT NULL REFERENCES peluqueros(id) ON DELETE CASCADE,
+        dia TEXT NOT NULL,
+        hora TEXT NOT NULL,
+        fecha DATE,
+        nombre TEXT NOT NULL,
+        telefono TEXT NOT NULL,
+        fijo BOOLEAN DEFAULT 0,
+        recordatorio_enviado BOOLEAN DEFAULT 0
     )
-    """))
-
-    # Crear admin por defecto
-    c.execute(adapt_query("SELECT COUNT(*) FROM peluqueros WHERE es_admin = ?"), (True,))
-    count = c.fetchone()[0]
-    if count == 0:
-        c.execute(adapt_query(
-            "INSERT INTO peluqueros (nombre, password, es_admin) VALUES (?, ?, ?)"
-        ), ("admin", "admin", True))
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_citas_peluquero_fecha_hora ON citas (peluquero_id, fecha, hora)",
+    """
+    CREATE TABLE IF NOT EXISTS contabilidad (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        peluquero_id INTEGER REFERENCES peluqueros(id) ON DELETE CASCADE,
+        nombre_peluquero TEXT,
+        tipo TEXT,
+        categoria TEXT,
+        descripcion TEXT,
+        nombre_item TEXT,
+        valor NUMERIC,
+        fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_contabilidad_peluquero_fecha ON contabilidad (peluquero_id, fecha)",
+    """
+    CREATE TABLE IF NOT EXISTS notificaciones (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        destinatario TEXT NOT NULL,
+        mensaje TEXT NOT NULL,
+        intentos INTEGER NOT NULL DEFAULT 0,
+        proximo_intento TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        enviado_en TIMESTAMP,
+        fallido_en TIMESTAMP,
+        error TEXT,
+        creado_en TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+]
 
+def crear_esquema_sqlite():
+    conn = _tomar_conexion_sqlite()
+    for sql in ESQUEMA_SQLITE:
+        conn.execute(sql)
     conn.commit()
-    conn.close()
\ No newline at end of file
@@ -0,0 +1,114 @@
+# estaticos.py
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+# Huellas de los archivos de /static: url_for('static', ...) agrega ?v=<hash
+# del contenido> y esas URLs se sirven con caché de un año ('immutable'),
+# porque si el archivo cambia cambia la URL. Si existen variantes .br/.gz
+# (ver 'flask comprimir-estaticos') se sirven según Accept-Encoding.
+
+ESTATICOS_MAX_AGE = int(os.getenv("ESTATICOS_MAX_AGE", str(365 * 24 * 3600)))
+COMPRIMIBLES = {".css", ".js", ".svg", ".json", ".txt", ".html", ".xml", ".map"}
+
+# Fotos procesadas por imagenes.py: el hash ya va en el nombre
+_NOMBRE_CON_HASH = re.compile(r"(^|/)[0-9a-f]{16}-\d+\.(jpg|webp)$")
+
+_huellas = {}   # ruta relativa -> (mtime, hash)
+_lock = threading.Lock()
+
+
+def _calcular(ruta):
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for bloque in iter(lambda: f.read(65536), b""):
+            h.update(bloque)
+    return h.hexdigest()[:12]
+
+
+def huella(carpeta, archivo):
+    """Hash corto del contenido de carpeta/archivo (None si no existe); se recalcula si cambia el mtime."""
+    ruta = os.path.join(carpeta, archivo)
+    try:
+        mtime = os.stat(ruta).st_mtime
+    except OSError:
+        return None
+    with _lock:
+        guardada = _huellas.get(archivo)
+    if guardada and guardada[0] == mtime:
+        return guardada[1]
+    valor = _calcular(ruta)
+    with _lock:
+        _huellas[archivo] = (mtime, valor)
+    return valor
+
+
+def recorrer(carpeta):
+    """Rutas relativas (con '/') de todos los archivos bajo 'carpeta', sin las variantes comprimidas."""
+    for raiz, _, archivos in os.walk(carpeta):
+        for nombre in archivos:
+            if nombre.endswith((".gz", ".br")):
+                continue
+            yield os.path.relpath(os.path.join(raiz, nombre), carpeta).replace(os.sep, "/")
+
+
+def precalcular(carpeta):
+    """Paso de arranque: calcula todas las huellas para que la primera página no pague el costo."""
+    for archivo in recorrer(carpeta):
+        huella(carpeta, archivo)
+    return len(_huellas)
+
+
+def es_inmutable(carpeta, archivo, version):
+    """True si la URL pedida identifica el contenido exacto (huella vigente o nombre con hash)."""
+    if _NOMBRE_CON_HASH.search(archivo):
+        return True
+    return version is not None and version == huella(carpeta, archivo)
+
+
+def variante_comprimida(carpeta, archivo, accept_encoding):
+    """(archivo.br|archivo.gz, codificación) si hay una variante precomprimida aceptable, si no (None, None)."""
+    aceptadas = {parte.split(";")[0].strip() for parte in (accept_encoding or "").split(",")}
+    ruta = os.path.join(carpeta, archivo)
+    for codificacion, extension in (("br", ".br"), ("gzip", ".gz")):
+        if codificacion not in aceptadas:
+            continue
+        try:
+            # Una variante más vieja que el original quedó desactualizada: no usarla
+            if os.stat(ruta + extension).st_mtime >= os.stat(ruta).st_mtime:
+                return archivo + extension, codificacion
+        except OSError:
+            continue
+    return None, None
+
+
+def comprimir(carpeta):
+    """Genera .gz (y .br si está el paquete 'brotli') junto a los archivos de texto. Devuelve cuántos escribió."""
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+    escritos = 0
+    for archivo in recorrer(carpeta):
+        if os.path.splitext(archivo)[1].lower() not in COMPRIMIBLES:
+            continue
+        ruta = os.path.join(carpeta, archivo)
+        with open(ruta, "rb") as f:
+            datos = f.read()
+        if not datos:
+            continue
+        with open(ruta + ".gz", "wb") as f:
+            f.write(gzip.compress(datos, compresslevel=9, mtime=0))
+        escritos += 1
+        if brotli is not None:
+            with open(ruta + ".br", "wb") as f:
+                f.write(brotli.compress(datos, quality=11))
+            escritos += 1
+    return escritos
+
+
+def tipo_mime(archivo):
+    return mimetypes.guess_type(archivo)[0] or "application/octet-stream"
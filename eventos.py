@@ -0,0 +1,172 @@
+# eventos.py
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+
+import db
+from cache import cache, invalidar_peluquero, invalidar_todos
+
+log = logging.getLogger(__name__)
+
+# Avisos en tiempo real de cambios de horarios, por peluquero y semana.
+# Cada proceso reparte los avisos entre sus suscriptores (colas en memoria);
+# con EVENTOS_BACKEND=postgres (por defecto) los avisos viajan entre procesos
+# con LISTEN/NOTIFY, con 'local' (por defecto con SQLite) se quedan en el proceso.
+# Con la caché local (sin Redis) el mismo aviso invalida también la caché de
+# cada worker: si no, los demás procesos seguirían sirviendo horarios y ETags
+# viejos hasta que venciera el TTL.
+
+EVENTOS_BACKEND = os.getenv("EVENTOS_BACKEND", "postgres" if db.USE_POSTGRES else "local").strip().lower()
+if EVENTOS_BACKEND == "local" and db.USE_POSTGRES and not cache.compartida:
+    log.warning("⚠️ EVENTOS_BACKEND=local con caché local: con varios workers los cambios "
+                "de un proceso no invalidan la caché de los demás (usar CACHE_URL o 'postgres')")
+EVENTOS_CANAL = "barberia_horarios"
+EVENTOS_LATIDO = float(os.getenv("EVENTOS_LATIDO", "25"))               # segundos entre comentarios keep-alive
+EVENTOS_DURACION = float(os.getenv("EVENTOS_DURACION", "300"))          # el navegador reconecta solo al vencer
+
+# Con gunicorn gthread cada flujo abierto ocupa un hilo del worker mientras
+# dure: el cupo de suscriptores sale de los hilos (WEB_HILOS, el --threads del
+# Procfile) menos los que se reservan para las peticiones normales. Sin cupo
+# la ruta responde 503 y la página del cliente sondea la API con ETag.
+WEB_HILOS = int(os.getenv("WEB_HILOS", "8"))
+EVENTOS_HILOS_LIBRES = int(os.getenv("EVENTOS_HILOS_LIBRES", "4"))
+_cupo_hilos = max(WEB_HILOS - EVENTOS_HILOS_LIBRES, 0)
+EVENTOS_MAX_SUSCRIPTORES = int(os.getenv("EVENTOS_MAX_SUSCRIPTORES", str(_cupo_hilos)))  # por proceso
+if EVENTOS_MAX_SUSCRIPTORES > _cupo_hilos:
+    log.warning("⚠️ EVENTOS_MAX_SUSCRIPTORES=%s dejaría sin hilos a las peticiones normales "
+                "(WEB_HILOS=%s, EVENTOS_HILOS_LIBRES=%s); se usa %s",
+                EVENTOS_MAX_SUSCRIPTORES, WEB_HILOS, EVENTOS_HILOS_LIBRES, _cupo_hilos)
+    EVENTOS_MAX_SUSCRIPTORES = _cupo_hilos
+
+
+_suscriptores = {}          # peluquero_id -> {cola: semana_inicio}
+_oyentes = []               # funciones(peluquero_id, semana) llamadas con cada aviso
+_lock = threading.Lock()
+_escucha = None
+
+
+def suscribir(peluquero_id, semana_inicio):
+    """Devuelve una cola que recibe los avisos del peluquero para esa semana, o None si no hay cupo."""
+    iniciar_escucha()
+    cola = queue.Queue(maxsize=100)
+    with _lock:
+        if sum(len(colas) for colas in _suscriptores.values()) >= EVENTOS_MAX_SUSCRIPTORES:
+            return None
+        _suscriptores.setdefault(peluquero_id, {})[cola] = semana_inicio
+    return cola
+
+
+def desuscribir(peluquero_id, cola):
+    with _lock:
+        colas = _suscriptores.get(peluquero_id, {})
+        colas.pop(cola, None)
+        if not colas:
+            _suscriptores.pop(peluquero_id, None)
+
+
+def al_avisar(funcion):
+    """Llama a 'funcion(peluquero_id, semana)' con cada aviso, sea de este proceso o de otro."""
+    _oyentes.append(funcion)
+
+
+def _entregar(peluquero_id, semana):
+    """Pone el aviso en las colas del peluquero; semana=None afecta a todas sus semanas."""
+    for funcion in _oyentes:
+        funcion(peluquero_id, semana)
+    aviso = {"peluquero_id": peluquero_id, "semana": semana}
+    with _lock:
+        colas = [cola for cola, semana_cola in _suscriptores.get(peluquero_id, {}).items()
+                 if semana is None or semana == semana_cola]
+    for cola in colas:
+        try:
+            cola.put_nowait(aviso)
+        except queue.Full:
+            pass  # el cliente ya tiene avisos sin leer; con uno basta para recargar
+
+
+def publicar(get_conn, peluquero_id, semana=None):
+    """
+    Avisa que cambiaron los horarios del peluquero ('semana' = lunes en
+    formato ISO, o None si pueden ser varias). Llamar después del commit.
+    Los avisos son de mejor esfuerzo: un error aquí nunca tumba la petición.
+    """
+    peluquero_id = int(peluquero_id)
+    if EVENTOS_BACKEND == "local":
+        _entregar(peluquero_id, semana)
+        return
+    try:
+        conn = get_conn()
+        c = conn.cursor()
+        c.execute("SELECT pg_notify(%s, %s)",
+                  (EVENTOS_CANAL, json.dumps({"peluquero_id": peluquero_id, "semana": semana})))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        log.warning("⚠️ No se pudo publicar el cambio de horarios del peluquero %s: %s", peluquero_id, e)
+
+
+# ---------- Escucha de LISTEN/NOTIFY ----------
+
+def iniciar_escucha():
+    """Arranca (una vez por proceso) el hilo que escucha el canal de Postgres."""
+    global _escucha
+    if EVENTOS_BACKEND == "local":
+        return
+    with _lock:
+        if _escucha is None or not _escucha.is_alive():
+            _escucha = threading.Thread(target=_escuchar, daemon=True)
+            _escucha.start()
+
+
+def _escuchar():
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(os.getenv("DATABASE_URL"))
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {EVENTOS_CANAL}")
+            if not cache.compartida:
+                invalidar_todos()  # lo que cambió mientras no se escuchaba
+            while True:
+                if select.select([conn], [], [], EVENTOS_LATIDO) == ([], [], []):
+                    conn.cursor().execute("SELECT 1")  # comprobar que la conexión sigue viva
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    aviso = json.loads(conn.notifies.pop(0).payload)
+                    if not cache.compartida:
+                        invalidar_peluquero(aviso["peluquero_id"])
+                    _entregar(aviso["peluquero_id"], aviso.get("semana"))
+        except Exception as e:
+            log.warning("⚠️ Escucha de eventos de horarios caída, reintentando: %s", e)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        time.sleep(5)
+
+
+# ---------- Server-sent events ----------
+
+def flujo_sse(peluquero_id, semana_inicio, cola):
+    """Generador del cuerpo text/event-stream; libera la suscripción al terminar."""
+    vence = time.monotonic() + EVENTOS_DURACION
+    try:
+        yield "retry: 3000\n\n"
+        while time.monotonic() < vence:
+            try:
+                aviso = cola.get(timeout=EVENTOS_LATIDO)
+            except queue.Empty:
+                yield ": latido\n\n"
+                continue
+            yield f"event: cambio\ndata: {json.dumps(aviso)}\n\n"
+    finally:
+        desuscribir(peluquero_id, cola)
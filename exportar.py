@@ -0,0 +1,148 @@
+# exportar.py
+import csv
+import io
+import os
+
+# Exportaciones para el contador: las filas se leen con un cursor con nombre
+# (del lado del servidor) en lotes de EXPORT_LOTE, así que la memoria usada
+# no depende de cuántos años de datos se exporten.
+
+EXPORT_LOTE = int(os.getenv("EXPORT_LOTE", "2000"))
+
+# Cada consulta recibe %(desde)s y %(hasta)s (fechas o None)
+EXPORTACIONES = {
+    "citas": """
+        SELECT ci.id, ci.peluquero_id, p.nombre AS peluquero, ci.fecha, ci.dia, ci.hora,
+               ci.nombre AS cliente, ci.telefono, ci.fijo
+        FROM citas ci
+        LEFT JOIN peluqueros p ON p.id = ci.peluquero_id
+        WHERE (%(desde)s::date IS NULL OR ci.fecha >= %(desde)s)
+          AND (%(hasta)s::date IS NULL OR ci.fecha <= %(hasta)s)
+        ORDER BY ci.fecha, ci.hora_t, ci.id
+    """,
+    "contabilidad": """
+        SELECT m.id, m.peluquero_id, p.nombre AS peluquero, m.fecha, m.tipo, m.categoria,
+               m.descripcion, m.valor
+        FROM contabilidad m
+        LEFT JOIN peluqueros p ON p.id = m.peluquero_id
+        WHERE (%(desde)s::date IS NULL OR m.fecha >= %(desde)s)
+          AND (%(hasta)s::date IS NULL OR m.fecha < %(hasta)s::date + 1)
+        ORDER BY m.fecha, m.id
+    """,
+    "contabilidad_historial": """
+        SELECT semana_inicio, semana_fin, peluquero_id, nombre_peluquero, tipo, categoria,
+               nombre_item, valor, fecha
+        FROM contabilidad_historial
+        WHERE (%(desde)s::date IS NULL OR semana_inicio >= %(desde)s)
+          AND (%(hasta)s::date IS NULL OR semana_inicio <= %(hasta)s)
+        ORDER BY semana_inicio, id
+    """,
+}
+
+
+# OID del tipo de Postgres -> tipo de Arrow para el esquema del Parquet; lo
+# que no esté aquí se exporta como texto
+_TIPOS_PARQUET = {
+    16: lambda pa, col: pa.bool_(),
+    20: lambda pa, col: pa.int64(),
+    21: lambda pa, col: pa.int16(),
+    23: lambda pa, col: pa.int32(),
+    25: lambda pa, col: pa.string(),
+    700: lambda pa, col: pa.float32(),
+    701: lambda pa, col: pa.float64(),
+    1042: lambda pa, col: pa.string(),
+    1043: lambda pa, col: pa.string(),
+    1082: lambda pa, col: pa.date32(),
+    1083: lambda pa, col: pa.time64("us"),
+    1114: lambda pa, col: pa.timestamp("us"),
+    1184: lambda pa, col: pa.timestamp("us", tz="UTC"),
+    # NUMERIC sin precisión declarada (como 'valor', que psycopg2 reporta
+    # como 65535): hasta 10 decimales
+    1700: lambda pa, col: (pa.decimal128(col.precision, col.scale) if 0 < (col.precision or 0) <= 38
+                           else pa.decimal128(38, 10)),
+}
+
+
+def lotes(conn, nombre, desde=None, hasta=None, lote=EXPORT_LOTE):
+    """
+    Genera primero la descripción de las columnas (cursor.description) y
+    después las filas en lotes. El cursor con nombre necesita una
+    transacción abierta: no usar con una conexión en autocommit.
+    """
+    c = conn.cursor(name=f"exportar_{nombre}")
+    c.itersize = lote
+    try:
+        c.execute(EXPORTACIONES[nombre], {"desde": desde, "hasta": hasta})
+        bloque = c.fetchmany(lote)
+        yield c.description
+        while bloque:
+            yield bloque
+            bloque = c.fetchmany(lote)
+    finally:
+        c.close()
+        conn.rollback()  # solo lectura; cierra la transacción del cursor
+
+
+def csv_en_trozos(conn, nombre, desde=None, hasta=None):
+    """Texto CSV en trozos (uno por lote), para una respuesta de Flask en streaming."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    datos = lotes(conn, nombre, desde, hasta)
+    writer.writerow([col.name for col in next(datos)])
+    for bloque in datos:
+        writer.writerows(bloque)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def escribir_csv(conn, nombre, archivo, desde=None, hasta=None):
+    """Escribe el CSV en 'archivo' y devuelve cuántas filas exportó (sin el encabezado)."""
+    writer = csv.writer(archivo)
+    datos = lotes(conn, nombre, desde, hasta)
+    writer.writerow([col.name for col in next(datos)])
+    filas = 0
+    for bloque in datos:
+        writer.writerows(bloque)
+        filas += len(bloque)
+    return filas
+
+
+def escribir_parquet(conn, nombre, ruta, desde=None, hasta=None):
+    """
+    Parquet por lotes (un row group por lote). El esquema sale de los tipos
+    de las columnas, no de los valores: una columna toda NULL en el primer
+    lote no queda con tipo null, y sin filas se escribe igual el archivo con
+    su esquema. Devuelve cuántas filas exportó. Requiere el paquete opcional
+    'pyarrow'.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Para exportar a Parquet instala el paquete 'pyarrow'")
+
+    datos = lotes(conn, nombre, desde, hasta)
+    filas = 0
+    try:
+        descripcion = next(datos)
+        como_texto = [col.type_code not in _TIPOS_PARQUET for col in descripcion]
+        schema = pa.schema([
+            (col.name, pa.string() if texto else _TIPOS_PARQUET[col.type_code](pa, col))
+            for col, texto in zip(descripcion, como_texto)
+        ])
+        with pq.ParquetWriter(ruta, schema) as writer:
+            for bloque in datos:
+                columnas = [
+                    [None if v is None else str(v) for v in valores] if texto else list(valores)
+                    for valores, texto in zip(zip(*bloque), como_texto)
+                ]
+                writer.write_table(pa.Table.from_arrays(
+                    [pa.array(valores, type=campo.type) for valores, campo in zip(columnas, schema)],
+                    schema=schema))
+                filas += len(bloque)
+    finally:
+        datos.close()  # cierra el cursor aunque falle a mitad
+    return filas
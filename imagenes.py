@@ -0,0 +1,105 @@
+# imagenes.py
+import hashlib
+import io
+import os
+import re
+
+# Fotos de peluqueros: cada subida se recorta en cuadrado y se guarda en
+# varios anchos, en JPEG y WebP, con el hash del contenido en el nombre
+# (<hash>-<ancho>.jpg / .webp). Como el nombre cambia si cambia la imagen,
+# los archivos se pueden servir con caché de largo plazo.
+# Sin Pillow instalado se guarda el original, igual con nombre por hash.
+# Solo se aceptan JPEG, PNG, GIF y WebP: la extensión del archivo guardado
+# sale del contenido, nunca de lo que mande el cliente.
+
+IMG_ANCHOS = [int(a) for a in os.getenv("IMG_ANCHOS", "150,300,600").split(",")]
+IMG_ANCHO_PRINCIPAL = int(os.getenv("IMG_ANCHO_PRINCIPAL", "300"))  # el que queda en peluqueros.foto
+IMG_CALIDAD = int(os.getenv("IMG_CALIDAD", "80"))
+
+_VARIANTE = re.compile(r"^(?P<base>.*/[0-9a-f]{16})-(?P<ancho>\d+)\.jpg$")
+
+EXTENSIONES = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+TIPOS_CONTENIDO = {"image/jpeg", "image/pjpeg", "image/png", "image/gif", "image/webp"}
+FORMATOS_PIL = ["JPEG", "PNG", "GIF", "WEBP"]
+
+
+class FotoInvalida(ValueError):
+    """La subida no es una imagen JPEG, PNG, GIF o WebP legible."""
+
+
+def _hash(datos):
+    return hashlib.sha256(datos).hexdigest()[:16]
+
+
+def _extension_por_contenido(datos):
+    """Extensión según los primeros bytes, o None si no es un formato aceptado."""
+    if datos.startswith(b"\xff\xd8\xff"):
+        return ".jpg"
+    if datos.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if datos[:6] in (b"GIF87a", b"GIF89a"):
+        return ".gif"
+    if datos[:4] == b"RIFF" and datos[8:12] == b"WEBP":
+        return ".webp"
+    return None
+
+
+def procesar_foto(datos, carpeta, url_carpeta):
+    """
+    Guarda las variantes de la foto ('datos' en bytes) en 'carpeta' y devuelve
+    la URL de la variante principal para guardar en peluqueros.foto.
+    Si los archivos ya existen (misma imagen) no se vuelven a generar.
+    Lanza FotoInvalida si los datos no son una imagen aceptada o están dañados.
+    """
+    extension = _extension_por_contenido(datos)
+    if extension is None:
+        raise FotoInvalida("formato no soportado")
+    nombre = _hash(datos)
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        archivo = f"{nombre}{extension}"
+        ruta = os.path.join(carpeta, archivo)
+        if not os.path.exists(ruta):
+            with open(ruta, "wb") as f:
+                f.write(datos)
+        return f"{url_carpeta}/{archivo}"
+
+    anchos = sorted(set(IMG_ANCHOS) | {IMG_ANCHO_PRINCIPAL})
+    pendientes = [a for a in anchos
+                  if not os.path.exists(os.path.join(carpeta, f"{nombre}-{a}.webp"))]
+    if pendientes:
+        try:
+            imagen = ImageOps.exif_transpose(Image.open(io.BytesIO(datos), formats=FORMATOS_PIL)).convert("RGB")
+        except (OSError, Image.DecompressionBombError) as e:  # UnidentifiedImageError es un OSError
+            raise FotoInvalida(str(e)) from e
+        for ancho in pendientes:
+            # Recorte centrado en cuadrado: las plantillas muestran la foto en un círculo
+            variante = ImageOps.fit(imagen, (ancho, ancho), Image.LANCZOS)
+            variante.save(os.path.join(carpeta, f"{nombre}-{ancho}.jpg"), "JPEG",
+                          quality=IMG_CALIDAD, optimize=True, progressive=True)
+            variante.save(os.path.join(carpeta, f"{nombre}-{ancho}.webp"), "WEBP",
+                          quality=IMG_CALIDAD, method=6)
+    return f"{url_carpeta}/{nombre}-{IMG_ANCHO_PRINCIPAL}.jpg"
+
+
+def procesar_subida(archivo, carpeta, url_carpeta):
+    """
+    Como procesar_foto() pero para un FileStorage de Flask (request.files);
+    antes rechaza extensiones y tipos de contenido que no sean de imagen.
+    """
+    extension = os.path.splitext(archivo.filename or "")[1].lower()
+    if extension not in EXTENSIONES or archivo.mimetype not in TIPOS_CONTENIDO:
+        raise FotoInvalida(f"tipo no permitido ({extension or 'sin extensión'}, {archivo.mimetype})")
+    return procesar_foto(archivo.read(), carpeta, url_carpeta)
+
+
+def srcset(foto, formato="jpg"):
+    """
+    Valor de srcset ("url 150w, url 300w, ...") para una foto procesada, o ""
+    si la foto es anterior al procesamiento (nombre sin hash ni ancho).
+    """
+    m = _VARIANTE.match(foto or "")
+    if not m:
+        return ""
+    return ", ".join(f"{m.group('base')}-{ancho}.{formato} {ancho}w" for ancho in sorted(IMG_ANCHOS))
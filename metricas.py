@@ -0,0 +1,151 @@
+# metricas.py
+import bisect
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Métricas en el formato de texto de Prometheus, sin dependencias: contadores,
+# histogramas y medidores que se leen al exponer. Son por proceso (cada
+# worker de gunicorn tiene las suyas); Prometheus las suma al consultarlas.
+# El proceso web las expone en /metrics y worker.py, si METRICAS_PUERTO está
+# definido, en un puerto propio.
+
+METRICAS_TOKEN = os.getenv("METRICAS_TOKEN", "").strip()   # si se define, /metrics pide 'Authorization: Bearer <token>'
+METRICAS_PUERTO = int(os.getenv("METRICAS_PUERTO", "0"))   # 0 = el worker no expone métricas
+
+TIPO_CONTENIDO = "text/plain; version=0.0.4; charset=utf-8"
+
+_registro = []
+_lock = threading.Lock()
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _etiquetas(nombres, valores, extra=""):
+    partes = [f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        partes.append(extra)
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+
+def _numero(valor):
+    return repr(float(valor)) if valor != float("inf") else "+Inf"
+
+
+class Contador:
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre, self.ayuda, self.etiquetas = nombre, ayuda, tuple(etiquetas)
+        self._valores = {}
+        _registro.append(self)
+
+    def sumar(self, cantidad=1, **etiquetas):
+        clave = tuple(etiquetas.get(n, "") for n in self.etiquetas)
+        with _lock:
+            self._valores[clave] = self._valores.get(clave, 0) + cantidad
+
+    def exponer(self):
+        yield f"# HELP {self.nombre} {self.ayuda}"
+        yield f"# TYPE {self.nombre} counter"
+        with _lock:
+            valores = sorted(self._valores.items())
+        for clave, valor in valores:
+            yield f"{self.nombre}{_etiquetas(self.etiquetas, clave)} {_numero(valor)}"
+
+
+class Histograma:
+    def __init__(self, nombre, ayuda, etiquetas=(), limites=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        self.nombre, self.ayuda, self.etiquetas = nombre, ayuda, tuple(etiquetas)
+        self.limites = tuple(sorted(limites))
+        self._series = {}   # etiquetas -> [conteo por cubeta..., +Inf, suma]
+        _registro.append(self)
+
+    def observar(self, valor, **etiquetas):
+        clave = tuple(etiquetas.get(n, "") for n in self.etiquetas)
+        i = bisect.bisect_left(self.limites, valor)
+        with _lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                serie = self._series[clave] = [0] * (len(self.limites) + 2)
+            serie[i] += 1
+            serie[-1] += valor
+
+    def exponer(self):
+        yield f"# HELP {self.nombre} {self.ayuda}"
+        yield f"# TYPE {self.nombre} histogram"
+        with _lock:
+            series = sorted((clave, list(serie)) for clave, serie in self._series.items())
+        for clave, serie in series:
+            acumulado = 0
+            for limite, conteo in zip(self.limites + (float("inf"),), serie[:-1]):
+                acumulado += conteo
+                le = 'le="' + _numero(limite) + '"'
+                yield f"{self.nombre}_bucket{_etiquetas(self.etiquetas, clave, le)} {acumulado}"
+            yield f"{self.nombre}_sum{_etiquetas(self.etiquetas, clave)} {_numero(serie[-1])}"
+            yield f"{self.nombre}_count{_etiquetas(self.etiquetas, clave)} {acumulado}"
+
+
+class Medidor:
+    """Valor que se calcula al exponer (p. ej. conexiones del pool en uso)."""
+
+    def __init__(self, nombre, ayuda, funcion, tipo="gauge"):
+        self.nombre, self.ayuda, self.funcion, self.tipo = nombre, ayuda, funcion, tipo
+        _registro.append(self)
+
+    def exponer(self):
+        try:
+            valor = self.funcion()
+        except Exception:
+            return  # sin valor en este momento (p. ej. pool aún no creado)
+        yield f"# HELP {self.nombre} {self.ayuda}"
+        yield f"# TYPE {self.nombre} {self.tipo}"
+        yield f"{self.nombre} {_numero(valor)}"
+
+
+def exponer():
+    """Todas las métricas registradas, en formato de texto de Prometheus."""
+    return "\n".join(linea for metrica in list(_registro) for linea in metrica.exponer()) + "\n"
+
+
+def autorizado(cabecera_authorization):
+    return not METRICAS_TOKEN or cabecera_authorization == f"Bearer {METRICAS_TOKEN}"
+
+
+def servir(puerto=METRICAS_PUERTO):
+    """Expone /metrics en un hilo aparte (para procesos sin Flask, como worker.py)."""
+
+    class Manejador(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            if not autorizado(self.headers.get("Authorization")):
+                self.send_error(401)
+                return
+            cuerpo = exponer().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", TIPO_CONTENIDO)
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def log_message(self, *args):
+            pass
+
+    servidor = ThreadingHTTPServer(("0.0.0.0", puerto), Manejador)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+# ---------- MÉTRICAS DE LA APP ----------
+
+PETICION_SEGUNDOS = Histograma("barberia_peticion_segundos", "Duración de las peticiones por ruta.",
+                               ("endpoint", "metodo"))
+PETICIONES = Contador("barberia_peticiones_total", "Peticiones atendidas por ruta y estado.",
+                      ("endpoint", "metodo", "estado"))
+CONSULTAS_POR_PETICION = Histograma("barberia_consultas_por_peticion", "Consultas SQL por petición (N+1 = colas altas).",
+                                    ("endpoint",), limites=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+BD_SEGUNDOS = Contador("barberia_bd_segundos_total", "Segundos dentro de la base por ruta.", ("endpoint",))
+TAREA_SEGUNDOS = Histograma("barberia_tarea_segundos", "Duración de cada pasada de las tareas de fondo.",
+                            ("tarea", "resultado"), limites=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
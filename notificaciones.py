@@ -0,0 +1,224 @@
+# notificaciones.py
+import logging
+import os
+import threading
+import time
+from psycopg2.extras import execute_values
+
+import metricas
+import registro
+
+log = logging.getLogger(__name__)
+
+# Outbox de WhatsApp: las rutas solo insertan en la tabla 'notificaciones'
+# (dentro de su misma transacción) y un hilo despachador hace el envío real.
+
+NOTIF_BACKEND = os.getenv("NOTIF_BACKEND", "twilio").strip().lower()   # 'twilio' o 'falso' (solo desarrollo)
+NOTIF_LOTE = int(os.getenv("NOTIF_LOTE", "20"))
+NOTIF_INTERVALO = float(os.getenv("NOTIF_INTERVALO", "10"))         # segundos entre revisiones
+NOTIF_MAX_INTENTOS = int(os.getenv("NOTIF_MAX_INTENTOS", "5"))
+NOTIF_BACKOFF = int(os.getenv("NOTIF_BACKOFF", "30"))               # segundos, se duplica por intento
+NOTIF_RECLAMO = int(os.getenv("NOTIF_RECLAMO", "300"))              # segundos que un lote queda reservado
+
+SQL_CREAR_TABLA = """
+    CREATE TABLE IF NOT EXISTS notificaciones (
+        id SERIAL PRIMARY KEY,
+        destinatario TEXT NOT NULL,
+        mensaje TEXT NOT NULL,
+        intentos INTEGER NOT NULL DEFAULT 0,
+        proximo_intento TIMESTAMP NOT NULL DEFAULT NOW(),
+        enviado_en TIMESTAMP,
+        error TEXT,
+        creado_en TIMESTAMP NOT NULL DEFAULT NOW()
+    )
+"""
+
+SQL_CREAR_INDICE = """
+    CREATE INDEX IF NOT EXISTS idx_notificaciones_pendientes
+    ON notificaciones (proximo_intento) WHERE enviado_en IS NULL
+"""
+
+# Estado explícito de descarte: tras NOTIF_MAX_INTENTOS la fila queda con
+# 'fallido_en' y el despachador ya no la mira. Las que antes quedaban
+# aparcadas con un próximo intento a un año pasan a ese estado.
+SQL_ESTADO_FALLIDO = [
+    "ALTER TABLE notificaciones ADD COLUMN IF NOT EXISTS fallido_en TIMESTAMP",
+    """
+    UPDATE notificaciones SET fallido_en = NOW()
+    WHERE enviado_en IS NULL AND fallido_en IS NULL
+      AND proximo_intento > NOW() + INTERVAL '300 days'
+    """,
+    "DROP INDEX IF EXISTS idx_notificaciones_pendientes",
+    """
+    CREATE INDEX IF NOT EXISTS idx_notificaciones_pendientes
+    ON notificaciones (proximo_intento) WHERE enviado_en IS NULL AND fallido_en IS NULL
+    """,
+]
+
+
+# ---------- Enviadores ----------
+
+class EnviadorTwilio:
+    """Envía por la API de Twilio reutilizando un único Client."""
+
+    def __init__(self, account_sid=None, auth_token=None, numero=None):
+        from twilio.rest import Client
+        self.client = Client(account_sid or os.getenv("TWILIO_ACCOUNT_SID"),
+                             auth_token or os.getenv("TWILIO_AUTH_TOKEN"))
+        self.numero = numero or os.getenv("TWILIO_WHATSAPP_NUMBER")
+
+    def enviar(self, destinatario, mensaje):
+        msg = self.client.messages.create(
+            from_=self.numero,
+            to=f"whatsapp:{destinatario}",  # Ejemplo: whatsapp:+573001234567
+            body=mensaje
+        )
+        return msg.sid
+
+
+class EnviadorFalso:
+    """Guarda los mensajes en memoria; sirve para desarrollo local y pruebas."""
+
+    def __init__(self):
+        self.enviados = []
+
+    def enviar(self, destinatario, mensaje):
+        self.enviados.append((destinatario, mensaje))
+        log.info("📨 (falso) WhatsApp a %s: %r", destinatario, mensaje[:40])
+        return f"falso-{len(self.enviados)}"
+
+
+TWILIO_VARIABLES = ("TWILIO_ACCOUNT_SID", "TWILIO_AUTH_TOKEN", "TWILIO_WHATSAPP_NUMBER")
+
+_enviador = None
+_sin_configurar_avisado = False
+
+def get_enviador():
+    """
+    Enviador según NOTIF_BACKEND. El falso solo se usa si se pide
+    explícitamente; si a Twilio le faltan credenciales devuelve None y las
+    notificaciones quedan pendientes en el outbox hasta que se configure.
+    """
+    global _enviador, _sin_configurar_avisado
+    if _enviador is None:
+        if NOTIF_BACKEND == "falso":
+            _enviador = EnviadorFalso()
+            return _enviador
+        faltan = [v for v in TWILIO_VARIABLES if not os.getenv(v)]
+        if faltan:
+            if not _sin_configurar_avisado:
+                log.error("❌ WhatsApp sin configurar (faltan %s): las notificaciones quedan pendientes",
+                          ", ".join(faltan))
+                _sin_configurar_avisado = True
+            return None
+        _enviador = EnviadorTwilio()
+    return _enviador
+
+def set_enviador(enviador):
+    """Reemplaza el enviador (p. ej. por un EnviadorFalso en pruebas)."""
+    global _enviador
+    _enviador = enviador
+
+
+# ---------- Outbox ----------
+
+_hay_pendientes = threading.Event()
+
+def encolar(c, destinatario, mensaje):
+    """
+    Inserta la notificación con el cursor de quien llama; se confirma con su
+    commit. Después del commit conviene llamar a avisar() para no esperar al
+    próximo ciclo del despachador.
+    """
+    c.execute(
+        "INSERT INTO notificaciones (destinatario, mensaje) VALUES (%s, %s)",
+        (destinatario, mensaje)
+    )
+
+def encolar_varios(c, mensajes):
+    """Como encolar(), pero para una lista de (destinatario, mensaje) en un solo INSERT."""
+    if mensajes:
+        execute_values(c, "INSERT INTO notificaciones (destinatario, mensaje) VALUES %s",
+                       mensajes, page_size=len(mensajes))
+
+def avisar():
+    _hay_pendientes.set()
+
+def despachar_pendientes(get_conn, enviador=None, lote=NOTIF_LOTE):
+    """
+    Envía un lote de notificaciones vencidas, en tres pasos para no tener
+    filas bloqueadas ni una transacción abierta mientras se habla con Twilio:
+      1. reclamar el lote (FOR UPDATE SKIP LOCKED, así varios despachadores no
+         toman lo mismo): se cuenta el intento, se corre 'proximo_intento'
+         NOTIF_RECLAMO segundos y se hace commit;
+      2. enviar fuera de toda transacción;
+      3. anotar cada resultado en su propia transacción corta.
+    Si el proceso muere entre 1 y 3 la fila vuelve a estar vencida al pasar
+    el reclamo y se reintenta (como mucho, un envío repetido).
+    Devuelve cuántas se enviaron (0 sin enviador configurado: no se toca nada).
+    """
+    enviador = enviador or get_enviador()
+    if enviador is None:
+        return 0
+    conn = get_conn()
+    c = conn.cursor()
+    enviadas = 0
+    try:
+        c.execute("""
+            UPDATE notificaciones
+            SET intentos = intentos + 1,
+                proximo_intento = NOW() + %s * INTERVAL '1 second'
+            WHERE id IN (
+                SELECT id FROM notificaciones
+                WHERE enviado_en IS NULL AND fallido_en IS NULL AND proximo_intento <= NOW()
+                ORDER BY proximo_intento
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, destinatario, mensaje, intentos
+        """, (NOTIF_RECLAMO, lote))
+        reclamadas = c.fetchall()
+        conn.commit()
+
+        for notif_id, destinatario, mensaje, intentos in reclamadas:
+            try:
+                enviador.enviar(destinatario, mensaje)
+            except Exception as e:
+                if intentos >= NOTIF_MAX_INTENTOS:
+                    log.error("❌ WhatsApp a %s descartado tras %s intentos: %s", destinatario, intentos, e)
+                    c.execute("UPDATE notificaciones SET fallido_en = NOW(), error = %s WHERE id = %s",
+                              (str(e)[:500], notif_id))
+                else:
+                    log.warning("⚠️ Error enviando WhatsApp a %s (intento %s): %s", destinatario, intentos, e)
+                    c.execute("""
+                        UPDATE notificaciones
+                        SET error = %s, proximo_intento = NOW() + %s * INTERVAL '1 second'
+                        WHERE id = %s
+                    """, (str(e)[:500], NOTIF_BACKOFF * 2 ** (intentos - 1), notif_id))
+            else:
+                c.execute("UPDATE notificaciones SET enviado_en = NOW(), error = NULL WHERE id = %s",
+                          (notif_id,))
+                enviadas += 1
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return enviadas
+
+def despachador(get_conn, intervalo=NOTIF_INTERVALO):
+    """Bucle del hilo despachador: se despierta al encolar o cada 'intervalo' segundos."""
+    while True:
+        _hay_pendientes.clear()
+        inicio = time.perf_counter()
+        with registro.tarea("notificaciones"):
+            try:
+                while despachar_pendientes(get_conn) >= NOTIF_LOTE:
+                    pass  # había más de un lote, seguir sin esperar
+                metricas.TAREA_SEGUNDOS.observar(time.perf_counter() - inicio, tarea="notificaciones", resultado="ok")
+            except Exception:
+                metricas.TAREA_SEGUNDOS.observar(time.perf_counter() - inicio, tarea="notificaciones", resultado="error")
+                log.exception("❌ Error en despachador de notificaciones")
+                time.sleep(intervalo)
+        _hay_pendientes.wait(intervalo)
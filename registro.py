@@ -0,0 +1,145 @@
+# registro.py
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import metricas
+
+# Logs estructurados: una línea JSON por evento (LOG_FORMATO=texto para leerlos
+# en desarrollo), con el id de la petición o de la pasada de tarea que los
+# produjo. Los hilos que loguean solo dejan el registro en una cola; un hilo
+# aparte (QueueListener) formatea y escribe, así un stdout lento nunca frena
+# una petición. Si la cola se llena, los registros se descartan y se cuentan.
+
+LOG_NIVEL = os.getenv("LOG_NIVEL", "INFO").upper()
+LOG_FORMATO = os.getenv("LOG_FORMATO", "json").strip().lower()     # 'json' o 'texto'
+LOG_COLA_MAX = int(os.getenv("LOG_COLA_MAX", "10000"))
+
+id_peticion = contextvars.ContextVar("id_peticion", default=None)
+id_tarea = contextvars.ContextVar("id_tarea", default=None)
+
+DESCARTADOS = metricas.Contador("barberia_logs_descartados_total", "Registros de log descartados con la cola llena.")
+
+_ID_VALIDO = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+_listener = None
+_lock = threading.Lock()
+
+
+def nuevo_id():
+    return uuid.uuid4().hex[:16]
+
+
+class FormatoJson(logging.Formatter):
+    def format(self, record):
+        datos = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "pid": record.process,
+        }
+        for campo in ("id_peticion", "id_tarea"):
+            valor = getattr(record, campo, None)
+            if valor:
+                datos[campo] = valor
+        datos.update(getattr(record, "datos", None) or {})
+        if record.exc_text:
+            datos["excepcion"] = record.exc_text
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+class FormatoTexto(logging.Formatter):
+    def format(self, record):
+        contexto = getattr(record, "id_peticion", None) or getattr(record, "id_tarea", None) or "-"
+        linea = f"{self.formatTime(record)} {record.levelname:<7} [{contexto}] {record.name}: {record.getMessage()}"
+        datos = getattr(record, "datos", None)
+        if datos:
+            linea += " " + " ".join(f"{k}={v}" for k, v in datos.items())
+        if record.exc_text:
+            linea += "\n" + record.exc_text
+        return linea
+
+
+class _ManejadorCola(logging.handlers.QueueHandler):
+    """
+    Corre en el hilo que loguea: copia el contexto (ids) al registro, deja el
+    mensaje ya armado y nunca bloquea.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.id_peticion = id_peticion.get()
+        record.id_tarea = id_tarea.get()
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DESCARTADOS.sumar()
+
+
+def _arrancar_listener(cola):
+    global _listener
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(FormatoTexto() if LOG_FORMATO == "texto" else FormatoJson())
+    _listener = logging.handlers.QueueListener(cola, salida, respect_handler_level=False)
+    _listener.start()
+
+
+def configurar():
+    """Instala el manejador con cola en el logger raíz (una vez por proceso)."""
+    with _lock:
+        if _listener is not None:
+            return
+        cola = queue.Queue(LOG_COLA_MAX)
+        raiz = logging.getLogger()
+        for manejador in list(raiz.handlers):
+            raiz.removeHandler(manejador)
+        raiz.addHandler(_ManejadorCola(cola))
+        raiz.setLevel(LOG_NIVEL)
+        _arrancar_listener(cola)
+        atexit.register(detener)
+        # El hilo del listener no sobrevive a un fork (gunicorn --preload): el hijo arranca el suyo
+        os.register_at_fork(after_in_child=lambda: _arrancar_listener(cola))
+
+
+def detener():
+    """Escribe lo que quede en la cola (se llama sola al salir del proceso)."""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def iniciar_peticion(cabecera=None):
+    """Fija el id de la petición (el de X-Request-ID si es válido, si no uno nuevo). Devuelve (id, token)."""
+    valor = cabecera if cabecera and _ID_VALIDO.match(cabecera) else nuevo_id()
+    return valor, id_peticion.set(valor)
+
+
+def terminar_peticion(token):
+    id_peticion.reset(token)
+
+
+@contextmanager
+def tarea(nombre):
+    """Marca los logs de una pasada de tarea de fondo con su propio id ('<nombre>-<hex>')."""
+    token = id_tarea.set(f"{nombre}-{uuid.uuid4().hex[:8]}")
+    try:
+        yield id_tarea.get()
+    finally:
+        id_tarea.reset(token)
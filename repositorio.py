@@ -0,0 +1,252 @@
+# repositorio.py
+from collections import namedtuple
+
+from db import USE_POSTGRES, ejecutar_preparada
+
+# Consultas calientes de la app agrupadas por entidad (peluqueros, horarios,
+# citas, contabilidad). Cada una es una sentencia preparada con nombre: en
+# Postgres se hace PREPARE la primera vez que la usa cada conexión del pool y
+# después solo EXECUTE, sin volver a parsear ni planificar. Devuelven filas
+# con nombre (namedtuple) en lugar de tuplas que se desarman por posición.
+# Reciben el cursor: el commit lo decide quien llama.
+
+
+# ---------- PELUQUEROS ----------
+
+PeluqueroPublico = namedtuple("PeluqueroPublico", "id nombre foto")
+Contacto = namedtuple("Contacto", "nombre telefono foto")
+
+
+def peluqueros_publicos(c):
+    """Peluqueros que no son admin, por nombre."""
+    ejecutar_preparada(c, "peluqueros_publicos",
+                       "SELECT id, nombre, foto FROM peluqueros WHERE es_admin = 0 ORDER BY nombre ASC")
+    return [PeluqueroPublico(*fila) for fila in c.fetchall()]
+
+
+def contacto_peluquero(c, peluquero_id):
+    """Nombre, teléfono y foto del peluquero, o None si no existe."""
+    ejecutar_preparada(c, "contacto_peluquero",
+                       "SELECT nombre, telefono, foto FROM peluqueros WHERE id = $1", (int(peluquero_id),))
+    fila = c.fetchone()
+    return Contacto(*fila) if fila else None
+
+
+# ---------- HORARIOS ----------
+
+FilaSemana = namedtuple("FilaSemana", "tipo dia hora cita_id nombre telefono fijo orden")
+
+# Postgres ordena por la columna generada hora_t; SQLite calcula la misma
+# clave "HH:MM" a partir del texto "hh:mm AM/PM" (los % van escapados como
+# en cualquier SQL que pasa por el cursor)
+_HORA_ORDEN_SQLITE = (
+    "printf('%%02d:%%s', (CAST(substr(hora, 1, instr(hora, ':') - 1) AS INTEGER) %% 12)"
+    " + CASE WHEN upper(hora) LIKE '%%PM' THEN 12 ELSE 0 END,"
+    " substr(hora, instr(hora, ':') + 1, 2))"
+)
+
+_SQL_SEMANA_POSTGRES = """
+    SELECT 'peluquero', NULL, nombre, NULL::integer, NULL, NULL, NULL::boolean, NULL::time
+    FROM peluqueros WHERE id = $1
+    UNION ALL
+    (SELECT 'hora', NULL, hora, NULL::integer, NULL, NULL, NULL::boolean, hora_t FROM horarios WHERE peluquero_id = $1
+     UNION
+     SELECT 'hora', NULL, hora, NULL::integer, NULL, NULL, NULL::boolean, hora_t FROM citas    WHERE peluquero_id = $1)
+    UNION ALL
+    SELECT 'disponible', dia, hora, NULL::integer, NULL, NULL, NULL::boolean, NULL::time
+    FROM horarios
+    WHERE peluquero_id = $1
+      AND bloqueado = FALSE
+      AND (fecha IS NULL OR fecha BETWEEN $2 AND $3)
+    UNION ALL
+    SELECT 'bloqueado', dia, hora, NULL::integer, NULL, NULL, NULL::boolean, NULL::time
+    FROM horarios
+    WHERE peluquero_id = $1
+      AND bloqueado = TRUE
+      AND (fecha = '2000-01-01' OR fecha BETWEEN $2 AND $3)
+    UNION ALL
+    SELECT 'ocupado', dia, hora, id, nombre, telefono, fijo, NULL::time
+    FROM citas
+    WHERE peluquero_id = $1
+      AND fecha BETWEEN $2 AND $3
+    ORDER BY 8
+"""
+
+_SQL_SEMANA_SQLITE = f"""
+    SELECT 'peluquero', NULL, nombre, NULL, NULL, NULL, NULL, NULL
+    FROM peluqueros WHERE id = $1
+    UNION ALL
+    SELECT * FROM (
+        SELECT 'hora', NULL, hora, NULL, NULL, NULL, NULL, {_HORA_ORDEN_SQLITE} FROM horarios WHERE peluquero_id = $1
+        UNION
+        SELECT 'hora', NULL, hora, NULL, NULL, NULL, NULL, {_HORA_ORDEN_SQLITE} FROM citas    WHERE peluquero_id = $1)
+    UNION ALL
+    SELECT 'disponible', dia, hora, NULL, NULL, NULL, NULL, NULL
+    FROM horarios
+    WHERE peluquero_id = $1
+      AND bloqueado = 0
+      AND (fecha IS NULL OR fecha BETWEEN $2 AND $3)
+    UNION ALL
+    SELECT 'bloqueado', dia, hora, NULL, NULL, NULL, NULL, NULL
+    FROM horarios
+    WHERE peluquero_id = $1
+      AND bloqueado = 1
+      AND (fecha = '2000-01-01' OR fecha BETWEEN $2 AND $3)
+    UNION ALL
+    SELECT 'ocupado', dia, hora, id, nombre, telefono, fijo, NULL
+    FROM citas
+    WHERE peluquero_id = $1
+      AND fecha BETWEEN $2 AND $3
+    ORDER BY 8
+"""
+
+
+def filas_semana(c, peluquero_id, inicio, fin):
+    """
+    Todo lo que necesita la grilla de la semana en un solo viaje. El campo
+    'tipo' es 'peluquero', 'hora', 'disponible', 'bloqueado' u 'ocupado'.
+    """
+    sql = _SQL_SEMANA_POSTGRES if USE_POSTGRES else _SQL_SEMANA_SQLITE
+    ejecutar_preparada(c, "filas_semana", sql, (int(peluquero_id), inicio, fin))
+    return [FilaSemana(*fila) for fila in c.fetchall()]
+
+
+def bloquear_horario(c, peluquero_id, dia, hora, fecha):
+    """Bloquea el horario de esa fecha (lo crea si solo existía en la grilla base)."""
+    ejecutar_preparada(c, "bloquear_horario", """
+        INSERT INTO horarios (peluquero_id, dia, hora, fecha, bloqueado)
+        VALUES ($1, $2, $3, $4, TRUE)
+        ON CONFLICT (peluquero_id, dia, hora, fecha)
+        DO UPDATE SET bloqueado = TRUE
+    """, (int(peluquero_id), dia, hora, fecha))
+
+
+def bloquear_fecha(c, peluquero_id, dia, fecha):
+    """
+    Bloquea todas las horas de esa fecha: las de la grilla base y las que ya
+    tenían fila propia. Las citas no se tocan.
+    """
+    # en Postgres el parámetro de la lista SELECT necesita el tipo explícito;
+    # en SQLite la fecha ya llega como texto ISO
+    fecha_sql = "$3::date" if USE_POSTGRES else "$3"
+    ejecutar_preparada(c, "bloquear_fecha", f"""
+        INSERT INTO horarios (peluquero_id, dia, hora, fecha, bloqueado)
+        SELECT DISTINCT peluquero_id, dia, hora, {fecha_sql}, TRUE FROM horarios
+        WHERE peluquero_id = $1 AND dia = $2 AND (fecha IS NULL OR fecha = {fecha_sql})
+        ON CONFLICT (peluquero_id, dia, hora, fecha)
+        DO UPDATE SET bloqueado = TRUE
+    """, (int(peluquero_id), dia, fecha))
+
+
+def reactivar_horario(c, peluquero_id, dia, hora, fecha):
+    ejecutar_preparada(c, "reactivar_horario", """
+        UPDATE horarios SET bloqueado = FALSE
+        WHERE peluquero_id = $1 AND dia = $2 AND hora = $3 AND fecha = $4
+    """, (int(peluquero_id), dia, hora, fecha))
+
+
+# ---------- CITAS ----------
+
+Reserva = namedtuple("Reserva", "cita_id nombre_peluquero telefono_peluquero")
+Cita = namedtuple("Cita", "id peluquero_id fijo")
+
+
+def reservar_cita(c, peluquero_id, dia, hora, fecha, nombre, telefono):
+    """
+    Inserta la cita solo si el horario sigue libre (índice único por
+    peluquero, fecha y hora). Devuelve la Reserva o None si otro cliente lo
+    tomó antes.
+    """
+    if USE_POSTGRES:
+        ejecutar_preparada(c, "reservar_cita", """
+            INSERT INTO citas (peluquero_id, dia, hora, fecha, nombre, telefono)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            ON CONFLICT (peluquero_id, fecha, hora) DO NOTHING
+            RETURNING id,
+                      (SELECT nombre   FROM peluqueros WHERE id = citas.peluquero_id),
+                      (SELECT telefono FROM peluqueros WHERE id = citas.peluquero_id)
+        """, (int(peluquero_id), dia, hora, fecha, nombre, telefono))
+        fila = c.fetchone()
+        return Reserva(*fila) if fila else None
+
+    ejecutar_preparada(c, "reservar_cita", """
+        INSERT INTO citas (peluquero_id, dia, hora, fecha, nombre, telefono)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT (peluquero_id, fecha, hora) DO NOTHING
+    """, (int(peluquero_id), dia, hora, fecha, nombre, telefono))
+    if c.rowcount != 1:
+        return None
+    cita_id = c.lastrowid
+    contacto = contacto_peluquero(c, peluquero_id)
+    return Reserva(cita_id, contacto and contacto.nombre, contacto and contacto.telefono)
+
+
+def cita(c, cita_id):
+    ejecutar_preparada(c, "cita", "SELECT id, peluquero_id, fijo FROM citas WHERE id = $1", (int(cita_id),))
+    fila = c.fetchone()
+    return Cita(*fila) if fila else None
+
+
+def marcar_fija(c, cita_id, fijo):
+    ejecutar_preparada(c, "marcar_fija", "UPDATE citas SET fijo = $2 WHERE id = $1", (int(cita_id), bool(fijo)))
+
+
+def cancelar_cita(c, peluquero_id, dia, hora):
+    ejecutar_preparada(c, "cancelar_cita",
+                       "DELETE FROM citas WHERE peluquero_id = $1 AND dia = $2 AND hora = $3",
+                       (int(peluquero_id), dia, hora))
+
+
+# ---------- CONTABILIDAD ----------
+
+Movimiento = namedtuple("Movimiento", "id fecha tipo categoria descripcion valor")
+TotalesSemana = namedtuple("TotalesSemana", "ingresos consumos")
+
+
+def registrar_movimiento(c, peluquero_id, tipo, categoria, descripcion, valor):
+    """Nuevo movimiento con la fecha de ahora; en Postgres el trigger actualiza el resumen."""
+    ejecutar_preparada(c, "registrar_movimiento", """
+        INSERT INTO contabilidad (peluquero_id, tipo, categoria, descripcion, valor, fecha)
+        VALUES ($1, $2, $3, $4, $5, CURRENT_TIMESTAMP)
+    """, (int(peluquero_id), tipo, categoria, descripcion, valor))
+
+
+def movimientos_semana(c, peluquero_id, desde, hasta, antes, limite):
+    """
+    Movimientos con fecha en [desde, hasta), del más nuevo al más viejo,
+    empezando después del movimiento 'antes' (keyset por fecha e id; None =
+    primera página). El rango sobre 'fecha' sin cast usa el índice
+    (peluquero_id, fecha).
+    """
+    ejecutar_preparada(c, "movimientos_semana", """
+        SELECT id, fecha, tipo, categoria, descripcion, valor
+        FROM contabilidad
+        WHERE peluquero_id = $1
+          AND fecha >= $2 AND fecha < $3
+          AND (CAST($4 AS INTEGER) IS NULL OR (fecha, id) < (SELECT fecha, id FROM contabilidad WHERE id = $4))
+        ORDER BY fecha DESC, id DESC
+        LIMIT $5
+    """, (int(peluquero_id), desde, hasta, antes, limite))
+    return [Movimiento(*fila) for fila in c.fetchall()]
+
+
+def totales_semana(c, peluquero_id, desde, hasta, usar_resumen=True):
+    """
+    Ingresos (ventas) y consumos del peluquero en [desde, hasta). Con
+    'usar_resumen' lee la fila de contabilidad_resumen de la semana que
+    empieza en 'desde' (solo Postgres); si no, agrupa los movimientos.
+    """
+    if usar_resumen and USE_POSTGRES:
+        ejecutar_preparada(c, "totales_semana_resumen", """
+            SELECT cortes + ventas_otras, consumos
+            FROM contabilidad_resumen
+            WHERE peluquero_id = $1 AND semana_inicio = $2
+        """, (int(peluquero_id), desde))
+    else:
+        ejecutar_preparada(c, "totales_semana", """
+            SELECT SUM(valor) FILTER (WHERE tipo = 'venta'), SUM(valor) FILTER (WHERE tipo = 'consumo')
+            FROM contabilidad
+            WHERE peluquero_id = $1 AND fecha >= $2 AND fecha < $3
+        """, (int(peluquero_id), desde, hasta))
+    fila = c.fetchone() or (0, 0)
+    return TotalesSemana(float(fila[0] or 0), float(fila[1] or 0))
@@ -0,0 +1,89 @@
+# tareas.py
+import logging
+import os
+import time
+
+import psycopg2
+
+import metricas
+import registro
+
+log = logging.getLogger(__name__)
+
+# Tareas periódicas con un solo ejecutor entre todos los procesos: cada
+# proceso intenta tomar un advisory lock de Postgres por tarea y solo el
+# que lo consigue la ejecuta. Si ese proceso muere, su sesión se cierra,
+# el lock se libera y otro toma el relevo.
+
+LIDER_REINTENTO = float(os.getenv("LIDER_REINTENTO", "30"))  # segundos entre intentos de tomar el lock
+LIDER_LATIDO = float(os.getenv("LIDER_LATIDO", "60"))        # espera máxima antes de revisar el lock
+
+
+def _conectar():
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        raise Exception("❌ No se encontró la variable DATABASE_URL")
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    return conn
+
+
+def _esperar(c, segundos, evento):
+    """Duerme hasta 'segundos' (o hasta que se active 'evento'), revisando el lock cada LIDER_LATIDO."""
+    vence = time.monotonic() + max(segundos, 0)
+    while True:
+        restante = vence - time.monotonic()
+        if restante <= 0:
+            return
+        tramo = min(restante, LIDER_LATIDO)
+        if evento is not None:
+            if evento.wait(tramo):
+                return
+        else:
+            time.sleep(tramo)
+        c.execute("SELECT 1")
+
+
+def ejecutar_como_lider(nombre, paso, evento=None):
+    """
+    Bucle de una tarea periódica. 'paso' hace una pasada y devuelve cuántos
+    segundos esperar hasta la siguiente; 'evento' (threading.Event opcional)
+    permite despertar la tarea antes de tiempo.
+
+    El lock se mantiene en una conexión propia, fuera del pool, mientras el
+    proceso sea el líder. Mientras espera y antes de cada pasada se comprueba
+    que esa conexión siga viva: si se cayó, el lock ya no es nuestro y se
+    vuelve a competir.
+    """
+    while True:
+        conn = None
+        try:
+            conn = _conectar()
+            c = conn.cursor()
+            c.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (f"barberia:{nombre}",))
+            if c.fetchone()[0]:
+                log.info("👑 Proceso %s ejecuta la tarea '%s'", os.getpid(), nombre)
+                while True:
+                    c.execute("SELECT 1")  # si falla, perdimos el lock junto con la sesión
+                    if evento is not None:
+                        evento.clear()
+                    inicio = time.perf_counter()
+                    # Cada pasada lleva su propio id en los logs
+                    with registro.tarea(nombre):
+                        try:
+                            espera = paso()
+                            metricas.TAREA_SEGUNDOS.observar(time.perf_counter() - inicio, tarea=nombre, resultado="ok")
+                        except Exception:
+                            metricas.TAREA_SEGUNDOS.observar(time.perf_counter() - inicio, tarea=nombre, resultado="error")
+                            log.exception("❌ Error en tarea '%s'", nombre)
+                            espera = LIDER_REINTENTO
+                    _esperar(c, espera, evento)
+        except Exception as e:
+            log.warning("⚠️ Tarea '%s' sin lock de líder: %s", nombre, e)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        time.sleep(LIDER_REINTENTO)
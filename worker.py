@@ -0,0 +1,22 @@
+# worker.py
+# Proceso aparte para las tareas periódicas (Procfile: worker).
+# Los workers web pueden correr con JOBS_EN_WEB=False para no lanzarlas.
+import logging
+import os
+import time
+
+os.environ["JOBS_EN_WEB"] = "False"  # las lanzamos aquí, no al importar app
+
+import app
+import metricas
+
+log = logging.getLogger("worker")
+
+if __name__ == "__main__":
+    app.iniciar_tareas()
+    if metricas.METRICAS_PUERTO:
+        metricas.servir()  # duración de las tareas para Prometheus
+        log.info("📈 Métricas del worker en :%s/metrics", metricas.METRICAS_PUERTO)
+    log.info("⚙️ Worker de tareas en marcha")
+    while True:
+        time.sleep(3600)